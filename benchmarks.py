@@ -0,0 +1,695 @@
+"""
+Замеры производительности
+Запустите: python benchmarks.py <замер>
+
+Замеры:
+  sqlite-concurrency  Параллельные чтения и записи: SQLite по умолчанию против профиля (WAL, один писатель)
+  serialization       Ответ списка: ORM + Pydantic + jsonable_encoder против кортежей строк + orjson
+  projection          Размер и время страницы списка: view=full против compact и полей карточки Mini App
+  payload-storage     Metadata в строке notifications против сжатой таблицы notification_payloads
+  rollup              Всплеск обновлений из Airtable: уведомление на событие против сводок
+  rules               Подбор правила уведомления: индекс (action, table_id) против перебора по порядку
+  search              Поиск по title/description: FTS5 / tsvector против LIKE '%слово%' (по умолчанию 1 млн строк)
+  workers             Чтения через HTTP: uvicorn с 1, 2, 4 воркерами (нагрузка - из отдельных процессов)
+"""
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+import httpx
+from sqlalchemy import and_, insert, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+import serialization
+import services
+from database import Base, Notification, create_engines, ensure_search_index
+from models import ListView, NotificationCreate, NotificationFilter, NotificationResponse, NotificationStatus, NotificationType
+from rules import NotificationRule, RuleSet, ACTIONS
+from services import AirtableService, NotificationService, SearchService, RESPONSE_COLUMNS, row_to_response
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def make_notification(number: int) -> NotificationCreate:
+    return NotificationCreate(
+        type=NotificationType.RECORD_CREATE,
+        title=f"Запись {number}",
+        description=f"Создана запись {number}",
+        user_id=f"manager_{number % 20}",
+        user_name=f"Менеджер {number % 20}",
+        details={"number": number}
+    )
+
+async def sqlite_workload(tuned: bool, seconds: float, writers: int, readers: int, seed: int) -> dict:
+    """Писатели создают уведомления, читатели листают список и берут статистику"""
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    write_engine, read_engine = create_engines(f"sqlite+aiosqlite:///{path}", tuned=tuned)
+    WriteSession = async_sessionmaker(write_engine, class_=AsyncSession, expire_on_commit=False)
+    ReadSession = async_sessionmaker(read_engine, class_=AsyncSession, expire_on_commit=False)
+
+    async with write_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with WriteSession() as db:
+        await NotificationService.create_notifications(db, [make_notification(i) for i in range(seed)])
+
+    latencies = {"write": [], "read": []}
+    errors = {"write": 0, "read": 0}
+    deadline = time.monotonic() + seconds
+
+    async def writer(worker: int):
+        number = seed + worker
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            try:
+                async with WriteSession() as db:
+                    await NotificationService.create_notification(db, make_notification(number))
+                latencies["write"].append(time.monotonic() - started)
+            except Exception:
+                errors["write"] += 1
+            number += writers
+
+    async def reader(worker: int):
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            try:
+                async with ReadSession() as db:
+                    await NotificationService.get_notifications(
+                        db, NotificationFilter(user_id=f"manager_{worker % 20}", limit=50)
+                    )
+                    await NotificationService.get_stats(db)
+                latencies["read"].append(time.monotonic() - started)
+            except Exception:
+                errors["read"] += 1
+
+    await asyncio.gather(
+        *(writer(worker) for worker in range(writers)),
+        *(reader(worker) for worker in range(readers))
+    )
+    await write_engine.dispose()
+    await read_engine.dispose()
+
+    return {
+        kind: {
+            "ops": len(values) / seconds,
+            "p50_ms": percentile(values, 0.5) * 1000,
+            "p99_ms": percentile(values, 0.99) * 1000,
+            "errors": errors[kind]
+        }
+        for kind, values in latencies.items()
+    }
+
+async def sqlite_concurrency(args):
+    print(f"SQLite: {args.writers} писателей, {args.readers} читателей, {args.seconds} с, {args.seed} строк в базе\n")
+    print(f"{'профиль':<10} {'операция':<8} {'оп/с':>9} {'p50, мс':>9} {'p99, мс':>9} {'ошибок':>7}")
+    for name, tuned in (("default", False), ("tuned", True)):
+        result = await sqlite_workload(tuned, args.seconds, args.writers, args.readers, args.seed)
+        for kind, row in result.items():
+            print(
+                f"{name:<10} {kind:<8} {row['ops']:>9.1f} {row['p50_ms']:>9.2f} "
+                f"{row['p99_ms']:>9.2f} {row['errors']:>7}"
+            )
+
+def encode_models(notifications: list) -> bytes:
+    """Прежний путь: модель на каждую строку, затем кодирование ответа FastAPI (response_model=dict)"""
+    payload = {
+        "notifications": [NotificationResponse.model_validate(n) for n in notifications],
+        "total": len(notifications)
+    }
+    return JSONResponse(jsonable_encoder(payload)).body
+
+def encode_rows(rows: list) -> bytes:
+    """Быстрый путь: кортежи строк -> dict -> JSON-байты"""
+    return serialization.dumps({
+        "notifications": [row_to_response(row) for row in rows],
+        "total": len(rows)
+    })
+
+def timed(function, repeat: int) -> float:
+    """Медиана времени вызова, мс"""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        samples.append((time.perf_counter() - started) * 1000)
+    return percentile(samples, 0.5)
+
+async def serialization_benchmark(args):
+    encoder = "orjson" if serialization.orjson else "json (stdlib)"
+    print(f"Сериализация списка уведомлений, кодировщик: {encoder}, медиана из {args.repeat} повторов\n")
+    print(f"{'строк':>6} {'этап':<22} {'прежний, мс':>12} {'быстрый, мс':>12} {'ускорение':>10}")
+
+    for count in args.rows:
+        write_engine, read_engine = create_engines(f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}")
+        Session = async_sessionmaker(write_engine, class_=AsyncSession, expire_on_commit=False)
+        async with write_engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        async with Session() as db:
+            await NotificationService.create_notifications(db, [make_notification(i) for i in range(count)])
+
+        filters = NotificationFilter(limit=count, include_total="false")
+        async with Session() as db:
+            notifications, _ = await NotificationService.get_notifications(db, filters)
+            query, _ = NotificationService.list_query(filters, *RESPONSE_COLUMNS)
+            rows = (await db.execute(query)).all()
+
+        # Полный путь с запросом к БД, новая сессия на каждый запрос - как в API
+        async def measure(path) -> float:
+            samples = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                async with Session() as db:
+                    await path(db)
+                samples.append((time.perf_counter() - started) * 1000)
+            return percentile(samples, 0.5)
+
+        async def old_path(db):
+            found, _ = await NotificationService.get_notifications(db, filters)
+            encode_models(found)
+
+        async def new_path(db):
+            found, _ = await NotificationService.get_notification_rows(db, filters)
+            serialization.dumps({"notifications": found, "total": len(found)})
+
+        full = (await measure(old_path), await measure(new_path))
+        encode = (timed(lambda: encode_models(notifications), args.repeat), timed(lambda: encode_rows(rows), args.repeat))
+        await write_engine.dispose()
+        await read_engine.dispose()
+
+        for stage, (old, new) in (("кодирование", encode), ("запрос + кодирование", full)):
+            print(f"{count:>6} {stage:<22} {old:>12.2f} {new:>12.2f} {old / new:>9.1f}x")
+
+def airtable_event(number: int, field_count: int) -> dict:
+    """Событие Airtable с полями записи - как его сохраняет AirtableService в metadata"""
+    return {
+        "base_id": "appBenchmark0001",
+        "table_id": "tblOrders0000001",
+        "record_id": f"rec{number:014d}",
+        "action": "updated",
+        "user_id": f"manager_{number % 20}",
+        "user_name": f"Менеджер {number % 20}",
+        "fields": {
+            f"Поле {column}": f"Значение {column} записи {number}" for column in range(field_count)
+        }
+    }
+
+# Поля карточки уведомления в Mini App (app.js)
+MINI_APP_FIELDS = ["type", "title", "description", "user_id", "user_name", "status", "details"]
+
+async def projection_benchmark(args):
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    write_engine, read_engine = create_engines(f"sqlite+aiosqlite:///{path}")
+    Session = async_sessionmaker(write_engine, class_=AsyncSession, expire_on_commit=False)
+    async with write_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with Session() as db:
+        await NotificationService.create_notifications(db, [
+            AirtableService.build_notification(airtable_event(number, args.fields))
+            for number in range(args.seed)
+        ])
+
+    print(
+        f"Страница списка из {args.limit} уведомлений Airtable ({args.fields} полей записи в metadata), "
+        f"медиана из {args.repeat} повторов\n"
+    )
+    print(f"{'набор полей':<22} {'байт':>10} {'мс':>8} {'байт, %':>8} {'время, %':>9}")
+    variants = (
+        ("view=full", {"view": ListView.FULL}),
+        ("view=standard", {}),
+        ("view=compact", {"view": ListView.COMPACT}),
+        ("fields=карточка", {"fields": MINI_APP_FIELDS}),
+    )
+    baseline = None
+    for name, options in variants:
+        filters = NotificationFilter(limit=args.limit, include_total="false", **options)
+        samples = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            async with Session() as db:
+                rows, _ = await NotificationService.get_notification_rows(db, filters)
+            body = serialization.dumps({"notifications": rows, "total": None})
+            samples.append((time.perf_counter() - started) * 1000)
+        size, latency = len(body), percentile(samples, 0.5)
+        baseline = baseline or (size, latency)
+        print(
+            f"{name:<22} {size:>10} {latency:>8.2f} "
+            f"{size / baseline[0] * 100:>7.0f}% {latency / baseline[1] * 100:>8.0f}%"
+        )
+
+    await write_engine.dispose()
+    await read_engine.dispose()
+
+async def payload_storage_benchmark(args):
+    print(
+        f"{args.seed} уведомлений Airtable ({args.fields} полей записи в metadata), "
+        f"страница {args.limit}, медиана из {args.repeat} повторов\n"
+    )
+    print(f"{'хранение':<10} {'файл БД, КБ':>12} {'вставка, с':>11} {'compact, мс':>12} {'full, мс':>9}")
+    for mode in ("inline", "table"):
+        services.PAYLOAD_STORAGE = mode
+        path = os.path.join(tempfile.mkdtemp(), "bench.db")
+        write_engine, read_engine = create_engines(f"sqlite+aiosqlite:///{path}")
+        Session = async_sessionmaker(write_engine, class_=AsyncSession, expire_on_commit=False)
+        async with write_engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+        # Повторная доставка части событий - как бывает с webhook
+        events = [airtable_event(number % int(args.seed * 0.8), args.fields) for number in range(args.seed)]
+        started = time.perf_counter()
+        async with Session() as db:
+            await NotificationService.create_notifications(db, [AirtableService.build_notification(e) for e in events])
+        insert_seconds = time.perf_counter() - started
+        async with write_engine.begin() as conn:
+            await conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+            await conn.exec_driver_sql("VACUUM")
+
+        latencies = []
+        for view in (ListView.COMPACT, ListView.FULL):
+            # Глубокая страница - листание старых уведомлений
+            filters = NotificationFilter(limit=args.limit, offset=args.seed // 2, view=view, include_total="false")
+            samples = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                async with Session() as db:
+                    await NotificationService.get_notification_rows(db, filters)
+                samples.append((time.perf_counter() - started) * 1000)
+            latencies.append(percentile(samples, 0.5))
+
+        await write_engine.dispose()
+        await read_engine.dispose()
+        print(
+            f"{mode:<10} {os.path.getsize(path) / 1024:>12.0f} {insert_seconds:>11.2f} "
+            f"{latencies[0]:>12.2f} {latencies[1]:>9.2f}"
+        )
+
+async def rollup_benchmark(args):
+    print(
+        f"{args.events} обновлений: {args.users} менеджеров x {args.tables} таблиц, "
+        f"пачки по {args.batch} (как у очереди webhook)\n"
+    )
+    print(f"{'режим':<10} {'уведомлений':>12} {'файл БД, КБ':>12} {'запись, с':>10} {'событий/с':>10}")
+    for name, window in (("без сводок", 0), ("сводки", 60)):
+        services.ROLLUP_WINDOW_SECONDS = window
+        path = os.path.join(tempfile.mkdtemp(), "bench.db")
+        write_engine, read_engine = create_engines(f"sqlite+aiosqlite:///{path}")
+        Session = async_sessionmaker(write_engine, class_=AsyncSession, expire_on_commit=False)
+        async with write_engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+        events = []
+        for number in range(args.events):
+            event = airtable_event(number, args.fields)
+            event["user_id"] = f"manager_{number % args.users}"
+            event["table_id"] = f"tbl{number // args.users % args.tables:013d}"
+            events.append(event)
+        started = time.perf_counter()
+        for start in range(0, len(events), args.batch):
+            async with Session() as db:
+                await AirtableService.process_airtable_events(db, events[start:start + args.batch])
+        write_seconds = time.perf_counter() - started
+
+        async with Session() as db:
+            stats = await NotificationService.get_stats(db)
+        async with write_engine.begin() as conn:
+            await conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+            await conn.exec_driver_sql("VACUUM")
+        await write_engine.dispose()
+        await read_engine.dispose()
+        print(
+            f"{name:<10} {stats.total:>12} {os.path.getsize(path) / 1024:>12.0f} "
+            f"{write_seconds:>10.2f} {args.events / write_seconds:>10.0f}"
+        )
+
+def generate_rules(count: int, tables: int) -> list:
+    """Правила по таблицам и действиям с условиями на поля; каждое десятое - без таблицы"""
+    actions = ACTIONS[:4]
+    rules = []
+    for number in range(count):
+        rule = {
+            "name": f"rule-{number}",
+            "action": actions[number % len(actions)],
+            "fields": {"Status": f"Статус {number % 7}"},
+            "type": "record_update",
+            "title": "{record_name}: {fields[Status]}",
+            "description": "{user_name} - таблица {table_name}"
+        }
+        if number % 10:
+            rule["table_id"] = f"tbl{number % tables:05d}"
+        rules.append(NotificationRule(**rule))
+    return rules
+
+def linear_match(rules: RuleSet, event: dict):
+    """Перебор всех правил по порядку - как цепочка if/elif"""
+    fields = event.get("fields") or {}
+    for compiled in rules.rules:
+        rule = compiled.rule
+        if rule.action is not None and rule.action != event["action"]:
+            continue
+        if rule.table_id is not None and rule.table_id != event["table_id"]:
+            continue
+        if compiled.matches(event, fields):
+            return compiled
+    return None
+
+async def rules_benchmark(args):
+    random_events = []
+    for number in range(args.events):
+        event = airtable_event(number, 5)
+        event["action"] = ACTIONS[number % 4]
+        event["table_id"] = f"tbl{number * 7919 % (args.tables * 2):05d}"  # половина таблиц без правил
+        event["fields"]["Status"] = f"Статус {number % 11}"
+        random_events.append(event)
+
+    print(f"{args.events} событий, {args.tables} таблиц\n")
+    print(f"{'правил':>7} {'компиляция, мс':>15} {'перебор, мкс':>13} {'индекс, мкс':>12} {'ускорение':>10}")
+    for count in args.rules:
+        rules = generate_rules(count, args.tables)
+        started = time.perf_counter()
+        compiled = RuleSet(rules)
+        compile_ms = (time.perf_counter() - started) * 1000
+
+        timings = []
+        for match in (linear_match, RuleSet.match):
+            started = time.perf_counter()
+            matched = [match(compiled, event) for event in random_events]
+            timings.append((time.perf_counter() - started) / len(random_events) * 1_000_000)
+            names = [rule.rule.name if rule else None for rule in matched]
+            if match is linear_match:
+                expected = names
+            assert names == expected, "индекс выбрал не то правило, что перебор"
+        print(f"{count:>7} {compile_ms:>15.1f} {timings[0]:>13.1f} {timings[1]:>12.2f} {timings[0] / timings[1]:>9.0f}x")
+
+# Корпус поиска: частые слова CRM в разных падежах и редкие названия клиентов
+SEARCH_ENTITIES = (
+    ("сделка", "сделки", "сделку", "сделкой"), ("контакт", "контакта", "контакту", "контакты"),
+    ("договор", "договора", "договору", "договоры"), ("задача", "задачи", "задачу", "задачей"),
+    ("счет", "счета", "счету", "счетом"), ("встреча", "встречи", "встречу", "встречей")
+)
+SEARCH_ACTIONS = ("Создана", "Обновлена", "Закрыта", "Перенесена", "Оплачена", "Отменена", "Согласована")
+SEARCH_SYLLABLES = ("ро", "ма", "ли", "ка", "то", "ве", "на", "сы", "лю", "ти", "пе", "ду", "ко", "зе", "бра", "гор")
+SEARCH_QUERIES = (
+    ("частое слово", "сделки", None),
+    ("префикс", "догов", None),
+    ("два слова", "оплачена сделка", None),
+    ("частое, менеджер", "сделки", ["manager_6"]),
+    ("редкое название", None, None),
+    ("нет совпадений", "трансформатор", None)
+)
+
+def search_corpus(count: int, seed: int = 7):
+    """Строки notifications для массовой вставки (генератор); в конце - редкое название"""
+    rng = random.Random(seed)
+    names = sorted({"".join(rng.choices(SEARCH_SYLLABLES, k=3)) for _ in range(50000)})
+    started = datetime.utcnow()
+    for number in range(count):
+        forms = SEARCH_ENTITIES[number % len(SEARCH_ENTITIES)]
+        name = names[rng.randrange(len(names))].capitalize()
+        yield {
+            "type": NotificationType.RECORD_UPDATE,
+            "title": f"{rng.choice(SEARCH_ACTIONS)} {forms[0]} {name}",
+            "description": f"Менеджер {rng.randrange(200)} изменил {rng.choice(forms[1:])} клиента {name} "
+                           f"на сумму {rng.randrange(1000, 1000000)} руб.",
+            "user_id": f"manager_{number % 50}",
+            "user_name": f"Manager {number % 50}",
+            "source": "airtable",
+            "status": NotificationStatus.UNREAD,
+            "timestamp": started - timedelta(seconds=number),
+            "change_seq": number + 1
+        }
+
+def like_conditions(terms: list) -> list:
+    """Базовый вариант без индекса: каждое слово - подстрока title или description"""
+    return [
+        or_(Notification.title.ilike(f"%{term}%"), Notification.description.ilike(f"%{term}%"))
+        for term in terms
+    ]
+
+async def search_benchmark(args):
+    url = args.url or f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    write_engine, read_engine = create_engines(url)
+    Session = async_sessionmaker(write_engine, class_=AsyncSession, expire_on_commit=False)
+    dialect = write_engine.dialect.name
+    async with write_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+
+    print(f"{dialect}: {args.rows} уведомлений, страница {args.limit}, медиана из {args.repeat} повторов\n")
+    corpus = search_corpus(args.rows)
+    rare = None
+    started = time.perf_counter()
+    while True:
+        chunk = [row for _, row in zip(range(args.batch), corpus)]
+        if not chunk:
+            break
+        rare = chunk[-1]["title"].split()[-1]
+        async with write_engine.begin() as conn:
+            await conn.execute(insert(Notification), chunk)
+    load_seconds = time.perf_counter() - started
+
+    # Цена синхронизации индекса при записи - вставка через сервис, как у webhook
+    async def insert_ms() -> float:
+        started = time.perf_counter()
+        async with Session() as db:
+            await NotificationService.create_notifications(db, [make_notification(n) for n in range(args.insert)])
+        return (time.perf_counter() - started) * 1000
+
+    insert_plain = await insert_ms()
+    size_before = await database_size(write_engine, url)
+
+    # Индекс строится по готовому корпусу - как после manage.py rebuild-search
+    started = time.perf_counter()
+    async with write_engine.begin() as conn:
+        await conn.run_sync(ensure_search_index)
+    build_seconds = time.perf_counter() - started
+    index_mb = (await database_size(write_engine, url) - size_before) / 1024 / 1024
+    print(f"загрузка корпуса: {load_seconds:.1f} с, построение индекса: {build_seconds:.1f} с, индекс: {index_mb:.0f} МБ")
+    print(f"вставка {args.insert} уведомлений: без индекса {insert_plain:.0f} мс, с индексом {await insert_ms():.0f} мс\n")
+
+    window = services.SEARCH_RANK_WINDOW
+    print(f"{'запрос':<19} {'найдено':>8} {'LIKE, мс':>9} {'все, мс':>9} {f'окно {window}, мс':>14} {'LIKE/окно':>10}")
+    for label, q, user_ids in SEARCH_QUERIES:
+        q = q or rare
+        like_query = (
+            select(Notification.id).where(and_(*like_conditions(SearchService.terms(q))))
+            .order_by(Notification.timestamp.desc(), Notification.id.desc()).limit(args.limit)
+        )
+        if user_ids:
+            like_query = like_query.where(Notification.user_id.in_(user_ids))
+        filters = NotificationFilter(limit=args.limit, include_total="false", view=ListView.COMPACT, user_ids=user_ids)
+        timings = []
+        # LIKE, ранжирование всех совпадений, ранжирование окна новейших
+        for rank_window in (None, 0, window):
+            samples = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                async with Session() as db:
+                    if rank_window is None:
+                        await db.execute(like_query)
+                    else:
+                        services.SEARCH_RANK_WINDOW = rank_window
+                        await SearchService.search(db, q, filters)
+                samples.append((time.perf_counter() - started) * 1000)
+            timings.append(percentile(samples, 0.5))
+        async with Session() as db:
+            _, total = await SearchService.search(
+                db, q, NotificationFilter(limit=1, include_total="exact", user_ids=user_ids)
+            )
+        print(
+            f"{label:<19} {total:>8} {timings[0]:>9.1f} {timings[1]:>9.1f} {timings[2]:>14.1f} "
+            f"{timings[0] / timings[2]:>9.1f}x"
+        )
+
+    await write_engine.dispose()
+    await read_engine.dispose()
+
+async def database_size(engine, url: str) -> int:
+    """Размер базы в байтах (SQLite - файл после checkpoint)"""
+    async with engine.begin() as conn:
+        if engine.dialect.name == "postgresql":
+            return (await conn.exec_driver_sql("SELECT pg_database_size(current_database())")).scalar()
+        await conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+    return os.path.getsize(url.split("///", 1)[1])
+
+WORKERS_READ_PATHS = (
+    "/api/notifications?user_id=manager_{n}&limit=20",
+    "/api/notifications?limit=20&view=compact",
+    "/api/stats?user_id=manager_{n}",
+    "/api/notifications/{id}"
+)
+
+def http_reader(base_url: str, seconds: float, connections: int, ids: int, seed: int) -> list:
+    """Процесс-клиент: connections параллельных читателей, задержки запросов в секундах"""
+    async def client() -> list:
+        latencies = []
+        deadline = time.monotonic() + seconds
+        limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as http:
+            async def reader(number: int):
+                rnd = random.Random(seed * 1000 + number)
+                while time.monotonic() < deadline:
+                    path = rnd.choice(WORKERS_READ_PATHS).format(n=rnd.randrange(20), id=rnd.randrange(1, ids + 1))
+                    started = time.monotonic()
+                    response = await http.get(path)
+                    if response.status_code == 200:
+                        latencies.append(time.monotonic() - started)
+            await asyncio.gather(*(reader(number) for number in range(connections)))
+        return latencies
+
+    return asyncio.run(client())
+
+def wait_healthy(base_url: str, server: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"uvicorn завершился с кодом {server.returncode}")
+        try:
+            if httpx.get(f"{base_url}/health", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("uvicorn не поднялся за отведенное время")
+
+async def workers_benchmark(args):
+    workdir = tempfile.mkdtemp()
+    url = args.url or f"sqlite+aiosqlite:///{os.path.join(workdir, 'bench.db')}"
+    write_engine, read_engine = create_engines(url)
+    async with write_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    Session = async_sessionmaker(write_engine, class_=AsyncSession, expire_on_commit=False)
+    async with Session() as db:
+        await NotificationService.create_notifications(db, [make_notification(n) for n in range(args.seed)])
+    await write_engine.dispose()
+    await read_engine.dispose()
+
+    print(
+        f"{write_engine.dialect.name}: {args.seed} уведомлений, {args.clients} процессов-клиентов "
+        f"по {args.connections} соединений, {args.seconds} с; ядер CPU: {os.cpu_count()}\n"
+    )
+    print(f"{'воркеров':>8} {'запр/с':>9} {'ускорение':>10} {'p50, мс':>9} {'p99, мс':>9}")
+    baseline = None
+    for workers in args.workers:
+        port = args.port
+        env = dict(
+            os.environ, DATABASE_URL=url, WEB_CONCURRENCY=str(workers),
+            EVENT_BROKER_DIR=os.path.join(workdir, f"events-{workers}")
+        )
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port),
+             "--workers", str(workers), "--log-level", "warning", "--no-access-log"],
+            env=env
+        )
+        base_url = f"http://127.0.0.1:{port}"
+        try:
+            wait_healthy(base_url, server)
+            # Короткий прогон - пулы соединений и кэш всех воркеров прогреты
+            with ProcessPoolExecutor(args.clients) as pool:
+                jobs = [
+                    pool.submit(http_reader, base_url, min(2.0, args.seconds), args.connections, args.seed, client)
+                    for client in range(args.clients)
+                ]
+                [job.result() for job in jobs]
+                jobs = [
+                    pool.submit(http_reader, base_url, args.seconds, args.connections, args.seed, client)
+                    for client in range(args.clients)
+                ]
+                latencies = [value for job in jobs for value in job.result()]
+        finally:
+            server.terminate()
+            server.wait(30)
+        rate = len(latencies) / args.seconds
+        baseline = baseline or rate
+        print(
+            f"{workers:>8} {rate:>9.0f} {rate / baseline:>9.2f}x "
+            f"{percentile(latencies, 0.5) * 1000:>9.1f} {percentile(latencies, 0.99) * 1000:>9.1f}"
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры производительности")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    concurrency = subparsers.add_parser("sqlite-concurrency", help="Чтения и записи параллельно на SQLite")
+    concurrency.add_argument("--seconds", type=float, default=5.0)
+    concurrency.add_argument("--writers", type=int, default=4)
+    concurrency.add_argument("--readers", type=int, default=8)
+    concurrency.add_argument("--seed", type=int, default=5000, help="Уведомлений в базе до начала замера")
+
+    serialization_parser = subparsers.add_parser("serialization", help="Кодирование списка уведомлений")
+    serialization_parser.add_argument("--rows", type=int, nargs="+", default=[100, 1000])
+    serialization_parser.add_argument("--repeat", type=int, default=50)
+
+    projection = subparsers.add_parser("projection", help="Проекция полей списка уведомлений")
+    projection.add_argument("--seed", type=int, default=2000, help="Уведомлений в базе")
+    projection.add_argument("--limit", type=int, default=100, help="Размер страницы")
+    projection.add_argument("--fields", type=int, default=30, help="Полей записи Airtable в событии")
+    projection.add_argument("--repeat", type=int, default=50)
+
+    payload_storage = subparsers.add_parser("payload-storage", help="Хранение metadata уведомлений")
+    payload_storage.add_argument("--seed", type=int, default=20000, help="Уведомлений в базе")
+    payload_storage.add_argument("--limit", type=int, default=100, help="Размер страницы")
+    payload_storage.add_argument("--fields", type=int, default=30, help="Полей записи Airtable в событии")
+    payload_storage.add_argument("--repeat", type=int, default=20)
+
+    rollup = subparsers.add_parser("rollup", help="Сводки однотипных событий Airtable")
+    rollup.add_argument("--events", type=int, default=20000, help="Событий во всплеске")
+    rollup.add_argument("--users", type=int, default=3, help="Менеджеров")
+    rollup.add_argument("--tables", type=int, default=2, help="Таблиц")
+    rollup.add_argument("--batch", type=int, default=500, help="Событий в пачке записи")
+    rollup.add_argument("--fields", type=int, default=10, help="Полей записи Airtable в событии")
+
+    rules_parser = subparsers.add_parser("rules", help="Подбор правила уведомления")
+    rules_parser.add_argument("--rules", type=int, nargs="+", default=[100, 1000, 10000, 50000])
+    rules_parser.add_argument("--tables", type=int, default=500, help="Таблиц с правилами")
+    rules_parser.add_argument("--events", type=int, default=2000)
+
+    search = subparsers.add_parser("search", help="Полнотекстовый поиск уведомлений")
+    search.add_argument("--rows", type=int, default=1_000_000, help="Уведомлений в корпусе")
+    search.add_argument("--batch", type=int, default=20000, help="Строк в пачке загрузки")
+    search.add_argument("--insert", type=int, default=1000, help="Уведомлений для замера вставки с индексом")
+    search.add_argument("--limit", type=int, default=20, help="Размер страницы")
+    search.add_argument("--repeat", type=int, default=5)
+    search.add_argument("--url", default="", help="База для замера (PostgreSQL); все таблицы будут пересозданы")
+
+    workers = subparsers.add_parser("workers", help="Масштабирование чтений по воркерам uvicorn")
+    workers.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    workers.add_argument("--seed", type=int, default=20000, help="Уведомлений в базе")
+    workers.add_argument("--clients", type=int, default=4, help="Процессов-клиентов нагрузки")
+    workers.add_argument("--connections", type=int, default=16, help="Соединений на процесс-клиент")
+    workers.add_argument("--seconds", type=float, default=10.0)
+    workers.add_argument("--port", type=int, default=8765)
+    workers.add_argument("--url", default="", help="База для замера (PostgreSQL); все таблицы будут пересозданы")
+
+    args = parser.parse_args()
+
+    if args.command == "sqlite-concurrency":
+        asyncio.run(sqlite_concurrency(args))
+    elif args.command == "serialization":
+        asyncio.run(serialization_benchmark(args))
+    elif args.command == "projection":
+        asyncio.run(projection_benchmark(args))
+    elif args.command == "payload-storage":
+        asyncio.run(payload_storage_benchmark(args))
+    elif args.command == "rollup":
+        asyncio.run(rollup_benchmark(args))
+    elif args.command == "rules":
+        asyncio.run(rules_benchmark(args))
+    elif args.command == "search":
+        asyncio.run(search_benchmark(args))
+    elif args.command == "workers":
+        asyncio.run(workers_benchmark(args))
+
+if __name__ == "__main__":
+    main()
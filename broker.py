@@ -0,0 +1,375 @@
+"""
+Рассылка событий между процессами приложения (воркерами uvicorn / gunicorn)
+
+У каждого воркера свои подписчики живой ленты и свой LRU кэша запросов. WorkerFanout
+пересылает события broadcaster и прямые инвалидации кэша (удаление уведомлений,
+сброс секций) остальным воркерам через брокер. Там событие раздается подписчикам
+и слушателям, а кэш инвалидируется без повторной пересылки.
+
+Брокер выбирается EVENT_BROKER:
+- unix - датаграммные Unix-сокеты в EVENT_BROKER_DIR, по сокету на воркер. Для
+  воркеров одной машины, внешних сервисов не нужно. По умолчанию при WEB_CONCURRENCY > 1
+  (ту же переменную читают uvicorn и gunicorn как число воркеров);
+- memory - общий хаб внутри процесса, для тестов;
+- пусто - один процесс, пересылать некому.
+Для нескольких машин нужен наследник EventBroker поверх внешней шины (например,
+Redis pub/sub).
+
+Доставка best effort, как и у живой ленты. Брокер не блокирует публикующего, а
+сообщение получателю, который не успевает разбирать очередь, отбрасывается и
+учитывается в stats. Такой получатель затем сбрасывает локальный кэш целиком.
+"""
+import asyncio
+import json
+import os
+import socket
+import time
+from abc import ABC, abstractmethod
+from typing import Callable, List, Optional
+
+from cache import QueryCache, query_cache
+from pubsub import NotificationBroadcaster, broadcaster
+from serialization import dumps
+
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+EVENT_BROKER = os.getenv("EVENT_BROKER", "unix" if WEB_CONCURRENCY > 1 else "").lower()
+EVENT_BROKER_DIR = os.getenv("EVENT_BROKER_DIR", "/tmp/notification-events")
+EVENT_BROKER_PEERS_REFRESH_SECONDS = float(os.getenv("EVENT_BROKER_PEERS_REFRESH_SECONDS", "1"))
+# Событие больше этого размера уходит другим воркерам без тела уведомления
+EVENT_BROKER_MAX_MESSAGE = int(os.getenv("EVENT_BROKER_MAX_MESSAGE", str(64 * 1024)))
+
+class EventBroker(ABC):
+    """Транспорт сообщений между процессами: publish отправляет копию всем, кроме себя"""
+
+    # Ограничение размера сообщения транспорта; None - без ограничения
+    max_message_size: Optional[int] = None
+
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+
+    @abstractmethod
+    async def start(self, handler: Callable[[bytes], None]):
+        """
+        Начать прием: handler вызывается в цикле событий на каждое сообщение
+
+        Пустое сообщение - сигнал, что часть сообщений для этого процесса потеряна.
+        """
+
+    @abstractmethod
+    def publish(self, data: bytes):
+        """Отправить сообщение; не ждет получателей"""
+
+    async def stop(self):
+        pass
+
+    def stats(self) -> dict:
+        return {
+            "broker": type(self).__name__,
+            "sent": self.sent,
+            "received": self.received,
+            "dropped": self.dropped
+        }
+
+class MemoryBroker(EventBroker):
+    """Брокер внутри процесса: экземпляры с общим hub изображают воркеры (для тестов)"""
+
+    def __init__(self, hub: Optional[list] = None):
+        super().__init__()
+        self.hub = hub if hub is not None else []
+        self.handler: Optional[Callable[[bytes], None]] = None
+
+    async def start(self, handler: Callable[[bytes], None]):
+        self.handler = handler
+        self.hub.append(self)
+
+    def publish(self, data: bytes):
+        # Получатель разбирает сообщение позже, как пришедшее из сокета
+        loop = asyncio.get_running_loop()
+        for peer in self.hub:
+            if peer is not self:
+                loop.call_soon(peer._receive, data)
+                self.sent += 1
+
+    def _receive(self, data: bytes):
+        if self.handler is None:
+            self.dropped += 1
+            return
+        self.received += 1
+        self.handler(data)
+
+    async def stop(self):
+        if self in self.hub:
+            self.hub.remove(self)
+        self.handler = None
+
+class UnixSocketBroker(EventBroker):
+    """
+    Датаграммные Unix-сокеты: воркер слушает <directory>/<name>.sock и отправляет копию
+    сообщения в каждый сокет каталога
+
+    Список соседей перечитывается не чаще раза в refresh_seconds. Сокет воркера,
+    завершившегося без уборки, удаляется при первой неудачной отправке.
+    """
+
+    max_message_size = EVENT_BROKER_MAX_MESSAGE
+
+    def __init__(
+        self,
+        directory: str = EVENT_BROKER_DIR,
+        name: Optional[str] = None,
+        refresh_seconds: float = EVENT_BROKER_PEERS_REFRESH_SECONDS
+    ):
+        super().__init__()
+        self.directory = directory
+        self.name = name or str(os.getpid())
+        self.path = os.path.join(directory, f"{self.name}.sock")
+        self.refresh_seconds = refresh_seconds
+        self.dead_peers = 0
+        # Соседи, которым не досталось сообщение: первым им уйдет сигнал потери
+        self._lagging: set = set()
+        self.sock: Optional[socket.socket] = None
+        self.handler: Optional[Callable[[bytes], None]] = None
+        self._peers: List[str] = []
+        self._peers_checked: Optional[float] = None
+
+    async def start(self, handler: Callable[[bytes], None]):
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(self.path)
+        sock.setblocking(False)
+        # Очередь датаграмм ограничена и байтами, и числом (net.unix.max_dgram_qlen),
+        # поэтому WorkerFanout склеивает сообщения одного шага цикла в одну датаграмму
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16 * self.max_message_size)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 2 * self.max_message_size)
+        except OSError:
+            pass
+        self.sock = sock
+        self.handler = handler
+        self._peers_checked = None
+        asyncio.get_running_loop().add_reader(sock.fileno(), self._read)
+
+    def _read(self):
+        while self.sock is not None:
+            try:
+                data = self.sock.recv(self.max_message_size)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                print(f"Ошибка чтения сокета событий {self.path}: {e}")
+                return
+            if data:
+                self.received += 1
+            try:
+                self.handler(data)
+            except Exception as e:
+                print(f"Ошибка обработки события другого воркера: {e}")
+
+    def peers(self) -> List[str]:
+        """Сокеты других воркеров (список кэшируется на refresh_seconds)"""
+        now = time.monotonic()
+        if self._peers_checked is None or now - self._peers_checked >= self.refresh_seconds:
+            self._peers_checked = now
+            try:
+                names = os.listdir(self.directory)
+            except OSError:
+                names = []
+            paths = (os.path.join(self.directory, name) for name in names if name.endswith(".sock"))
+            self._peers = [path for path in paths if path != self.path]
+        return self._peers
+
+    def _forget(self, peer: str):
+        if peer in self._peers:
+            self._peers.remove(peer)
+        try:
+            os.unlink(peer)
+            self.dead_peers += 1
+        except OSError:
+            pass
+
+    def publish(self, data: bytes):
+        if self.sock is None:
+            return
+        for peer in list(self.peers()):
+            try:
+                if peer in self._lagging:
+                    self.sock.sendto(b"", peer)
+                    self._lagging.discard(peer)
+                self.sock.sendto(data, peer)
+                self.sent += 1
+            except ConnectionRefusedError:
+                # Файл есть, а процесса нет - воркер упал, не убрав сокет
+                self._lagging.discard(peer)
+                self._forget(peer)
+            except FileNotFoundError:
+                self._lagging.discard(peer)
+                if peer in self._peers:
+                    self._peers.remove(peer)
+            except (BlockingIOError, InterruptedError):
+                # Очередь получателя полна - не ждем медленный воркер
+                self.dropped += 1
+                self._lagging.add(peer)
+            except OSError as e:
+                self.dropped += 1
+                self._lagging.add(peer)
+                print(f"Ошибка отправки события воркеру {peer}: {e}")
+
+    async def stop(self):
+        if self.sock is None:
+            return
+        sock, self.sock = self.sock, None
+        try:
+            asyncio.get_running_loop().remove_reader(sock.fileno())
+        except RuntimeError:
+            pass
+        sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def stats(self) -> dict:
+        return dict(
+            super().stats(),
+            path=self.path,
+            peers=len(self.peers()) if self.sock is not None else 0,
+            dead_peers=self.dead_peers
+        )
+
+def create_broker(kind: str = EVENT_BROKER) -> Optional[EventBroker]:
+    """Брокер по имени из EVENT_BROKER; None - пересылка не нужна"""
+    if kind in ("", "none"):
+        return None
+    if kind == "unix":
+        return UnixSocketBroker()
+    if kind == "memory":
+        return MemoryBroker()
+    raise ValueError(f"Неизвестный EVENT_BROKER: {kind!r} (ожидается unix, memory или пусто)")
+
+class WorkerFanout:
+    """
+    Пересылка событий broadcaster и инвалидаций кэша этого процесса через брокер
+
+    Сообщения одного шага цикла событий (пачка webhook - сотни событий) уходят одной
+    датаграммой-списком. Пустое сообщение от брокера означает, что часть сообщений
+    потеряна: тогда локальный кэш сбрасывается целиком.
+    """
+
+    def __init__(
+        self,
+        broker: Optional[EventBroker],
+        events: NotificationBroadcaster = broadcaster,
+        cache: QueryCache = query_cache
+    ):
+        self.broker = broker
+        self.events = events
+        self.cache = cache
+        self.running = False
+        self._pending: List[bytes] = []
+        self.forwarded_events = 0
+        self.forwarded_invalidations = 0
+        self.truncated = 0
+        self.received_events = 0
+        self.received_invalidations = 0
+        self.resyncs = 0
+        self.errors = 0
+
+    async def start(self):
+        if self.broker is None or self.running:
+            return
+        await self.broker.start(self.receive)
+        self.events.forward = self.forward_event
+        self.cache.forward = self.forward_invalidation
+        self.running = True
+
+    async def stop(self):
+        if not self.running:
+            return
+        self.flush()
+        self.running = False
+        self.events.forward = None
+        self.cache.forward = None
+        await self.broker.stop()
+
+    def _enqueue(self, message: bytes):
+        if not self._pending:
+            asyncio.get_running_loop().call_soon(self.flush)
+        self._pending.append(message)
+
+    def flush(self):
+        """Отправить накопленные сообщения датаграммами-списками не больше max_message_size"""
+        pending, self._pending = self._pending, []
+        limit = self.broker.max_message_size
+        batch, size = [], 2
+        for message in pending:
+            if batch and limit is not None and size + len(message) + 1 > limit:
+                self.broker.publish(b"[" + b",".join(batch) + b"]")
+                batch, size = [], 2
+            batch.append(message)
+            size += len(message) + 1
+        if batch:
+            self.broker.publish(b"[" + b",".join(batch) + b"]")
+
+    def forward_event(self, event: dict):
+        message = dumps({"kind": "event", "event": event})
+        limit = self.broker.max_message_size
+        if limit is not None and len(message) + 2 > limit:
+            # Тело не влезает в сообщение: другие воркеры инвалидируют кэш и разбудят
+            # слушателей, но их подписчики живой ленты этого события не увидят
+            stripped = {key: value for key, value in event.items() if key not in ("notification", "changes")}
+            message = dumps({"kind": "event", "event": stripped, "listeners_only": True})
+            self.truncated += 1
+        self._enqueue(message)
+        self.forwarded_events += 1
+
+    def forward_invalidation(self, tags: List[str]):
+        self._enqueue(dumps({"kind": "invalidate", "tags": list(tags)}))
+        self.forwarded_invalidations += 1
+
+    def receive(self, data: bytes):
+        if not data:
+            # Брокер потерял сообщения для этого воркера - каких тегов, неизвестно
+            self.resyncs += 1
+            self.cache.drop_local()
+            return
+        try:
+            messages = json.loads(data)
+        except ValueError as e:
+            self.errors += 1
+            print(f"Невалидное сообщение от другого воркера: {e}")
+            return
+        for message in messages:
+            try:
+                if message["kind"] == "event":
+                    self.received_events += 1
+                    self.events.deliver(message["event"], subscribers=not message.get("listeners_only"))
+                elif message["kind"] == "invalidate":
+                    self.received_invalidations += 1
+                    self.cache.invalidate(message["tags"], forward=False)
+            except (KeyError, TypeError) as e:
+                self.errors += 1
+                print(f"Невалидное сообщение от другого воркера: {e}")
+
+    def stats(self) -> dict:
+        """Пересылка между воркерами: отправлено, получено, обрезано и потеряно"""
+        return {
+            "enabled": self.running,
+            "pid": os.getpid(),
+            "web_concurrency": WEB_CONCURRENCY,
+            "forwarded_events": self.forwarded_events,
+            "forwarded_invalidations": self.forwarded_invalidations,
+            "truncated": self.truncated,
+            "received_events": self.received_events,
+            "received_invalidations": self.received_invalidations,
+            "resyncs": self.resyncs,
+            "errors": self.errors,
+            "broker": self.broker.stats() if self.broker is not None else None
+        }
+
+worker_fanout = WorkerFanout(create_broker())
@@ -0,0 +1,256 @@
+"""
+Кэш результатов частых запросов (read-through)
+
+Два уровня: LRU с TTL в памяти процесса и необязательное общее хранилище
+(CacheBackend - например, Redis для нескольких экземпляров приложения).
+
+Инвалидация по тегам с версиями: каждая запись помнит версии своих тегов на
+момент чтения из БД, событие записи увеличивает версии затронутых тегов.
+Запись с устаревшей версией считается промахом - в том числе результат запроса,
+который начался до записи, а закончился после нее.
+
+Инвалидация локального LRU касается только своего процесса: при нескольких
+воркерах invalidate передает теги в forward (WorkerFanout из broker.py).
+
+Пока один запрос считает отсутствующий ключ, остальные ждут его результат
+(защита от лавины одинаковых запросов к БД).
+"""
+import asyncio
+import os
+import pickle
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "30"))
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "2048"))
+COUNT_CACHE_TTL = float(os.getenv("COUNT_CACHE_TTL", "5"))
+
+class CacheBackend(ABC):
+    """Общее хранилище кэша: значения - байты с TTL, версии тегов - счетчики без TTL"""
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[bytes]:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, value: bytes, ttl: float):
+        ...
+
+    @abstractmethod
+    async def get_versions(self, tags: List[str]) -> List[int]:
+        ...
+
+    @abstractmethod
+    async def bump_versions(self, tags: List[str]):
+        ...
+
+class MemoryBackend(CacheBackend):
+    """CacheBackend в памяти: для тестов и как образец реализации"""
+
+    def __init__(self):
+        self._values: Dict[str, tuple] = {}
+        self._versions: Dict[str, int] = {}
+
+    async def get(self, key: str) -> Optional[bytes]:
+        entry = self._values.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        self._values[key] = (time.monotonic() + ttl, value)
+
+    async def get_versions(self, tags: List[str]) -> List[int]:
+        return [self._versions.get(tag, 0) for tag in tags]
+
+    async def bump_versions(self, tags: List[str]):
+        for tag in tags:
+            self._versions[tag] = self._versions.get(tag, 0) + 1
+
+class LRUCache:
+    """Ограниченный по размеру словарь с TTL; вытесняет давно не читанные записи"""
+
+    def __init__(self, maxsize: int = QUERY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key: str, value, ttl: float):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+
+class QueryCache:
+    """Read-through кэш с инвалидацией по тегам и защитой от лавины запросов"""
+
+    def __init__(self, maxsize: int = QUERY_CACHE_SIZE, shared: Optional[CacheBackend] = None):
+        self.local = LRUCache(maxsize)
+        self.shared = shared
+        self._versions: Dict[str, int] = {}
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.metrics: Dict[str, Dict[str, int]] = {}
+        self.invalidations = 0
+        # Пересылка инвалидаций другим процессам (см. broker.WorkerFanout)
+        self.forward: Optional[Callable[[List[str]], None]] = None
+
+    def _count(self, namespace: str, metric: str):
+        counters = self.metrics.setdefault(
+            namespace, {"hits": 0, "shared_hits": 0, "misses": 0, "coalesced": 0}
+        )
+        counters[metric] += 1
+
+    def _local_versions(self, tags: List[str]) -> tuple:
+        return tuple(self._versions.get(tag, 0) for tag in tags)
+
+    async def get_or_load(
+        self,
+        namespace: str,
+        signature: str,
+        tags: List[str],
+        loader: Callable[[], Awaitable[Any]],
+        ttl: float = QUERY_CACHE_TTL
+    ):
+        """
+        Значение из кэша или результат loader()
+
+        None не кэшируется (например, "не найдено").
+        """
+        key = f"{namespace}:{signature}"
+        versions = self._local_versions(tags)
+        entry = self.local.get(key)
+        if entry is not None and entry[0] == versions:
+            self._count(namespace, "hits")
+            return entry[1]
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self._count(namespace, "coalesced")
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                if not inflight.cancelled():
+                    raise
+            except Exception:
+                pass
+            # Первый запрос не справился - считаем сами
+            return await loader()
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await self._load(namespace, key, tags, versions, loader, ttl)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # ожидающих может не быть - не логировать как забытую ошибку
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        future.set_result(value)
+        return value
+
+    async def _load(self, namespace, key, tags, versions, loader, ttl):
+        shared_versions = None
+        if self.shared is not None:
+            shared_versions = await self.shared.get_versions(tags)
+            raw = await self.shared.get(key)
+            if raw is not None:
+                stored_versions, value = pickle.loads(raw)
+                if stored_versions == shared_versions:
+                    self._count(namespace, "shared_hits")
+                    self._store_local(key, tags, versions, value, ttl)
+                    return value
+
+        self._count(namespace, "misses")
+        value = await loader()
+        if value is None:
+            return value
+
+        self._store_local(key, tags, versions, value, ttl)
+        if self.shared is not None:
+            await self.shared.set(key, pickle.dumps((shared_versions, value)), ttl)
+        return value
+
+    def _store_local(self, key, tags, versions, value, ttl):
+        # Пока шел запрос, теги могли инвалидироваться - такой результат не сохраняем
+        if self._local_versions(tags) == versions:
+            self.local.set(key, (versions, value), ttl)
+
+    def invalidate(self, tags: List[str], forward: bool = True):
+        """
+        Сделать устаревшими все записи с этими тегами (локально и в общем хранилище)
+
+        forward=False - не пересылать другим процессам: инвалидация пришла от них
+        или они узнают о записи из того же события broadcaster.
+        """
+        self.invalidations += 1
+        for tag in tags:
+            self._versions[tag] = self._versions.get(tag, 0) + 1
+        if self.shared is not None:
+            try:
+                asyncio.get_running_loop().create_task(self.shared.bump_versions(tags))
+            except RuntimeError:
+                pass
+        if forward and self.forward is not None:
+            try:
+                self.forward(tags)
+            except Exception as e:
+                print(f"Ошибка пересылки инвалидации другим процессам: {e}")
+
+    def drop_local(self):
+        """Забыть записи LRU этого процесса: пропущены инвалидации от других процессов"""
+        self.local.clear()
+        self.invalidations += 1
+
+    def clear(self):
+        self.local.clear()
+        self._versions.clear()
+        self.metrics.clear()
+
+    def stats(self) -> dict:
+        """Метрики: попадания, промахи, вытеснения - всего и по видам запросов"""
+        namespaces = {}
+        for namespace, counters in self.metrics.items():
+            lookups = counters["hits"] + counters["shared_hits"] + counters["misses"]
+            namespaces[namespace] = dict(
+                counters,
+                hit_rate=round((counters["hits"] + counters["shared_hits"]) / lookups, 3) if lookups else 0.0
+            )
+        hits = sum(c["hits"] + c["shared_hits"] for c in self.metrics.values())
+        lookups = hits + sum(c["misses"] for c in self.metrics.values())
+        return {
+            "size": len(self.local),
+            "capacity": self.local.maxsize,
+            "shared_backend": type(self.shared).__name__ if self.shared else None,
+            "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+            "evictions": self.local.evictions,
+            "expirations": self.local.expirations,
+            "invalidations": self.invalidations,
+            "namespaces": namespaces
+        }
+
+query_cache = QueryCache()
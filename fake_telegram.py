@@ -0,0 +1,89 @@
+"""
+Локальный фейковый Bot API для разработки и тестов доставки в Telegram
+
+Запустите:
+    uvicorn fake_telegram:app --port 8081
+    TELEGRAM_API_URL=http://localhost:8081 TELEGRAM_BOT_TOKEN=test TELEGRAM_PUSH_ENABLED=true uvicorn main:app
+
+Принимает sendMessage и запоминает сообщения (GET /messages). Ошибки Bot API
+задаются заранее: fail_next() в тестах или POST /failures при ручной проверке.
+"""
+from collections import deque
+from datetime import datetime
+from typing import Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+class FakeBotAPI:
+    """Фейковый Bot API: записывает отправленные сообщения, умеет отвечать ошибками"""
+
+    def __init__(self, token: Optional[str] = None):
+        self.token = token
+        self.messages = []
+        self.failures = deque()
+        self.app = FastAPI(title="Fake Telegram Bot API")
+        self.app.post("/bot{token}/sendMessage")(self.send_message)
+        self.app.get("/messages")(self.list_messages)
+        self.app.post("/failures")(self.add_failure)
+
+    def fail_next(
+        self,
+        status: int,
+        description: str = "",
+        retry_after: Optional[int] = None,
+        chat_id: Optional[int] = None
+    ):
+        """Следующий sendMessage (в чат chat_id, если указан) получит ошибку status"""
+        self.failures.append({
+            "status": status,
+            "description": description or f"Fake error {status}",
+            "retry_after": retry_after,
+            "chat_id": chat_id
+        })
+
+    def messages_to(self, chat_id: int) -> list:
+        return [message for message in self.messages if message["chat"]["id"] == chat_id]
+
+    def _take_failure(self, chat_id: int) -> Optional[dict]:
+        for failure in self.failures:
+            if failure["chat_id"] in (None, chat_id):
+                self.failures.remove(failure)
+                return failure
+        return None
+
+    async def send_message(self, token: str, request: Request):
+        if self.token is not None and token != self.token:
+            return JSONResponse({"ok": False, "error_code": 401, "description": "Unauthorized"}, status_code=401)
+        body = await request.json()
+        chat_id = int(body["chat_id"])
+
+        failure = self._take_failure(chat_id)
+        if failure:
+            payload = {"ok": False, "error_code": failure["status"], "description": failure["description"]}
+            if failure["retry_after"] is not None:
+                payload["parameters"] = {"retry_after": failure["retry_after"]}
+            return JSONResponse(payload, status_code=failure["status"])
+
+        message = {
+            "message_id": len(self.messages) + 1,
+            "date": int(datetime.utcnow().timestamp()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": body["text"],
+            "reply_markup": body.get("reply_markup")
+        }
+        self.messages.append(message)
+        return {"ok": True, "result": message}
+
+    async def list_messages(self):
+        return self.messages
+
+    async def add_failure(self, request: Request):
+        failure = await request.json()
+        self.fail_next(
+            failure["status"], failure.get("description", ""), failure.get("retry_after"), failure.get("chat_id")
+        )
+        return {"ok": True, "pending_failures": len(self.failures)}
+
+fake_bot = FakeBotAPI()
+app = fake_bot.app
@@ -0,0 +1,256 @@
+"""
+Очередь приема webhook-событий с отложенной пакетной записью (write-behind)
+
+Webhook только кладет событие в ограниченную очередь и сразу отвечает 202.
+Фоновая задача забирает события пачками (до WEBHOOK_BATCH_SIZE штук или
+WEBHOOK_LINGER_MS ожидания) и пишет каждую пачку одной транзакцией.
+
+Ключи событий попадают в кэш недавних ключей только после коммита. Пачка, которую
+не удалось записать за WEBHOOK_FLUSH_RETRIES попыток, дописывается в файл
+WEBHOOK_SPILL_PATH (JSON Lines) - python manage.py replay-webhooks запишет ее позже.
+"""
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+from database import AsyncSessionLocal
+from serialization import dumps
+from services import AirtableService, DuplicateNotificationError
+
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "10000"))
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", "500"))
+WEBHOOK_LINGER_MS = int(os.getenv("WEBHOOK_LINGER_MS", "50"))
+WEBHOOK_FLUSH_RETRIES = int(os.getenv("WEBHOOK_FLUSH_RETRIES", "3"))
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "100000"))
+WEBHOOK_SPILL_PATH = os.getenv("WEBHOOK_SPILL_PATH", "webhook_failed.jsonl")
+
+# Маркер остановки: все, что встало в очередь до него, будет записано
+_STOP = object()
+
+class RecentKeys:
+    """
+    Ограниченный LRU недавно принятых ключей идемпотентности
+
+    Повторная доставка webhook обычно приходит в течение минут, поэтому ключ
+    чаще всего находится здесь и дубликат отсекается без запроса к БД.
+    Все, что вытеснено из кэша, ловит уникальный индекс в БД.
+    """
+
+    def __init__(self, maxsize: int = IDEMPOTENCY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._keys = OrderedDict()
+        self.hits = 0
+
+    def __contains__(self, key: str) -> bool:
+        if key in self._keys:
+            self._keys.move_to_end(key)
+            self.hits += 1
+            return True
+        return False
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def add(self, key: str):
+        self._keys[key] = None
+        self._keys.move_to_end(key)
+        while len(self._keys) > self.maxsize:
+            self._keys.popitem(last=False)
+
+    def filter_new(self, events: List[dict]) -> List[dict]:
+        """Оставить события, ключей которых нет в кэше"""
+        return [
+            event for event in events
+            if not event.get("idempotency_key") or event["idempotency_key"] not in self
+        ]
+
+    def remember(self, events: List[dict]):
+        """Запомнить ключи событий, уже записанных в БД"""
+        for event in events:
+            if event.get("idempotency_key"):
+                self.add(event["idempotency_key"])
+
+class WebhookQueue:
+    """Ограниченная очередь событий с фоновым писателем"""
+
+    def __init__(
+        self,
+        maxsize: int = WEBHOOK_QUEUE_SIZE,
+        batch_size: int = WEBHOOK_BATCH_SIZE,
+        linger_ms: int = WEBHOOK_LINGER_MS,
+        keys: Optional[RecentKeys] = None,
+        spill_path: str = WEBHOOK_SPILL_PATH
+    ):
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.linger = linger_ms / 1000
+        self.keys = keys
+        self.spill_path = spill_path
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._reset_metrics()
+
+    def _reset_metrics(self):
+        self.accepted = 0
+        self.rejected = 0
+        self.written = 0
+        self.duplicates = 0
+        self.failed = 0
+        self.spilled = 0
+        self.batches = 0
+        self.last_batch_size = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+        self.last_latency_ms = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def enqueue(self, events: List[dict]) -> bool:
+        """
+        Поставить события в очередь целиком или не ставить вовсе
+
+        False означает, что очередь переполнена - клиенту нужно ответить 429.
+        """
+        if not self.running or self.maxsize - self._queue.qsize() < len(events):
+            self.rejected += len(events)
+            return False
+
+        enqueued_at = time.monotonic()
+        for event in events:
+            self._queue.put_nowait((enqueued_at, event))
+        self.accepted += len(events)
+        return True
+
+    async def start(self):
+        """Запустить фонового писателя (вызывается из lifespan)"""
+        if self.running:
+            return
+        self._queue = asyncio.Queue(self.maxsize)
+        self._reset_metrics()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Дописать все накопленные события и остановить писателя"""
+        if not self.running:
+            return
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+
+    async def _next_batch(self) -> tuple[list, bool]:
+        """Дождаться первого события и добрать пачку в пределах linger"""
+        loop = asyncio.get_running_loop()
+        first = await self._queue.get()
+        if first is _STOP:
+            return [], True
+
+        batch = [first]
+        deadline = loop.time() + self.linger
+        while len(batch) < self.batch_size:
+            timeout = deadline - loop.time()
+            try:
+                item = self._queue.get_nowait() if timeout <= 0 else await asyncio.wait_for(self._queue.get(), timeout)
+            except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = await self._next_batch()
+            if batch:
+                await self._flush(batch)
+
+    async def _flush(self, batch: list):
+        """Записать пачку одной транзакцией, с повторами при ошибках БД"""
+        events = [event for _, event in batch]
+        started = time.monotonic()
+        error: Optional[Exception] = None
+
+        for attempt in range(WEBHOOK_FLUSH_RETRIES):
+            try:
+                async with AsyncSessionLocal() as db:
+                    outcomes = await AirtableService.process_airtable_events(db, events)
+                break
+            except Exception as e:
+                error = e
+                print(f"Ошибка записи пачки webhook-событий (попытка {attempt + 1}): {e}")
+                await asyncio.sleep(0.1 * 2 ** attempt)
+        else:
+            outcomes = [None] * len(events)
+            self.spill(events, error)
+
+        if self.keys is not None:
+            # Повтор записанного события - дубликат; незаписанное Airtable может доставить снова
+            self.keys.remember([
+                event for event, outcome in zip(events, outcomes)
+                if isinstance(outcome, (int, DuplicateNotificationError))
+            ])
+
+        finished = time.monotonic()
+        duplicates = sum(1 for outcome in outcomes if isinstance(outcome, DuplicateNotificationError))
+        failed = sum(1 for outcome in outcomes if not isinstance(outcome, int)) - duplicates
+        self.duplicates += duplicates
+        self.failed += failed
+        self.written += len(events) - failed - duplicates
+        self.batches += 1
+        self.last_batch_size = len(events)
+        self.last_flush_ms = (finished - started) * 1000
+        self.max_flush_ms = max(self.max_flush_ms, self.last_flush_ms)
+        self.total_flush_ms += self.last_flush_ms
+        self.last_latency_ms = (finished - batch[0][0]) * 1000
+
+    def spill(self, events: List[dict], error: Optional[Exception]):
+        """Сохранить незаписанную пачку в WEBHOOK_SPILL_PATH, чтобы не потерять события"""
+        print(
+            f"ОШИБКА: пачка из {len(events)} webhook-событий не записана после "
+            f"{WEBHOOK_FLUSH_RETRIES} попыток ({error}); сохраняю в {self.spill_path}"
+        )
+        try:
+            with open(self.spill_path, "ab") as spill_file:
+                for event in events:
+                    spill_file.write(dumps(event) + b"\n")
+            self.spilled += len(events)
+        except OSError as e:
+            print(f"ОШИБКА: не удалось сохранить пачку в {self.spill_path}: {e}; события потеряны")
+
+    def stats(self) -> dict:
+        """Метрики очереди"""
+        return {
+            "running": self.running,
+            "depth": self.depth,
+            "capacity": self.maxsize,
+            "batch_size": self.batch_size,
+            "linger_ms": self.linger * 1000,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "written": self.written,
+            # Дубликаты, отсеянные уникальным индексом в БД (мимо кэша ключей)
+            "duplicates": self.duplicates,
+            "failed": self.failed,
+            # Из них сохранены в WEBHOOK_SPILL_PATH для повторной записи
+            "spilled": self.spilled,
+            "spill_path": self.spill_path,
+            "batches": self.batches,
+            "last_batch_size": self.last_batch_size,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "avg_flush_ms": round(self.total_flush_ms / self.batches, 2) if self.batches else 0.0,
+            "max_flush_ms": round(self.max_flush_ms, 2),
+            # От постановки самого старого события пачки до коммита
+            "last_latency_ms": round(self.last_latency_ms, 2)
+        }
+
+recent_keys = RecentKeys()
+webhook_queue = WebhookQueue(keys=recent_keys)
@@ -5,15 +5,48 @@ from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 import os
 
-from database import init_db
-from routers import notifications, stats, webhooks
+from database import init_db, AsyncSessionLocal, DatabaseLock, LockLeader, jobs_lock, NOTIFICATIONS_PARTITIONED
+from services import CounterService
+from ingest import webhook_queue
+from retention import retention_job, RETENTION_ENABLED
+from telegram_push import telegram_delivery, TELEGRAM_PUSH_ENABLED
+from rules import rule_engine
+from broker import worker_fanout
+from routers import notifications, stats, telegram, webhooks
+
+async def start_jobs():
+    """Фоновые задачи воркера - держателя jobs_lock"""
+    # Очистка и доставка в Telegram - в одном воркере: архив пишется один раз,
+    # а лимиты Bot API общие на бота
+    # Задача очистки заодно заранее создает секции новых месяцев
+    if RETENTION_ENABLED or NOTIFICATIONS_PARTITIONED:
+        await retention_job.start()
+    if TELEGRAM_PUSH_ENABLED:
+        await telegram_delivery.start()
+
+# Если воркер с задачами упал, их подхватывает другой (JOBS_LOCK_RETRY_SECONDS)
+jobs_leader = LockLeader(jobs_lock, start_jobs)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Инициализация при запуске
-    await init_db()
+    # Инициализация при запуске: при нескольких воркерах схему готовит один
+    # воркер за раз, остальные дожидаются и находят ее готовой
+    async with DatabaseLock("init"):
+        await init_db()
+        async with AsyncSessionLocal() as db:
+            await CounterService.rebuild_if_empty(db)
+    # Ошибка в файле правил видна в логе сразу при запуске
+    rule_engine.refresh()
+    await worker_fanout.start()
+    await webhook_queue.start()
+    await jobs_leader.start()
     yield
-    # Очистка при завершении (если нужно)
+    # Очистка при завершении: дописываем накопленные webhook-события
+    await retention_job.stop()
+    await webhook_queue.stop()
+    await telegram_delivery.stop()
+    await worker_fanout.stop()
+    await jobs_leader.stop()
 
 app = FastAPI(
     title="Telegram Mini App - Notification System",
@@ -48,6 +81,7 @@ app.add_middleware(
 app.include_router(notifications.router, prefix="/api/notifications", tags=["notifications"])
 app.include_router(stats.router, prefix="/api/stats", tags=["stats"])
 app.include_router(webhooks.router, prefix="/api/webhooks", tags=["webhooks"])
+app.include_router(telegram.router, prefix="/api/telegram", tags=["telegram"])
 
 # Статические файлы - отдаём файлы из корня и из static/
 # Сначала пробуем из корня, потом из static/
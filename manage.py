@@ -0,0 +1,144 @@
+"""
+Служебные команды для обслуживания базы данных
+Запустите: python manage.py <команда>
+
+Команды:
+  rebuild-counters  Пересчитать счетчики статистики из таблицы notifications
+  offload-payloads  Перенести metadata уведомлений в сжатую таблицу notification_payloads
+  purge             Удалить/архивировать старые уведомления по RETENTION_POLICIES (--dry-run - только подсчет)
+  partition-notifications  Перестроить notifications в секционированную по месяцам (PostgreSQL, NOTIFICATIONS_PARTITIONED=true)
+  check-rules       Проверить файл правил уведомлений (NOTIFICATION_RULES_PATH или --path)
+  rebuild-search    Перестроить полнотекстовый индекс поиска (FTS5 в SQLite, search_vector в PostgreSQL)
+  replay-webhooks   Записать webhook-события, сохраненные после неудачных попыток (WEBHOOK_SPILL_PATH или --path)
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+from database import (
+    init_db, AsyncSessionLocal, engine, NOTIFICATIONS_PARTITIONED, migrate_to_partitioned, rebuild_search_index
+)
+from payloads import PAYLOAD_STORAGE
+from retention import RetentionJob
+from rules import NOTIFICATION_RULES_PATH, load_rules
+from services import AirtableService, CounterService, PayloadService, DuplicateNotificationError, chunked
+from ingest import WEBHOOK_BATCH_SIZE, WEBHOOK_SPILL_PATH
+
+async def rebuild_counters():
+    """Пересчитать таблицу notification_counters"""
+    await init_db()
+    async with AsyncSessionLocal() as db:
+        rows = await CounterService.rebuild(db)
+    print(f"[OK] Счетчики пересчитаны: {rows} строк")
+
+async def offload_payloads():
+    """Перенести metadata из строк notifications в notification_payloads"""
+    if PAYLOAD_STORAGE != "table":
+        print("[SKIP] PAYLOAD_STORAGE=inline - metadata хранится в строках уведомлений")
+        return
+    await init_db()
+    async with AsyncSessionLocal() as db:
+        moved = await PayloadService.offload(db)
+    print(f"[OK] Перенесено metadata: {moved} уведомлений")
+
+async def purge(dry_run: bool):
+    """Применить политики хранения"""
+    await init_db()
+    job = RetentionJob()
+    for result in await job.run_once(dry_run=dry_run):
+        if dry_run:
+            print(f"[DRY RUN] {result['policy']}: подходит {result['matched']}")
+        else:
+            print(f"[OK] {result['policy']}: удалено {result['deleted']}, в архиве {result['archived']}")
+
+async def partition_notifications():
+    """Перенести notifications в секционированную таблицу"""
+    if not NOTIFICATIONS_PARTITIONED:
+        print("[SKIP] Нужны PostgreSQL и NOTIFICATIONS_PARTITIONED=true")
+        return
+    await init_db()
+    async with engine.begin() as conn:
+        moved = await conn.run_sync(migrate_to_partitioned)
+    print(f"[OK] notifications секционирована по месяцам, перенесено {moved} строк")
+
+async def rebuild_search():
+    """Перестроить индекс поиска по title и description"""
+    await init_db()
+    async with engine.begin() as conn:
+        await conn.run_sync(rebuild_search_index)
+    print(f"[OK] Индекс поиска перестроен ({engine.dialect.name})")
+
+async def replay_webhooks(path: str):
+    """Записать события из файла незаписанных пачек; повторы отсекаются ключами идемпотентности"""
+    if not os.path.exists(path):
+        print(f"[SKIP] Нет файла {path}")
+        return
+    await init_db()
+    # Пока идет запись, новые неудачные пачки приложение пишет в новый файл
+    replaying = f"{path}.replay"
+    if not os.path.exists(replaying):
+        os.replace(path, replaying)
+    with open(replaying, encoding="utf-8") as spill_file:
+        events = [json.loads(line) for line in spill_file if line.strip()]
+    written = duplicates = failed = 0
+    for batch in chunked(events, WEBHOOK_BATCH_SIZE):
+        async with AsyncSessionLocal() as db:
+            outcomes = await AirtableService.process_airtable_events(db, batch)
+        for event, outcome in zip(batch, outcomes):
+            if isinstance(outcome, int):
+                written += 1
+            elif isinstance(outcome, DuplicateNotificationError):
+                duplicates += 1
+            else:
+                failed += 1
+                print(f"[ERROR] {event.get('idempotency_key')}: {outcome}")
+    os.remove(replaying)
+    print(f"[OK] Записано {written}, дубликатов {duplicates}, невалидных {failed}")
+
+def check_rules(path: str):
+    """Загрузить и скомпилировать правила, как это сделает приложение"""
+    if not path:
+        print("[SKIP] Файл правил не задан (NOTIFICATION_RULES_PATH или --path)")
+        return
+    try:
+        rules = load_rules(path)
+    except (OSError, ValueError) as e:
+        print(f"[ERROR] {e}")
+        sys.exit(1)
+    print(f"[OK] Правил: {len(rules)}, ключей индекса (action, table_id): {len(rules.index)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Обслуживание базы уведомлений")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("rebuild-counters", help="Пересчитать счетчики статистики")
+    subparsers.add_parser("offload-payloads", help="Перенести metadata в notification_payloads")
+    purge_parser = subparsers.add_parser("purge", help="Удалить/архивировать старые уведомления")
+    purge_parser.add_argument("--dry-run", action="store_true", help="Только посчитать подходящие уведомления")
+    subparsers.add_parser("partition-notifications", help="Секционировать notifications по месяцам")
+    rules_parser = subparsers.add_parser("check-rules", help="Проверить файл правил уведомлений")
+    rules_parser.add_argument("--path", default=NOTIFICATION_RULES_PATH, help="Файл правил (JSON или YAML)")
+    subparsers.add_parser("rebuild-search", help="Перестроить полнотекстовый индекс поиска")
+    replay_parser = subparsers.add_parser("replay-webhooks", help="Записать сохраненные незаписанные webhook-события")
+    replay_parser.add_argument("--path", default=WEBHOOK_SPILL_PATH, help="Файл событий (JSON Lines)")
+    
+    args = parser.parse_args()
+    
+    if args.command == "rebuild-counters":
+        asyncio.run(rebuild_counters())
+    elif args.command == "offload-payloads":
+        asyncio.run(offload_payloads())
+    elif args.command == "purge":
+        asyncio.run(purge(args.dry_run))
+    elif args.command == "partition-notifications":
+        asyncio.run(partition_notifications())
+    elif args.command == "check-rules":
+        check_rules(args.path)
+    elif args.command == "rebuild-search":
+        asyncio.run(rebuild_search())
+    elif args.command == "replay-webhooks":
+        asyncio.run(replay_webhooks(args.path))
+
+if __name__ == "__main__":
+    main()
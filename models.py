@@ -1,6 +1,6 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator
 from typing import Optional, List
-from datetime import datetime
+from datetime import datetime, timezone
 from enum import Enum
 
 class NotificationType(str, Enum):
@@ -16,6 +16,18 @@ class NotificationStatus(str, Enum):
     UNREAD = "unread"
     READ = "read"
 
+class TotalMode(str, Enum):
+    """Как считать total в списке уведомлений"""
+    NONE = "false"  # не считать
+    EXACT = "exact"  # COUNT (кэшируется на несколько секунд)
+    ESTIMATE = "estimate"  # из предрассчитанных счетчиков, без COUNT
+
+class ListView(str, Enum):
+    """Набор полей уведомления в списке"""
+    FULL = "full"  # все поля
+    STANDARD = "standard"  # все, кроме metadata: сырое событие не читается и не распаковывается
+    COMPACT = "compact"  # без тяжелых JSON-полей details и metadata
+
 # Request models
 class NotificationCreate(BaseModel):
     """Модель для создания уведомления"""
@@ -27,6 +39,7 @@ class NotificationCreate(BaseModel):
     source: str = Field(default="airtable", description="Источник события")
     details: Optional[dict] = Field(default=None, description="Дополнительные детали")
     event_metadata: Optional[dict] = Field(default=None, alias="metadata", description="Метаданные события")
+    idempotency_key: Optional[str] = Field(default=None, max_length=64, description="Ключ идемпотентности: повтор с тем же ключом не создает дубликат")
     
     class Config:
         populate_by_name = True  # Позволяет использовать как alias, так и имя поля
@@ -36,15 +49,56 @@ class NotificationUpdate(BaseModel):
     """Модель для обновления уведомления"""
     read: Optional[bool] = None
 
+class NotificationBatchRead(BaseModel):
+    """Модель для массовой отметки по списку id"""
+    notification_ids: List[int] = Field(default_factory=list)
+
+class NotificationMarkAllRead(BaseModel):
+    """Модель для отметки всех уведомлений пользователя"""
+    user_id: str = Field(..., description="ID пользователя/менеджера")
+    before: Optional[datetime] = Field(default=None, description="Только уведомления не позже этого момента")
+
 class NotificationFilter(BaseModel):
     """Модель для фильтрации уведомлений"""
     type: Optional[NotificationType] = None
     user_id: Optional[str] = None
+    # Несколько значений сразу (IN); одно значение лучше передавать в type / user_id
+    types: Optional[List[NotificationType]] = Field(default=None, description="Любой из типов")
+    user_ids: Optional[List[str]] = Field(default=None, description="Любой из пользователей")
+    source: Optional[str] = Field(default=None, description="Фильтр по источнику события")
     status: Optional[NotificationStatus] = None
-    start_date: Optional[datetime] = None
-    end_date: Optional[datetime] = None
+    start_date: Optional[datetime] = Field(default=None, description="Не раньше (включительно)")
+    end_date: Optional[datetime] = Field(default=None, description="Не позже (включительно)")
     limit: Optional[int] = Field(default=100, ge=1, le=1000)
     offset: Optional[int] = Field(default=0, ge=0)
+    cursor: Optional[str] = Field(default=None, description="Курсор keyset-пагинации (next_cursor предыдущей страницы)")
+    since_seq: Optional[int] = Field(default=None, ge=0, description="Только изменения с номером больше указанного")
+    include_total: TotalMode = Field(default=TotalMode.EXACT, description="Как считать total")
+    view: ListView = Field(default=ListView.STANDARD, description="Набор полей: standard, full или compact")
+    fields: Optional[List[str]] = Field(default=None, description="Только эти поля (id, timestamp, change_seq - всегда)")
+    
+    @model_validator(mode="after")
+    def normalize(self):
+        """Даты - в наивный UTC (как timestamp в БД); списки без повторов, из одного значения - как type / user_id"""
+        for name in ("start_date", "end_date"):
+            value = getattr(self, name)
+            if value is not None and value.tzinfo is not None:
+                setattr(self, name, value.astimezone(timezone.utc).replace(tzinfo=None))
+        if self.start_date and self.end_date and self.start_date > self.end_date:
+            raise ValueError("start_date позже end_date")
+        # Статус - единственное изменяемое поле фильтра: прочитанное выпало бы из дельты
+        # фильтра unread, и клиент не узнал бы о прочтении. Остальные поля не меняются.
+        if self.since_seq is not None and self.status is not None:
+            raise ValueError("since_seq нельзя сочетать с status: фильтруйте статус на клиенте")
+        if self.types:
+            self.types = sorted(set(self.types), key=lambda value: value.value)
+            if len(self.types) == 1 and self.type is None:
+                self.type, self.types = self.types[0], None
+        if self.user_ids:
+            self.user_ids = sorted(set(self.user_ids))
+            if len(self.user_ids) == 1 and self.user_id is None:
+                self.user_id, self.user_ids = self.user_ids[0], None
+        return self
 
 # Response models
 class NotificationResponse(BaseModel):
@@ -60,6 +114,7 @@ class NotificationResponse(BaseModel):
     timestamp: datetime
     details: Optional[dict] = None
     metadata: Optional[dict] = Field(default=None, alias="event_metadata", serialization_alias="metadata")
+    change_seq: Optional[int] = None
     
     model_config = {"from_attributes": True, "populate_by_name": True}
 
@@ -69,6 +124,7 @@ class NotificationListResponse(BaseModel):
     total: int
     limit: int
     offset: int
+    next_cursor: Optional[str] = None
 
 class StatsResponse(BaseModel):
     """Статистика уведомлений"""
@@ -78,6 +134,41 @@ class StatsResponse(BaseModel):
     by_type: dict
     by_user: dict
 
+# Telegram push
+class TelegramRecipientUpdate(BaseModel):
+    """Привязка чата Telegram к пользователю"""
+    chat_id: int = Field(..., description="ID чата (для личного чата - ID пользователя Telegram)")
+    enabled: bool = True
+
+class TelegramRecipientResponse(BaseModel):
+    """Чат Telegram пользователя"""
+    user_id: str
+    chat_id: int
+    enabled: bool
+    created_at: Optional[datetime] = None
+    
+    model_config = {"from_attributes": True}
+
+class TelegramOutboxItem(BaseModel):
+    """Строка очереди доставки в Telegram"""
+    id: int
+    notification_id: int
+    user_id: str
+    chat_id: int
+    type: NotificationType
+    title: str
+    status: str
+    attempts: int
+    next_attempt_at: datetime
+    created_at: datetime
+    last_error: Optional[str] = None
+    
+    model_config = {"from_attributes": True}
+
+class TelegramRequeueRequest(BaseModel):
+    """Вернуть в очередь недоставленные строки (ids не указаны - все)"""
+    ids: Optional[List[int]] = None
+
 # Webhook models
 class AirtableWebhookPayload(BaseModel):
     """Payload от Airtable webhook"""
@@ -0,0 +1,114 @@
+"""
+Хранение сырых payload событий (metadata уведомлений) вне таблицы notifications
+
+В metadata уведомления из Airtable лежит все исходное событие вместе с полями
+записи. В строке notifications оно раздувает таблицу и вытесняет из кэша страниц
+индексируемые колонки. В режиме PAYLOAD_STORAGE=table payload хранится в
+notification_payloads: сжатым (zstd, если установлен zstandard, иначе zlib),
+один раз на одинаковое содержимое (ключ - sha256) и не больше PAYLOAD_MAX_BYTES
+(слишком большой обрезается с пометкой "_truncated").
+
+Здесь только упаковка и распаковка; чтение и запись в БД - PayloadService в services.py.
+"""
+import hashlib
+import json
+import os
+import zlib
+from typing import Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# inline - metadata в строке notifications (как раньше), table - в notification_payloads
+PAYLOAD_STORAGE = os.getenv("PAYLOAD_STORAGE", "table").lower()
+# zstd, zlib или none; zstd без установленного zstandard заменяется на zlib
+PAYLOAD_COMPRESSION = os.getenv("PAYLOAD_COMPRESSION", "zstd").lower()
+# Максимальный размер JSON payload до сжатия, байт
+PAYLOAD_MAX_BYTES = int(os.getenv("PAYLOAD_MAX_BYTES", str(64 * 1024)))
+# Длиннее этого строки в слишком большом payload обрезаются первыми
+PAYLOAD_MAX_STRING = int(os.getenv("PAYLOAD_MAX_STRING", "1024"))
+
+TRUNCATED_MARKER = "_truncated"
+
+def canonical_json(payload) -> bytes:
+    """JSON с сортировкой ключей: одинаковые payload дают одинаковые байты и хэш"""
+    return json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+def payload_hash(raw: bytes) -> str:
+    return hashlib.sha256(raw).hexdigest()
+
+def _shorten_strings(value, limit: int):
+    if isinstance(value, str) and len(value) > limit:
+        return f"{value[:limit]}…[+{len(value) - limit}]"
+    if isinstance(value, dict):
+        return {key: _shorten_strings(item, limit) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_shorten_strings(item, limit) for item in value]
+    return value
+
+def cap_payload(payload: dict, raw: bytes, max_bytes: int = PAYLOAD_MAX_BYTES) -> tuple[dict, bool]:
+    """
+    Уложить payload в max_bytes; возвращает (payload, обрезан ли)
+
+    Сначала обрезаются длинные строки, затем, если не хватило, остаются только
+    скалярные поля верхнего уровня (для Airtable - без полей записи). Обрезанный
+    payload получает ключ "_truncated" с исходным размером.
+    """
+    if len(raw) <= max_bytes:
+        return payload, False
+    marker = {TRUNCATED_MARKER: {"original_size": len(raw)}}
+
+    shortened = dict(_shorten_strings(payload, PAYLOAD_MAX_STRING), **marker)
+    if len(canonical_json(shortened)) <= max_bytes:
+        return shortened, True
+
+    scalars = {
+        key: value for key, value in shortened.items()
+        if not isinstance(value, (dict, list)) or key == TRUNCATED_MARKER
+    }
+    scalars[TRUNCATED_MARKER]["dropped"] = sorted(set(shortened) - set(scalars))
+    return scalars, True
+
+def compress(raw: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(raw)
+    if codec == "zlib":
+        return zlib.compress(raw, 6)
+    return raw
+
+def decompress(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == "zlib":
+        return zlib.decompress(data)
+    return data
+
+def default_codec() -> str:
+    if PAYLOAD_COMPRESSION == "zstd" and zstandard is None:
+        return "zlib"
+    return PAYLOAD_COMPRESSION if PAYLOAD_COMPRESSION in ("zstd", "zlib") else "none"
+
+def pack_payload(payload: dict, codec: Optional[str] = None) -> dict:
+    """
+    Значения строки notification_payloads для payload
+
+    Хэш считается от исходного payload: повтор того же события дедуплицируется,
+    даже если его пришлось обрезать.
+    """
+    codec = codec or default_codec()
+    raw = canonical_json(payload)
+    stored, truncated = cap_payload(payload, raw)
+    stored_raw = canonical_json(stored) if truncated else raw
+    return {
+        "hash": payload_hash(raw),
+        "codec": codec,
+        "data": compress(stored_raw, codec),
+        "size": len(stored_raw),
+        "original_size": len(raw),
+        "truncated": truncated
+    }
+
+def unpack_payload(data: bytes, codec: str) -> dict:
+    return json.loads(decompress(data, codec))
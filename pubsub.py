@@ -0,0 +1,116 @@
+"""
+Внутрипроцессная рассылка событий об уведомлениях (pub/sub)
+
+NotificationService публикует события после коммита, живая лента
+(SSE / WebSocket) раздает их подписчикам. У каждого подписчика свой
+ограниченный буфер: медленный клиент не тормозит остальных, а отключается
+и догоняет пропущенное из БД по Last-Event-ID при переподключении.
+
+При нескольких воркерах publish передает событие в forward (WorkerFanout из
+broker.py), и другие процессы раздают его своим подписчикам через deliver.
+"""
+import asyncio
+import os
+from typing import Callable, List, Optional
+
+LIVE_FEED_BUFFER_SIZE = int(os.getenv("LIVE_FEED_BUFFER_SIZE", "100"))
+
+class Subscription:
+    """Подписка одного клиента с фильтрами по пользователю и типу"""
+
+    def __init__(
+        self,
+        user_ids: Optional[List[str]] = None,
+        types: Optional[List[str]] = None,
+        maxsize: Optional[int] = None
+    ):
+        self.user_ids = set(user_ids) if user_ids else None
+        self.types = set(types) if types else None
+        self.queue: asyncio.Queue = asyncio.Queue(LIVE_FEED_BUFFER_SIZE if maxsize is None else maxsize)
+        self.dropped = False
+
+    def matches(self, event: dict) -> bool:
+        if self.user_ids is not None and event.get("user_id") not in self.user_ids:
+            return False
+        if self.types is not None and event.get("type") not in self.types:
+            return False
+        return True
+
+    def offer(self, event: dict) -> bool:
+        """Положить событие в буфер; при переполнении подписка помечается отброшенной"""
+        if self.dropped:
+            return False
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except asyncio.QueueFull:
+            self.dropped = True
+            return False
+
+class NotificationBroadcaster:
+    """Раздача событий подписчикам живой ленты и локальным слушателям"""
+
+    def __init__(self):
+        self._subscriptions: set = set()
+        self._listeners: List[Callable[[dict], None]] = []
+        # Пересылка событий другим процессам (см. broker.WorkerFanout)
+        self.forward: Optional[Callable[[dict], None]] = None
+        self.published = 0
+        self.dropped_clients = 0
+
+    def subscribe(
+        self,
+        user_ids: Optional[List[str]] = None,
+        types: Optional[List[str]] = None
+    ) -> Subscription:
+        subscription = Subscription(user_ids, types)
+        self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self._subscriptions.discard(subscription)
+
+    def add_listener(self, listener: Callable[[dict], None]):
+        """Синхронный слушатель всех событий (например, инвалидация кэша)"""
+        self._listeners.append(listener)
+
+    def publish(self, event: dict):
+        """Разослать событие здесь и в других процессах; никогда не блокирует публикующего"""
+        self.published += 1
+        self.deliver(event)
+        if self.forward is not None:
+            try:
+                self.forward(event)
+            except Exception as e:
+                print(f"Ошибка пересылки события другим процессам: {e}")
+
+    def deliver(self, event: dict, subscribers: bool = True):
+        """
+        Раздать событие слушателям и подписчикам этого процесса
+
+        subscribers=False - только слушателям: событие пришло из другого процесса
+        без тела уведомления, живой ленте его не показать.
+        """
+        for listener in self._listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                print(f"Ошибка слушателя событий: {e}")
+
+        if not subscribers:
+            return
+        for subscription in list(self._subscriptions):
+            if subscription.matches(event) and not subscription.offer(event):
+                # Медленный клиент: отключаем, он догонит по Last-Event-ID
+                self._subscriptions.discard(subscription)
+                self.dropped_clients += 1
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": len(self._subscriptions),
+            "published": self.published,
+            "dropped_clients": self.dropped_clients,
+            "buffer_size": LIVE_FEED_BUFFER_SIZE
+        }
+
+broadcaster = NotificationBroadcaster()
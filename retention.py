@@ -0,0 +1,285 @@
+"""
+Срок хранения уведомлений: удаление и архивирование старых строк
+
+Политики задаются в RETENTION_POLICIES (JSON-список). Политика выбирает уведомления
+по типу и/или статусу старше days дней и удаляет их (delete) или сначала выгружает
+в архив NDJSON.gz, а затем удаляет (archive).
+
+Удаление идет небольшими пачками, каждая - отдельной транзакцией с паузой между
+ними: писатели (в SQLite - единственное соединение записи) ждут не дольше одной
+пачки. Если notifications секционирована по месяцам (NOTIFICATIONS_PARTITIONED),
+месяцы, целиком попавшие под политику без фильтров по типу и статусу, удаляются
+через DROP секции. Запускается фоновой задачей из lifespan (RETENTION_ENABLED=true)
+или командой python manage.py purge; та же задача заранее создает секции новых месяцев.
+"""
+import asyncio
+import gzip
+import json
+import os
+import time
+from datetime import datetime, timedelta
+from typing import List, Literal, Optional
+
+from pydantic import BaseModel, Field
+from sqlalchemy import select, func, and_, or_
+
+import serialization
+from database import (
+    AsyncSessionLocal, Notification, engine, NOTIFICATIONS_PARTITIONED,
+    list_partitions, add_months, _ensure_current_partitions
+)
+from models import NotificationResponse, NotificationStatus, NotificationType
+from services import NotificationService, PayloadService
+
+RETENTION_ENABLED = os.getenv("RETENTION_ENABLED", "false").lower() in ("1", "true", "yes")
+RETENTION_INTERVAL_SECONDS = float(os.getenv("RETENTION_INTERVAL_SECONDS", "3600"))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "500"))
+# Пауза между пачками, чтобы между ними успевали проходить обычные записи
+RETENTION_PAUSE_MS = int(os.getenv("RETENTION_PAUSE_MS", "50"))
+RETENTION_ARCHIVE_DIR = os.getenv("RETENTION_ARCHIVE_DIR", "./archive")
+# По умолчанию: прочитанные - 30 дней, все остальные - 180 дней с архивом
+RETENTION_POLICIES = os.getenv(
+    "RETENTION_POLICIES",
+    '[{"status": "read", "days": 30, "action": "delete"}, {"days": 180, "action": "archive"}]'
+)
+
+class RetentionPolicy(BaseModel):
+    """Правило хранения: уведомления типа type и статуса status старше days дней"""
+    type: Optional[NotificationType] = None
+    status: Optional[NotificationStatus] = None
+    days: int = Field(..., ge=1)
+    action: Literal["delete", "archive"] = "delete"
+
+    def describe(self) -> str:
+        type_value = self.type.value if self.type else "*"
+        status_value = self.status.value if self.status else "*"
+        return f"{self.action} type={type_value} status={status_value} старше {self.days} дн."
+
+    def conditions(self, now: datetime) -> list:
+        conditions = [Notification.timestamp < now - timedelta(days=self.days)]
+        if self.type:
+            conditions.append(Notification.type == self.type)
+        if self.status:
+            conditions.append(Notification.status == self.status)
+        return conditions
+
+def load_policies(raw: str = RETENTION_POLICIES) -> List[RetentionPolicy]:
+    """Разобрать RETENTION_POLICIES; ValueError при ошибке"""
+    try:
+        return [RetentionPolicy(**item) for item in json.loads(raw)]
+    except Exception as e:
+        raise ValueError(f"Невалидный RETENTION_POLICIES: {e}")
+
+def write_archive(path: str, lines: List[bytes]):
+    """Дописать строки в gzip-архив (каждый вызов - отдельный gzip-member, файл читается целиком)"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with gzip.open(path, "ab") as archive:
+        archive.writelines(lines)
+
+class RetentionJob:
+    """Периодическое применение политик хранения"""
+
+    def __init__(
+        self,
+        policies: Optional[List[RetentionPolicy]] = None,
+        batch_size: int = RETENTION_BATCH_SIZE,
+        pause_ms: int = RETENTION_PAUSE_MS,
+        archive_dir: str = RETENTION_ARCHIVE_DIR,
+        interval: float = RETENTION_INTERVAL_SECONDS
+    ):
+        self.policies = policies if policies is not None else load_policies()
+        self.batch_size = batch_size
+        self.pause = pause_ms / 1000
+        self.archive_dir = archive_dir
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+        self._stopping: Optional[asyncio.Event] = None
+        self.runs = 0
+        self.deleted = 0
+        self.dropped_partitions = 0
+        self.archived = 0
+        self.errors = 0
+        self.last_run_at: Optional[datetime] = None
+        self.last_duration_ms = 0.0
+        self.last_result: List[dict] = []
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        """Запустить периодический прогон (вызывается из lifespan)"""
+        if self.running:
+            return
+        self._stopping = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановить после текущей пачки"""
+        if not self.running:
+            return
+        self._stopping.set()
+        await self._task
+        self._task = None
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                await self.maintain_partitions()
+                if RETENTION_ENABLED:
+                    await self.run_once()
+            except Exception as e:
+                self.errors += 1
+                print(f"Ошибка очистки старых уведомлений: {e}")
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def archive_path(self, now: datetime) -> str:
+        return os.path.join(self.archive_dir, f"notifications-{now:%Y%m%d}.ndjson.gz")
+
+    async def maintain_partitions(self):
+        """Создать секции текущего и следующих месяцев (если notifications секционирована)"""
+        if NOTIFICATIONS_PARTITIONED:
+            async with engine.begin() as conn:
+                await conn.run_sync(_ensure_current_partitions)
+
+    async def _archive(self, db, notifications: list, now: datetime):
+        """Дописать уведомления в архив (в формате API, с metadata)"""
+        await PayloadService.hydrate(db, notifications)
+        lines = [
+            serialization.dumps(NotificationResponse.model_validate(n).model_dump(mode="json", by_alias=True)) + b"\n"
+            for n in notifications
+        ]
+        await asyncio.to_thread(write_archive, self.archive_path(now), lines)
+
+    async def _drop_partitions(self, policy: RetentionPolicy, now: datetime) -> tuple[int, int]:
+        """Удалить месячные секции, целиком старше срока политики (сначала - в архив)"""
+        cutoff = now - timedelta(days=policy.days)
+        async with engine.connect() as conn:
+            months = await conn.run_sync(list_partitions)
+
+        deleted = archived = 0
+        for month in months:
+            month_start = datetime(month.year, month.month, 1)
+            month_end = datetime.combine(add_months(month, 1), datetime.min.time())
+            if month_end > cutoff:
+                break
+            if policy.action == "archive":
+                # Архив пачками по (timestamp, id) внутри месяца
+                position = None
+                while True:
+                    async with AsyncSessionLocal() as db:
+                        query = select(Notification).where(
+                            Notification.timestamp >= month_start, Notification.timestamp < month_end
+                        )
+                        if position:
+                            query = query.where(or_(
+                                Notification.timestamp > position[0],
+                                and_(Notification.timestamp == position[0], Notification.id > position[1])
+                            ))
+                        found = list((await db.execute(
+                            query.order_by(Notification.timestamp, Notification.id).limit(self.batch_size)
+                        )).scalars().all())
+                        if found:
+                            await self._archive(db, found, now)
+                    archived += len(found)
+                    if len(found) < self.batch_size:
+                        break
+                    position = (found[-1].timestamp, found[-1].id)
+
+            async with AsyncSessionLocal() as db:
+                deleted += await NotificationService.drop_partition(db, month)
+            self.dropped_partitions += 1
+        return deleted, archived
+
+    async def run_once(self, dry_run: bool = False) -> List[dict]:
+        """
+        Применить все политики по порядку; результат - по каждой политике
+
+        dry_run только считает подходящие уведомления.
+        """
+        started = time.monotonic()
+        now = datetime.utcnow()
+        results = []
+        for policy in self.policies:
+            if dry_run:
+                async with AsyncSessionLocal() as db:
+                    matched = (await db.execute(
+                        select(func.count(Notification.id)).where(and_(*policy.conditions(now)))
+                    )).scalar() or 0
+                results.append({"policy": policy.describe(), "matched": matched})
+            else:
+                deleted, archived = await self._apply(policy, now)
+                results.append({"policy": policy.describe(), "deleted": deleted, "archived": archived})
+            if self._stopping is not None and self._stopping.is_set():
+                break
+
+        if not dry_run:
+            self.runs += 1
+            self.last_run_at = now
+            self.last_duration_ms = (time.monotonic() - started) * 1000
+            self.last_result = results
+        return results
+
+    async def _apply(self, policy: RetentionPolicy, now: datetime) -> tuple[int, int]:
+        """Удалять (и архивировать) пачками, пока подходящие уведомления не кончатся"""
+        deleted = archived = 0
+        if NOTIFICATIONS_PARTITIONED and policy.type is None and policy.status is None:
+            deleted, archived = await self._drop_partitions(policy, now)
+            self.deleted += deleted
+            self.archived += archived
+
+        while True:
+            async with AsyncSessionLocal() as db:
+                # Старые сначала: WHERE timestamp < ? ORDER BY timestamp, id идет по индексу
+                query = (
+                    select(Notification if policy.action == "archive" else Notification.id)
+                    .where(and_(*policy.conditions(now)))
+                    .order_by(Notification.timestamp, Notification.id)
+                    .limit(self.batch_size)
+                )
+                found = list((await db.execute(query)).scalars().all())
+                if not found:
+                    break
+
+                if policy.action == "archive":
+                    # Архив пишется до удаления: при сбое строки останутся в БД и попадут в архив повторно
+                    await self._archive(db, found, now)
+                    ids = [n.id for n in found]
+                else:
+                    ids = found
+
+                batch_deleted = await NotificationService.delete_notifications(db, ids)
+            deleted += batch_deleted
+            self.deleted += batch_deleted
+            if policy.action == "archive":
+                archived += len(ids)
+                self.archived += len(ids)
+
+            if len(found) < self.batch_size or (self._stopping is not None and self._stopping.is_set()):
+                break
+            await asyncio.sleep(self.pause)
+        return deleted, archived
+
+    def stats(self) -> dict:
+        """Метрики очистки"""
+        return {
+            "enabled": RETENTION_ENABLED,
+            "partitioned": NOTIFICATIONS_PARTITIONED,
+            "running": self.running,
+            "interval_seconds": self.interval,
+            "batch_size": self.batch_size,
+            "policies": [policy.describe() for policy in self.policies],
+            "runs": self.runs,
+            "deleted": self.deleted,
+            "archived": self.archived,
+            "dropped_partitions": self.dropped_partitions,
+            "errors": self.errors,
+            "last_run_at": self.last_run_at.isoformat() if self.last_run_at else None,
+            "last_duration_ms": round(self.last_duration_ms, 1),
+            "last_result": self.last_result
+        }
+
+retention_job = RetentionJob()
@@ -1,85 +1,503 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, Header, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
 from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Optional, List
 from datetime import datetime
+import asyncio
+import json
+import os
 
-from database import get_db
+from database import get_db, get_read_db, ReadSessionLocal
 from models import (
     NotificationCreate,
     NotificationUpdate,
     NotificationResponse,
     NotificationFilter,
+    NotificationBatchRead,
+    NotificationMarkAllRead,
     NotificationType,
-    NotificationStatus
+    NotificationStatus,
+    TotalMode,
+    ListView
 )
-from services import NotificationService
+from serialization import json_response
+from services import (
+    NotificationService,
+    CachedNotificationService,
+    CounterService,
+    SearchService,
+    DuplicateNotificationError,
+    encode_cursor,
+    replayed_event,
+    make_etag,
+    etag_matches
+)
+from pubsub import broadcaster
 
 router = APIRouter()
 
+# Максимум элементов в одном запросе массового создания
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "10000"))
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+# Интервал heartbeat живой ленты, чтобы прокси не закрывали простаивающее соединение
+LIVE_FEED_HEARTBEAT_SECONDS = float(os.getenv("LIVE_FEED_HEARTBEAT_SECONDS", "15"))
+
+async def iter_ndjson(request: Request):
+    """Построчно разбирать NDJSON-тело по мере чтения; отдает объект или ошибку разбора"""
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield parse_json_line(line)
+    if buffer.strip():
+        yield parse_json_line(buffer)
+
+def parse_json_line(line: bytes):
+    try:
+        return json.loads(line)
+    except json.JSONDecodeError as e:
+        return e
+
+def format_item_error(error: Exception) -> str:
+    """Короткое описание ошибки элемента пачки"""
+    if isinstance(error, ValidationError):
+        return "; ".join(
+            f"{'.'.join(str(part) for part in err['loc'])}: {err['msg']}" if err["loc"] else err["msg"]
+            for err in error.errors()
+        )
+    if isinstance(error, json.JSONDecodeError):
+        return f"Невалидный JSON: {error.msg}"
+    return str(getattr(error, "orig", error))
+
 @router.get("", response_model=dict)
 async def get_notifications(
-    type: Optional[NotificationType] = Query(None, description="Фильтр по типу"),
-    user_id: Optional[str] = Query(None, description="Фильтр по пользователю"),
+    request: Request,
+    type: Optional[List[NotificationType]] = Query(None, description="Фильтр по типу (можно несколько)"),
+    user_id: Optional[List[str]] = Query(None, description="Фильтр по пользователю (можно несколько)"),
+    source: Optional[str] = Query(None, description="Фильтр по источнику события"),
     status: Optional[NotificationStatus] = Query(None, description="Фильтр по статусу"),
+    start_date: Optional[datetime] = Query(None, description="Не раньше (ISO 8601, UTC)"),
+    end_date: Optional[datetime] = Query(None, description="Не позже (ISO 8601, UTC)"),
     limit: int = Query(100, ge=1, le=1000, description="Количество записей"),
     offset: int = Query(0, ge=0, description="Смещение"),
-    db: AsyncSession = Depends(get_db)
+    cursor: Optional[str] = Query(None, description="Курсор следующей страницы (next_cursor)"),
+    since_seq: Optional[int] = Query(None, ge=0, description="Только изменения после этого номера (last_seq); без status"),
+    include_total: TotalMode = Query(TotalMode.EXACT, description="total: exact, estimate или false"),
+    view: ListView = Query(ListView.STANDARD, description="Набор полей: standard (без metadata), full или compact (без details и metadata)"),
+    fields: Optional[str] = Query(None, description="Поля через запятую, например title,status"),
+    db: AsyncSession = Depends(get_read_db)
 ):
     """
     Получить список уведомлений с фильтрацией и пагинацией
     
     **Параметры:**
-    - `type`: Тип уведомления (file_upload, record_create, record_update, record_delete, user_action)
-    - `user_id`: ID пользователя
+    - `type`: Тип уведомления (file_upload, record_create, record_update, record_delete, user_action);
+      повтор параметра - любой из типов: `?type=file_upload&type=record_create`
+    - `user_id`: ID пользователя; повтор параметра - любой из пользователей
+    - `source`: Источник события (airtable, ...)
     - `status`: Статус (read, unread)
+    - `start_date`, `end_date`: период по времени уведомления, границы включительно
+      (ISO 8601 в UTC, как `timestamp` в ответе)
     - `limit`: Количество записей (1-1000)
     - `offset`: Смещение для пагинации
+    - `cursor`: Курсор keyset-пагинации; если передан, `offset` игнорируется
+    
+    - `since_seq`: дельта-синхронизация - только созданные/измененные после этого номера,
+      в порядке изменений; следующий запрос - с `last_seq` из ответа. Со `status` - `400`:
+      статус меняется, и прочитанное выпало бы из дельты. Удаления (очистка по политикам
+      хранения) в дельту не попадают
+    - `include_total`: `exact` (по умолчанию) - точный COUNT, `estimate` - из счетчиков
+      статистики без COUNT, `false` - не считать (`total: null`)
+    - `view`: `standard` (по умолчанию) - все поля, кроме `metadata` (сырое событие не
+      распаковывается на каждой странице), `full` - все поля, `compact` - без тяжелых
+      JSON-полей `details` и `metadata` (они не читаются из БД; полностью - в `GET /{id}`)
+    - `fields`: только перечисленные поля через запятую (важнее `view`);
+      `id`, `timestamp` и `change_seq` возвращаются всегда - они нужны для пагинации
+    
+    В ответе `next_cursor` указывает на следующую страницу (`null` - страниц больше нет).
+    Курсорная пагинация стоит одинаково на любой глубине, в отличие от `offset`.
+    
+    Ответ содержит `ETag`; с `If-None-Match` при отсутствии изменений вернется `304`
+    без чтения уведомлений.
     """
+    # ETag зависит только от номера последнего изменения и параметров запроса
+    seq = await CounterService.current_seq(db)
+    etag = make_etag(seq, sorted(request.query_params.multi_items()))
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    
     try:
+        # Одно значение type / user_id модель сводит к обычному фильтру (счетчики, кэш)
         filters = NotificationFilter(
-            type=type,
-            user_id=user_id,
+            types=type,
+            user_ids=user_id,
+            source=source,
             status=status,
+            start_date=start_date,
+            end_date=end_date,
             limit=limit,
-            offset=offset
+            offset=offset,
+            cursor=cursor,
+            since_seq=since_seq,
+            include_total=include_total,
+            view=view,
+            fields=sorted({name.strip() for name in fields.split(",") if name.strip()}) if fields else None
         )
         
-        notifications, total = await NotificationService.get_notifications(db, filters)
+        notifications, total = await CachedNotificationService.get_notifications(db, filters, seq)
+        
+        # Строки уже в формате NotificationResponse - кодируем сразу в JSON
+        if since_seq is not None:
+            return json_response({
+                "notifications": notifications,
+                "total": total,
+                "limit": limit,
+                "last_seq": notifications[-1]["change_seq"] if notifications else max(since_seq, seq),
+                "has_more": len(notifications) == limit
+            }, headers=headers)
         
-        # Преобразуем уведомления в ответ, обрабатывая возможные ошибки
-        notifications_list = []
-        for n in notifications:
-            try:
-                notifications_list.append(NotificationResponse.model_validate(n))
-            except Exception as e:
-                # Логируем ошибку преобразования отдельного уведомления
-                print(f"Ошибка преобразования уведомления {n.id}: {e}")
-                continue
+        # Полная страница - возможно, есть следующая
+        next_cursor = None
+        if len(notifications) == limit:
+            next_cursor = encode_cursor(notifications[-1]["timestamp"], notifications[-1]["id"])
         
-        return {
-            "notifications": notifications_list,
-            "total": total or 0,
+        return json_response({
+            "notifications": notifications,
+            "total": total,
             "limit": limit,
-            "offset": offset
-        }
+            "offset": offset,
+            "next_cursor": next_cursor,
+            "last_seq": seq
+        }, headers=headers)
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=format_item_error(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail=f"Ошибка при получении уведомлений: {str(e)}"
         )
 
+async def live_events(
+    subscription,
+    last_event_id: Optional[int],
+    user_ids: Optional[List[str]],
+    types: Optional[List[NotificationType]]
+):
+    """
+    События живой ленты: сначала изменившееся после last_event_id (номер изменения seq)
+    из БД, затем живые события
+    
+    None - пора отправить heartbeat. Заканчивается событием dropped, если клиент
+    не успевал читать и был отключен от рассылки.
+    """
+    replayed_up_to = 0
+    if last_event_id is not None:
+        replayed_up_to = last_event_id
+        async with ReadSessionLocal() as db:
+            while True:
+                missed = await NotificationService.get_changes_after(
+                    db, replayed_up_to, user_ids, types
+                )
+                for notification in missed:
+                    yield replayed_event(NotificationResponse.model_validate(notification))
+                if not missed:
+                    break
+                replayed_up_to = missed[-1].change_seq
+    
+    while not subscription.dropped:
+        try:
+            event = await asyncio.wait_for(subscription.queue.get(), LIVE_FEED_HEARTBEAT_SECONDS)
+        except asyncio.TimeoutError:
+            yield None
+            continue
+        # Подписка оформлена до догона - уже отданное из БД пропускаем
+        if event.get("seq") is not None and event["seq"] <= replayed_up_to:
+            continue
+        yield event
+    
+    yield {"event": "dropped"}
+
+def format_sse(event: Optional[dict]) -> str:
+    """Сериализовать событие в формат text/event-stream"""
+    if event is None:
+        return ": ping\n\n"
+    lines = []
+    # id события - номер изменения: по нему Last-Event-ID догоняет и создания, и смены статуса
+    if event.get("seq") is not None:
+        lines.append(f"id: {event['seq']}")
+    lines.append(f"event: {event['event']}")
+    lines.append(f"data: {json.dumps(event, ensure_ascii=False)}")
+    return "\n".join(lines) + "\n\n"
+
+# Маршруты с фиксированным путем объявляются до /{notification_id}, иначе он их перехватывает
+@router.get("/search", response_model=dict)
+async def search_notifications(
+    request: Request,
+    q: str = Query(..., min_length=1, max_length=200, description="Слова для поиска в заголовке и описании"),
+    type: Optional[List[NotificationType]] = Query(None, description="Фильтр по типу (можно несколько)"),
+    user_id: Optional[List[str]] = Query(None, description="Фильтр по пользователю (можно несколько)"),
+    source: Optional[str] = Query(None, description="Фильтр по источнику события"),
+    status: Optional[NotificationStatus] = Query(None, description="Фильтр по статусу"),
+    start_date: Optional[datetime] = Query(None, description="Не раньше (ISO 8601, UTC)"),
+    end_date: Optional[datetime] = Query(None, description="Не позже (ISO 8601, UTC)"),
+    limit: int = Query(20, ge=1, le=100, description="Количество записей"),
+    offset: int = Query(0, ge=0, description="Смещение"),
+    include_total: bool = Query(False, description="Посчитать все найденные (total)"),
+    view: ListView = Query(ListView.STANDARD, description="Набор полей: standard (без metadata), full или compact (без details и metadata)"),
+    fields: Optional[str] = Query(None, description="Поля через запятую, например title,status"),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """
+    Полнотекстовый поиск по заголовку и описанию уведомлений
+    
+    **Параметры:**
+    - `q`: слова запроса; каждое ищется как начало слова ("сдел" найдет "сделка"),
+      найдены должны быть все. Учитываются русские словоформы: "сделки" найдет "сделка"
+    - `type`, `user_id`, `source`, `status`, `start_date`, `end_date`, `view`, `fields` - как у списка
+    - `limit` (1-100), `offset`: пагинация
+    - `include_total`: посчитать общее число найденных
+    
+    Сначала самые релевантные (совпадение в заголовке весит больше), при равной
+    релевантности - новые. Запрос без слов - `400`. Ответ содержит `ETag`, как список.
+    """
+    seq = await CounterService.current_seq(db)
+    etag = make_etag(seq, "search", sorted(request.query_params.multi_items()))
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    
+    try:
+        filters = NotificationFilter(
+            types=type,
+            user_ids=user_id,
+            source=source,
+            status=status,
+            start_date=start_date,
+            end_date=end_date,
+            limit=limit,
+            offset=offset,
+            include_total=TotalMode.EXACT if include_total else TotalMode.NONE,
+            view=view,
+            fields=sorted({name.strip() for name in fields.split(",") if name.strip()}) if fields else None
+        )
+        notifications, total = await SearchService.search(db, q, filters)
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=format_item_error(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    return json_response({
+        "notifications": notifications,
+        "total": total,
+        "limit": limit,
+        "offset": offset,
+        "last_seq": seq
+    }, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+@router.get("/stream")
+async def stream_notifications(
+    user_id: Optional[List[str]] = Query(None, description="Только события этих пользователей"),
+    type: Optional[List[NotificationType]] = Query(None, description="Только события этих типов"),
+    last_event_id: Optional[int] = Query(None, description="Догнать изменения после этого номера (id события, last_seq списка)"),
+    last_event_id_header: Optional[str] = Header(None, alias="Last-Event-ID")
+):
+    """
+    Живая лента уведомлений (Server-Sent Events) вместо периодического опроса
+    
+    События (`id` события - номер изменения `seq`):
+    - `created` - новое уведомление (поле `notification`)
+    - `updated` - смена статуса (`id`, `status`) или новые события в сводке (`changes`: title, description, details)
+    - `dropped` - клиент не успевал читать и отключен; переподключитесь
+    
+    При переподключении браузер сам передает `Last-Event-ID`, и все изменившиеся
+    за это время уведомления догружаются из БД событиями `updated` с полным
+    `notification` (неизвестное клиенту уведомление - новое). Первое подключение -
+    с `last_event_id` = `last_seq` из ответа списка.
+    """
+    if last_event_id_header and last_event_id_header.isdigit():
+        last_event_id = int(last_event_id_header)
+    
+    subscription = broadcaster.subscribe(user_id, [t.value for t in type] if type else None)
+    
+    async def event_stream():
+        try:
+            async for event in live_events(subscription, last_event_id, user_id, type):
+                yield format_sse(event)
+        finally:
+            broadcaster.unsubscribe(subscription)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.websocket("/ws")
+async def notifications_websocket(
+    websocket: WebSocket,
+    user_id: Optional[List[str]] = Query(None),
+    type: Optional[List[NotificationType]] = Query(None),
+    last_event_id: Optional[int] = Query(None, description="Догнать изменения после этого номера")
+):
+    """Живая лента уведомлений через WebSocket (те же события, что и /stream)"""
+    await websocket.accept()
+    subscription = broadcaster.subscribe(user_id, [t.value for t in type] if type else None)
+    try:
+        async for event in live_events(subscription, last_event_id, user_id, type):
+            await websocket.send_json(event or {"event": "ping"})
+        # Медленный клиент: 1013 - "попробуйте позже"
+        await websocket.close(code=1013)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        broadcaster.unsubscribe(subscription)
+
+@router.post("/batch", response_model=dict, status_code=201)
+async def create_notifications_batch(
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Массово создать уведомления
+    
+    Тело - JSON-массив объектов `NotificationCreate` или NDJSON
+    (`Content-Type: application/x-ndjson`, один объект на строку).
+    Все строки вставляются в одной транзакции; ошибки отдельных элементов
+    не отменяют остальные и возвращаются в `results`.
+    
+    **Ответ:** `201`, если созданы все элементы, иначе `207`:
+    ```json
+    {
+        "created": 2,
+        "failed": 1,
+        "results": [
+            {"index": 0, "status": "created", "id": 101},
+            {"index": 1, "status": "error", "error": "title: Field required"},
+            {"index": 2, "status": "created", "id": 102}
+        ]
+    }
+    ```
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if content_type in NDJSON_CONTENT_TYPES:
+        # Строки считаются по мере чтения: слишком большое тело не дочитывается
+        raw_items = []
+        async for item in iter_ndjson(request):
+            raw_items.append(item)
+            if len(raw_items) > BATCH_MAX_ITEMS:
+                raise HTTPException(status_code=413, detail=f"Максимум {BATCH_MAX_ITEMS} элементов в пачке")
+    else:
+        try:
+            raw_items = await request.json()
+        except json.JSONDecodeError:
+            raise HTTPException(status_code=400, detail="Невалидный JSON")
+        if not isinstance(raw_items, list):
+            raise HTTPException(status_code=400, detail="Ожидается JSON-массив уведомлений")
+    
+    if not raw_items:
+        raise HTTPException(status_code=400, detail="Пустая пачка")
+    if len(raw_items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Максимум {BATCH_MAX_ITEMS} элементов в пачке")
+    
+    # Валидация по элементам: невалидные не попадают в БД, но остаются в отчете
+    outcomes: List = [None] * len(raw_items)
+    valid_indexes = []
+    valid_items = []
+    for index, raw in enumerate(raw_items):
+        if isinstance(raw, Exception):
+            outcomes[index] = raw
+            continue
+        try:
+            valid_items.append(NotificationCreate.model_validate(raw))
+            valid_indexes.append(index)
+        except ValidationError as e:
+            outcomes[index] = e
+    
+    if valid_items:
+        try:
+            created = await NotificationService.create_notifications(db, valid_items)
+        except Exception as e:
+            raise HTTPException(
+                status_code=500,
+                detail=f"Ошибка при создании уведомлений: {str(e)}"
+            )
+        for index, outcome in zip(valid_indexes, created):
+            outcomes[index] = outcome
+    
+    results = []
+    for index, outcome in enumerate(outcomes):
+        if isinstance(outcome, Exception):
+            results.append({"index": index, "status": "error", "error": format_item_error(outcome)})
+        else:
+            results.append({"index": index, "status": "created", "id": outcome})
+    
+    failed = sum(1 for r in results if r["status"] == "error")
+    if failed:
+        response.status_code = 207
+    
+    return {
+        "created": len(results) - failed,
+        "failed": failed,
+        "results": results
+    }
+
+@router.post("/batch/read", response_model=dict)
+async def mark_notifications_read(
+    request: NotificationBatchRead,
+    db: AsyncSession = Depends(get_db)
+):
+    """Отметить несколько уведомлений как прочитанные (одним UPDATE в одной транзакции)"""
+    updated, not_found = await NotificationService.mark_many_as_read(db, request.notification_ids)
+    
+    return {
+        "updated": updated,
+        "not_found": not_found,
+        "total_updated": len(updated)
+    }
+
+@router.post("/batch/read-all", response_model=dict)
+async def mark_all_notifications_read(
+    request: NotificationMarkAllRead,
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Отметить прочитанными все уведомления пользователя
+    
+    **Пример запроса:**
+    ```json
+    {
+        "user_id": "manager_a",
+        "before": "2024-01-01T12:00:00"
+    }
+    ```
+    `before` необязателен - без него отмечаются все непрочитанные уведомления пользователя.
+    """
+    total_updated = await NotificationService.mark_all_as_read(db, request.user_id, request.before)
+    
+    return {
+        "user_id": request.user_id,
+        "before": request.before,
+        "total_updated": total_updated
+    }
+
 @router.get("/{notification_id}", response_model=NotificationResponse)
 async def get_notification(
     notification_id: int,
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     """Получить уведомление по ID"""
-    notification = await NotificationService.get_notification(db, notification_id)
+    notification = await CachedNotificationService.get_notification(db, notification_id)
     
     if not notification:
         raise HTTPException(status_code=404, detail="Уведомление не найдено")
     
-    return NotificationResponse.model_validate(notification)
+    return notification
 
 @router.post("", response_model=NotificationResponse, status_code=201)
 async def create_notification(
@@ -108,6 +526,8 @@ async def create_notification(
     try:
         notification = await NotificationService.create_notification(db, notification_data)
         return NotificationResponse.model_validate(notification)
+    except DuplicateNotificationError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -142,27 +562,3 @@ async def mark_notification_read(
         raise HTTPException(status_code=404, detail="Уведомление не найдено")
     
     return NotificationResponse.model_validate(notification)
-
-@router.post("/batch/read", response_model=dict)
-async def mark_notifications_read(
-    request: dict,
-    db: AsyncSession = Depends(get_db)
-):
-    """Отметить несколько уведомлений как прочитанные"""
-    notification_ids = request.get("notification_ids", [])
-    updated = []
-    not_found = []
-    
-    for notification_id in notification_ids:
-        notification = await NotificationService.mark_as_read(db, notification_id)
-        if notification:
-            updated.append(notification_id)
-        else:
-            not_found.append(notification_id)
-    
-    return {
-        "updated": updated,
-        "not_found": not_found,
-        "total_updated": len(updated)
-    }
-
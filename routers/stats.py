@@ -1,17 +1,25 @@
-from fastapi import APIRouter, Depends, Query
+from fastapi import APIRouter, Depends, Query, Request, Response
 from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Optional
+from datetime import datetime
 
-from database import get_db
+from database import get_read_db, jobs_lock
 from models import StatsResponse
-from services import NotificationService
+from services import CachedNotificationService, CounterService, TelegramOutboxService, make_etag, etag_matches
+from cache import query_cache
+from retention import retention_job
+from telegram_push import telegram_delivery
+from rules import rule_engine
+from broker import worker_fanout
 
 router = APIRouter()
 
 @router.get("", response_model=StatsResponse)
 async def get_stats(
+    request: Request,
+    response: Response,
     user_id: Optional[str] = Query(None, description="Фильтр по пользователю"),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
     """
     Получить статистику уведомлений
@@ -22,7 +30,46 @@ async def get_stats(
     - `today`: Количество за сегодня
     - `by_type`: Распределение по типам
     - `by_user`: Топ 10 пользователей по активности
+    
+    Ответ содержит `ETag`; с `If-None-Match` при отсутствии изменений вернется `304`.
     """
-    stats = await NotificationService.get_stats(db, user_id)
+    # "Сегодня" меняется в полночь и без записей - дата входит в ETag
+    seq = await CounterService.current_seq(db)
+    etag = make_etag(seq, "stats", user_id, datetime.utcnow().date().isoformat())
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    
+    stats = await CachedNotificationService.get_stats(db, user_id, seq)
     return stats
 
+@router.get("/cache")
+async def get_cache_stats():
+    """Метрики кэша запросов: hit rate, вытеснения, инвалидации"""
+    return query_cache.stats()
+
+
+@router.get("/retention")
+async def get_retention_stats():
+    """Политики хранения и результаты очистки старых уведомлений"""
+    return retention_job.stats()
+
+
+@router.get("/telegram")
+async def get_telegram_stats(db: AsyncSession = Depends(get_read_db)):
+    """Доставка в Telegram: отправлено, повторы, 429, очередь (pending) и недоставленные (dead)"""
+    return {**telegram_delivery.stats(), "outbox": await TelegramOutboxService.counts(db)}
+
+
+@router.get("/rules")
+async def get_rules_stats():
+    """Правила уведомлений: сколько загружено, когда, сработавшие правила и ошибка загрузки"""
+    rule_engine.refresh()
+    return rule_engine.stats()
+
+
+@router.get("/workers")
+async def get_worker_stats():
+    """Воркер, ответивший на запрос: пересылка событий другим воркерам и фоновые задачи"""
+    return {**worker_fanout.stats(), "jobs_leader": jobs_lock.held}
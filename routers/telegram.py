@@ -0,0 +1,51 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional
+
+from database import get_db, get_read_db
+from models import TelegramRecipientUpdate, TelegramRecipientResponse, TelegramOutboxItem, TelegramRequeueRequest
+from services import TelegramOutboxService
+
+router = APIRouter()
+
+@router.put("/recipients/{user_id}", response_model=TelegramRecipientResponse)
+async def set_recipient(
+    user_id: str,
+    recipient: TelegramRecipientUpdate,
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Привязать чат Telegram к пользователю
+    
+    Новые уведомления пользователя будут приходить в этот чат (при `TELEGRAM_PUSH_ENABLED=true`).
+    `enabled=false` приостанавливает доставку; если бот заблокирован, чат отключается сам.
+    """
+    return await TelegramOutboxService.set_recipient(db, user_id, recipient.chat_id, recipient.enabled)
+
+@router.delete("/recipients/{user_id}")
+async def remove_recipient(
+    user_id: str,
+    db: AsyncSession = Depends(get_db)
+):
+    """Отвязать чат Telegram от пользователя"""
+    removed = await TelegramOutboxService.remove_recipient(db, user_id)
+    if not removed:
+        raise HTTPException(status_code=404, detail="Recipient not found")
+    return {"success": True, "message": "Recipient removed"}
+
+@router.get("/outbox/dead", response_model=List[TelegramOutboxItem])
+async def get_dead_letters(
+    limit: int = Query(100, ge=1, le=1000, description="Максимальное количество"),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """Недоставленные в Telegram уведомления (исчерпаны попытки, чат не найден, бот заблокирован)"""
+    return await TelegramOutboxService.dead_letters(db, limit)
+
+@router.post("/outbox/retry")
+async def retry_dead_letters(
+    request: Optional[TelegramRequeueRequest] = None,
+    db: AsyncSession = Depends(get_db)
+):
+    """Вернуть недоставленные уведомления в очередь (без `ids` - все)"""
+    requeued = await TelegramOutboxService.requeue_dead(db, request.ids if request else None)
+    return {"success": True, "requeued": requeued}
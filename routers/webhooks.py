@@ -1,11 +1,13 @@
 from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import JSONResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Optional
 import json
 
 from database import get_db
 from models import AirtableWebhookPayload
-from services import AirtableService, NotificationService
+from services import AirtableService, NotificationService, DuplicateNotificationError
+from ingest import webhook_queue, recent_keys
 
 router = APIRouter()
 
@@ -50,84 +52,106 @@ async def airtable_webhook(
         }
     }
     ```
+    
+    Повторная доставка того же события не создает дубликат: ключ идемпотентности
+    берется из заголовка `Idempotency-Key` или из (webhook.id, base.id, запись, event, timestamp).
+    
+    Уведомление создается для каждой записи каждой таблицы payload (не более
+    `WEBHOOK_MAX_EVENTS_PER_PAYLOAD`, лишние считаются в `dropped`). Несколько
+    обновлений одной записи схлопываются в одно уведомление с числом изменений, а
+    поток обновлений одного пользователя по одной таблице - в сводку (`ROLLUP_WINDOW_SECONDS`).
+    
+    **Ответ:** `202` - события приняты в очередь и будут записаны фоновой задачей;
+    `429` - очередь переполнена, Airtable повторит доставку позже.
     """
     try:
         # Получаем данные из запроса
         body = await request.json()
         
-        # Парсим событие Airtable
-        event_type = body.get("event", "")
-        base_id = body.get("base", {}).get("id", "")
-        payload = body.get("payload", {})
-        
-        # Определяем тип действия
-        action = "unknown"
-        if "record.created" in event_type:
-            action = "created"
-        elif "record.updated" in event_type:
-            action = "updated"
-        elif "record.deleted" in event_type:
-            action = "deleted"
-        elif "attachment" in event_type.lower():
-            action = "attachment_added"
-        
-        # Извлекаем информацию о пользователе
-        user_info = payload.get("eventMetadata", {}).get("sourceMetadata", {}).get("user", {})
-        user_id = user_info.get("id", "unknown")
-        user_email = user_info.get("email", "unknown@example.com")
-        user_name = user_info.get("name", user_email.split("@")[0])
-        
-        # Извлекаем информацию о таблице и записи
-        tables = payload.get("tables", [])
-        if not tables:
+        # Каждая пара (таблица, запись) - отдельное событие
+        events, dropped = AirtableService.expand_webhook_payload(
+            body, idempotency_key=request.headers.get("Idempotency-Key")
+        )
+        if not events:
             raise HTTPException(status_code=400, detail="Нет данных о таблицах")
         
-        table_data = tables[0]  # Берем первую таблицу
-        table_id = table_data.get("id", "")
-        table_name = table_data.get("name", "Unknown Table")
-        
-        records = table_data.get("records", [])
-        record_data = records[0] if records else {}
-        record_id = record_data.get("id", "")
-        fields = record_data.get("fields", {})
-        
-        # Проверяем наличие вложений
-        attachment_url = None
-        for field_name, field_value in fields.items():
-            if isinstance(field_value, list):
-                for item in field_value:
-                    if isinstance(item, dict) and "url" in item:
-                        attachment_url = item["url"]
-                        break
+        # Повторная доставка: недавние ключи отсекаются без обращения к БД
+        new_events = recent_keys.filter_new(events)
+        duplicates = len(events) - len(new_events)
+        if not new_events:
+            return {
+                "status": "duplicate",
+                "duplicates": duplicates,
+                "message": "События уже были приняты"
+            }
         
-        # Формируем данные события
-        event_data = {
-            "action": action,
-            "base_id": base_id,
-            "table_id": table_id,
-            "table_name": table_name,
-            "record_id": record_id,
-            "user_id": user_id,
-            "user_name": user_name,
-            "user_email": user_email,
-            "fields": fields,
-            "attachment_url": attachment_url
-        }
+        # Ставим в очередь - запись в БД идет пачками в фоне
+        if webhook_queue.running:
+            if not webhook_queue.enqueue(new_events):
+                raise HTTPException(
+                    status_code=429,
+                    detail="Очередь событий переполнена, повторите позже",
+                    headers={"Retry-After": "1"}
+                )
+            # Ключи запоминает фоновый писатель после коммита
+            return JSONResponse(
+                status_code=202,
+                content={
+                    "status": "accepted",
+                    "events": len(new_events),
+                    "duplicates": duplicates,
+                    "dropped": dropped,
+                    "queued": webhook_queue.depth,
+                    "message": "События приняты в обработку"
+                }
+            )
         
-        # Создаем уведомление
-        notification = await AirtableService.process_airtable_event(db, event_data)
+        # Фоновый писатель не запущен (приложение без lifespan) - пишем сразу одной пачкой
+        outcomes = await AirtableService.process_airtable_events(db, new_events)
+        recent_keys.remember([
+            event for event, outcome in zip(new_events, outcomes)
+            if isinstance(outcome, (int, DuplicateNotificationError))
+        ])
+        notification_ids = [outcome for outcome in outcomes if isinstance(outcome, int)]
         
         return {
             "status": "success",
-            "notification_id": notification.id,
-            "message": "Уведомление создано"
+            "notification_id": notification_ids[0] if notification_ids else None,
+            "notification_ids": notification_ids,
+            "duplicates": duplicates + sum(1 for outcome in outcomes if isinstance(outcome, DuplicateNotificationError)),
+            "dropped": dropped,
+            "message": "Уведомления созданы"
         }
         
+    except HTTPException:
+        raise
     except json.JSONDecodeError:
         raise HTTPException(status_code=400, detail="Невалидный JSON")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка обработки webhook: {str(e)}")
 
+@router.get("/queue")
+async def webhook_queue_stats():
+    """
+    Метрики очереди webhook-событий
+    
+    - `depth` / `capacity`: текущая глубина очереди и ее размер
+    - `accepted` / `rejected`: принято событий и отклонено с 429
+    - `written` / `failed`: записано в БД и не записано (невалидные события и пачки после повторов)
+    - `spilled`: из них сохранено в `spill_path` - запишите их `python manage.py replay-webhooks`
+    - `last_flush_ms`, `avg_flush_ms`, `max_flush_ms`: время записи пачки
+    - `last_latency_ms`: от постановки события в очередь до коммита
+    - `idempotency_cache`: размер кэша ключей и число отсеянных им повторов
+    """
+    return {
+        **webhook_queue.stats(),
+        "idempotency_cache": {
+            "size": len(recent_keys),
+            "capacity": recent_keys.maxsize,
+            "hits": recent_keys.hits
+        }
+    }
+
 @router.get("/airtable/test")
 async def test_airtable_webhook(db: AsyncSession = Depends(get_db)):
     """Тестовый эндпоинт для создания уведомления (для разработки)"""
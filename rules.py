@@ -0,0 +1,292 @@
+"""
+Правила преобразования событий Airtable в уведомления
+
+Правила задаются в файле NOTIFICATION_RULES_PATH (JSON, или YAML при установленном
+PyYAML) - списком или {"rules": [...]}. Правило выбирает события по action, таблице
+(table_id), пользователю, наличию и значениям полей записи и задает тип уведомления и
+шаблоны title/description в синтаксисе str.format: {table_name}, {record_name},
+{user_name}, {fields[Status]} и т.д. Обращение к атрибутам и индексы, кроме fields[Поле],
+запрещены. Выигрывает первое подходящее правило в порядке файла;
+если не подошло ни одно, работает встроенное преобразование AirtableService.
+
+При загрузке правила компилируются один раз: проверяются шаблоны, условия сводятся к
+множествам и кортежам, а правила раскладываются по индексу (action, table_id) - событие
+проверяет только правила своей пары и правила с подстановочными значениями.
+
+Файл перечитывается без перезапуска: не чаще раза в NOTIFICATION_RULES_CHECK_SECONDS
+сравнивается время изменения. Файл с ошибкой не применяется - остаются прежние правила,
+ошибка видна в GET /api/stats/rules и в python manage.py check-rules.
+"""
+import heapq
+import json
+import os
+import re
+import string
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Union
+
+from pydantic import BaseModel, Field
+
+from models import NotificationType
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+NOTIFICATION_RULES_PATH = os.getenv("NOTIFICATION_RULES_PATH", "")
+NOTIFICATION_RULES_CHECK_SECONDS = float(os.getenv("NOTIFICATION_RULES_CHECK_SECONDS", "2"))
+
+ACTIONS = ("created", "updated", "deleted", "attachment_added", "unknown")
+
+class NotificationRule(BaseModel):
+    """Правило: условия на событие и шаблон уведомления"""
+    name: str
+    action: Optional[Union[str, List[str]]] = None
+    table_id: Optional[Union[str, List[str]]] = None
+    user_id: Optional[Union[str, List[str]]] = None
+    # Поля, которые должны быть в записи (с любым значением)
+    fields_present: List[str] = Field(default_factory=list)
+    # Значения полей: одно значение или список допустимых
+    fields: Dict[str, Any] = Field(default_factory=dict)
+    type: NotificationType
+    title: str = Field(..., max_length=200)
+    description: str
+
+def as_tuple(value) -> tuple:
+    if value is None:
+        return ()
+    return tuple(value) if isinstance(value, list) else (value,)
+
+class TemplateValues(dict):
+    """Подстановки шаблона: отсутствующее поле записи дает пустую строку, а не KeyError"""
+
+    def __missing__(self, key):
+        return ""
+
+def template_values(event: dict) -> TemplateValues:
+    """Значения, доступные в шаблонах правил"""
+    fields = event.get("fields") or {}
+    attachment_url = event.get("attachment_url")
+    return TemplateValues(
+        action=event.get("action", "unknown"),
+        base_id=event.get("base_id", ""),
+        table_id=event.get("table_id", ""),
+        table_name=event.get("table_name", "Unknown"),
+        record_id=event.get("record_id", ""),
+        record_name=fields.get("Name") or fields.get("title") or "Запись",
+        user_id=event.get("user_id", "unknown"),
+        user_name=event.get("user_name", "Неизвестный пользователь"),
+        user_email=event.get("user_email", ""),
+        change_count=event.get("change_count", 1),
+        attachment_url=attachment_url or "",
+        file_name=attachment_url.split("/")[-1] if attachment_url else "",
+        fields=TemplateValues(fields)
+    )
+
+# Единственная разрешенная индексация - поле записи: {fields[Status]}
+FIELD_INDEX_RE = re.compile(r"fields\[[^\[\]]+\]")
+
+def check_fields(template: str, known: set):
+    for _, field_name, format_spec, _ in string.Formatter().parse(template):
+        if field_name is None:
+            continue
+        # Атрибуты ({user_name.__class__}) и прочие индексы дали бы доступ к объектам Python
+        if field_name not in known and not FIELD_INDEX_RE.fullmatch(field_name):
+            if "." in field_name or "[" in field_name:
+                raise ValueError(
+                    f"недопустимая подстановка {{{field_name}}}: атрибуты запрещены, индекс - только fields[Поле]"
+                )
+            raise ValueError(f"неизвестная подстановка {{{field_name}}}")
+        # Вложенные подстановки в формате: {title:{width}}
+        if format_spec:
+            check_fields(format_spec, known)
+
+def check_template(template: str, rule_name: str):
+    """Ошибка синтаксиса шаблона или недопустимая подстановка - ValueError при загрузке"""
+    try:
+        check_fields(template, set(template_values({})))
+    except ValueError as e:
+        raise ValueError(f"правило {rule_name!r}: шаблон {template!r}: {e}")
+
+class CompiledRule:
+    """Правило, приведенное к быстрой проверке"""
+
+    __slots__ = ("order", "rule", "user_ids", "fields_present", "field_values", "matched")
+
+    def __init__(self, order: int, rule: NotificationRule):
+        check_template(rule.title, rule.name)
+        check_template(rule.description, rule.name)
+        self.order = order
+        self.rule = rule
+        self.user_ids = frozenset(as_tuple(rule.user_id))
+        self.fields_present = tuple(rule.fields_present)
+        # Кортеж допустимых значений: значения полей Airtable бывают списками и словарями
+        self.field_values = tuple((name, as_tuple(value)) for name, value in rule.fields.items())
+        self.matched = 0
+
+    def __lt__(self, other: "CompiledRule") -> bool:
+        return self.order < other.order
+
+    def matches(self, event: dict, fields: dict) -> bool:
+        if self.user_ids and event.get("user_id") not in self.user_ids:
+            return False
+        for name in self.fields_present:
+            if fields.get(name) in (None, "", []):
+                return False
+        for name, allowed in self.field_values:
+            if name not in fields or fields[name] not in allowed:
+                return False
+        return True
+
+    def render(self, event: dict) -> tuple[NotificationType, str, str]:
+        values = template_values(event)
+        title = self.rule.title.format_map(values)[:200]
+        return self.rule.type, title, self.rule.description.format_map(values)
+
+class RuleSet:
+    """Скомпилированные правила с индексом по (action, table_id); None - любое значение"""
+
+    def __init__(self, rules: List[NotificationRule]):
+        self.rules = [CompiledRule(order, rule) for order, rule in enumerate(rules)]
+        self.index: Dict[tuple, List[CompiledRule]] = {}
+        for compiled in self.rules:
+            actions = as_tuple(compiled.rule.action) or (None,)
+            tables = as_tuple(compiled.rule.table_id) or (None,)
+            for action in actions:
+                if action is not None and action not in ACTIONS:
+                    raise ValueError(f"правило {compiled.rule.name!r}: неизвестный action {action!r}")
+                for table_id in tables:
+                    self.index.setdefault((action, table_id), []).append(compiled)
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def candidates(self, action: str, table_id: str) -> list:
+        """Списки правил, которые могут подойти событию (каждый - в порядке файла)"""
+        buckets = (
+            self.index.get((action, table_id)), self.index.get((action, None)),
+            self.index.get((None, table_id)), self.index.get((None, None))
+        )
+        return [bucket for bucket in buckets if bucket]
+
+    def match(self, event: dict) -> Optional[CompiledRule]:
+        """Первое в порядке файла правило, подходящее событию"""
+        buckets = self.candidates(event.get("action", "unknown"), event.get("table_id", ""))
+        if not buckets:
+            return None
+        fields = event.get("fields") or {}
+        ordered = buckets[0] if len(buckets) == 1 else heapq.merge(*buckets)
+        for compiled in ordered:
+            if compiled.matches(event, fields):
+                compiled.matched += 1
+                return compiled
+        return None
+
+def parse_rules(raw: str, path: str = "") -> List[NotificationRule]:
+    """Разобрать файл правил (JSON или YAML по расширению); ValueError при ошибке"""
+    try:
+        if path.endswith((".yaml", ".yml")):
+            if yaml is None:
+                raise ValueError("для YAML установите PyYAML (pip install pyyaml) или используйте JSON")
+            data = yaml.safe_load(raw)
+        else:
+            data = json.loads(raw)
+        if isinstance(data, dict):
+            data = data.get("rules")
+        if not isinstance(data, list):
+            raise ValueError("ожидается список правил или {\"rules\": [...]}")
+        return [NotificationRule(**item) for item in data]
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError(f"{type(e).__name__}: {e}")
+
+def load_rules(path: str) -> RuleSet:
+    """Прочитать и скомпилировать файл правил; ValueError при ошибке"""
+    with open(path, encoding="utf-8") as rules_file:
+        raw = rules_file.read()
+    try:
+        return RuleSet(parse_rules(raw, path))
+    except ValueError as e:
+        raise ValueError(f"Невалидные правила {path}: {e}")
+
+class RuleEngine:
+    """Текущий набор правил с перечитыванием файла при изменении"""
+
+    def __init__(self, path: str = NOTIFICATION_RULES_PATH, check_seconds: float = NOTIFICATION_RULES_CHECK_SECONDS):
+        self.path = path
+        self.check_seconds = check_seconds
+        self.rules = RuleSet([])
+        self.loaded_mtime: Optional[float] = None
+        self.loaded_at: Optional[datetime] = None
+        self.next_check = 0.0
+        self.reloads = 0
+        self.matched = 0
+        self.fallback = 0
+        self.last_error: Optional[str] = None
+
+    def reload(self) -> bool:
+        """Перечитать файл; при ошибке остаются прежние правила. True - правила заменены"""
+        try:
+            mtime = os.stat(self.path).st_mtime
+            rules = load_rules(self.path)
+        except (OSError, ValueError) as e:
+            self.last_error = str(e)
+            print(f"Ошибка загрузки правил уведомлений: {e}")
+            return False
+        self.rules = rules
+        self.loaded_mtime = mtime
+        self.loaded_at = datetime.utcnow()
+        self.reloads += 1
+        self.last_error = None
+        return True
+
+    def refresh(self):
+        """Перечитать файл, если он изменился (проверка не чаще раза в check_seconds)"""
+        if not self.path:
+            return
+        now = time.monotonic()
+        if now < self.next_check:
+            return
+        self.next_check = now + self.check_seconds
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError as e:
+            if self.last_error is None:
+                self.last_error = str(e)
+                print(f"Файл правил уведомлений недоступен: {e}")
+            return
+        if mtime != self.loaded_mtime:
+            self.reload()
+
+    def match(self, event: dict) -> Optional[CompiledRule]:
+        """Правило для события Airtable или None (тогда - встроенное преобразование)"""
+        self.refresh()
+        compiled = self.rules.match(event) if len(self.rules) else None
+        if compiled:
+            self.matched += 1
+        else:
+            self.fallback += 1
+        return compiled
+
+    def stats(self) -> dict:
+        """Состояние правил"""
+        return {
+            "path": self.path or None,
+            "rules": len(self.rules),
+            "index_keys": len(self.rules.index),
+            "loaded_at": self.loaded_at.isoformat() if self.loaded_at else None,
+            "reloads": self.reloads,
+            "matched": self.matched,
+            "fallback": self.fallback,
+            "last_error": self.last_error,
+            "top_rules": [
+                {"name": compiled.rule.name, "matched": compiled.matched}
+                for compiled in sorted(self.rules.rules, key=lambda c: c.matched, reverse=True)[:10]
+                if compiled.matched
+            ]
+        }
+
+rule_engine = RuleEngine()
@@ -0,0 +1,33 @@
+"""
+Быстрая сериализация ответов в JSON
+
+Списки уведомлений собираются из кортежей строк БД в обычные dict и кодируются
+сразу в байты - без модели Pydantic на каждую строку и без повторного прохода
+jsonable_encoder в FastAPI. Если установлен orjson, кодирует он, иначе -
+стандартный json с теми же настройками, что у JSONResponse.
+"""
+import json
+from datetime import datetime
+from typing import Optional
+
+from fastapi.responses import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Тип {type(value).__name__} не сериализуется в JSON")
+
+def dumps(payload) -> bytes:
+    """Закодировать dict/list в JSON (UTF-8 байты)"""
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":"), default=_default).encode("utf-8")
+
+def json_response(payload, status_code: int = 200, headers: Optional[dict] = None) -> Response:
+    """Готовый JSON-ответ без повторной обработки FastAPI"""
+    return Response(content=dumps(payload), status_code=status_code, headers=headers, media_type="application/json")
@@ -1,8 +1,16 @@
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func, and_, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import select, insert, update, delete, func, and_, or_, case, text, bindparam, tuple_, table, column, literal_column
 from sqlalchemy.orm import selectinload
-from typing import List, Optional
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.dialects import sqlite, postgresql
+from typing import List, Optional, Union
 from datetime import datetime, timedelta
+import base64
+import hashlib
+import json
+import os
+import re
 from models import (
     NotificationCreate, 
     NotificationUpdate, 
@@ -10,9 +18,657 @@ from models import (
     NotificationFilter,
     NotificationType,
     NotificationStatus,
-    StatsResponse
+    StatsResponse,
+    TotalMode,
+    ListView
 )
-from database import Notification
+from database import (
+    Notification, NotificationCounter, NotificationPayload, NotificationKey, NotificationRollup, NotificationRollupKey,
+    TelegramRecipient, TelegramOutbox, NOTIFICATIONS_PARTITIONED, SEARCH_LANGUAGE, partition_name, add_months
+)
+from pubsub import broadcaster
+from cache import query_cache, COUNT_CACHE_TTL
+from payloads import PAYLOAD_STORAGE, pack_payload, unpack_payload
+from telegram_push import TELEGRAM_PUSH_ENABLED
+from rules import rule_engine
+
+# Сколько событий максимум разворачивать из одного webhook-payload
+WEBHOOK_MAX_EVENTS_PER_PAYLOAD = int(os.getenv("WEBHOOK_MAX_EVENTS_PER_PAYLOAD", "1000"))
+# Схлопывать несколько обновлений одной записи в одном payload в одно уведомление
+WEBHOOK_COALESCE_UPDATES = os.getenv("WEBHOOK_COALESCE_UPDATES", "true").lower() in ("1", "true", "yes")
+
+# Сводки: события этих типов одного пользователя по одной таблице Airtable с паузами
+# не длиннее окна складываются в одно уведомление (0 - выключено)
+ROLLUP_WINDOW_SECONDS = float(os.getenv("ROLLUP_WINDOW_SECONDS", "60"))
+ROLLUP_TYPES = [value.strip() for value in os.getenv("ROLLUP_TYPES", "record_update").split(",") if value.strip()]
+# Дольше этого сводка не растет - следующее событие начинает новую
+ROLLUP_MAX_SECONDS = float(os.getenv("ROLLUP_MAX_SECONDS", "3600"))
+# Сколько разных record_id сохранять в сводке
+ROLLUP_SAMPLE_SIZE = int(os.getenv("ROLLUP_SAMPLE_SIZE", "20"))
+
+# Поиск: сколько слов запроса учитывать
+SEARCH_MAX_TERMS = int(os.getenv("SEARCH_MAX_TERMS", "8"))
+# Сколько самых новых совпадений упорядочивать по релевантности (0 - все): ранжирование
+# стоит пропорционально числу совпадений, а частое слово совпадает с заметной долей таблицы
+SEARCH_RANK_WINDOW = int(os.getenv("SEARCH_RANK_WINDOW", "5000"))
+# Слово запроса - буквы и цифры (подчеркивание и пунктуация разделяют слова)
+SEARCH_WORD_RE = re.compile(r"[^\W_]+")
+CYRILLIC_WORD_RE = re.compile(r"[а-яё]+")
+# Частые окончания русских слов - отрезаются для префиксного поиска в SQLite
+RUSSIAN_ENDING_RE = re.compile(
+    r"(?:ями|ами|ого|его|ому|ему|ыми|ими|ых|их|ой|ей|ий|ый|ая|яя|ое|ее|ые|ие|ую|юю|ов|ев|ам|ям|ах|ях|ом|ем|[аяыиоеуюйь])$"
+)
+
+# Заголовок сводки и подпись к счетчику событий
+ROLLUP_LABELS = {
+    NotificationType.RECORD_UPDATE: ("Обновление записей", "Обновлений записей"),
+    NotificationType.RECORD_CREATE: ("Создание записей", "Создано записей"),
+    NotificationType.RECORD_DELETE: ("Удаление записей", "Удалено записей"),
+    NotificationType.FILE_UPLOAD: ("Загрузка файлов", "Загружено файлов"),
+    NotificationType.USER_ACTION: ("Действия в таблице", "Действий"),
+}
+
+# Размер пачки для IN-списков и массовых вставок (лимит переменных SQLite - 999 в старых версиях)
+BULK_CHUNK_SIZE = 500
+# PostgreSQL: пачки от этого размера грузятся через COPY вместо INSERT
+PG_COPY_MIN_ROWS = int(os.getenv("PG_COPY_MIN_ROWS", "100"))
+
+# Порядок колонок для COPY в notifications
+COPY_COLUMNS = [
+    ("id", "id"), ("type", "type"), ("title", "title"), ("description", "description"),
+    ("user_id", "user_id"), ("user_name", "user_name"), ("source", "source"),
+    ("status", "status"), ("timestamp", "timestamp"), ("details", "details"),
+    ("metadata", "event_metadata"), ("idempotency_key", "idempotency_key"),
+    ("change_seq", "change_seq"), ("payload_hash", "payload_hash")
+]
+
+class DuplicateNotificationError(Exception):
+    """Уведомление с таким ключом идемпотентности уже создано"""
+    
+    def __init__(self, idempotency_key: str):
+        super().__init__(f"Дубликат: ключ идемпотентности {idempotency_key} уже использован")
+        self.idempotency_key = idempotency_key
+
+def is_idempotency_conflict(error: Exception) -> bool:
+    """Нарушение уникальности ключа идемпотентности (SQLite и PostgreSQL, в т.ч. notification_keys и notification_rollup_keys)"""
+    return isinstance(error, IntegrityError) and any(
+        marker in str(error.orig) for marker in ("idempotency_key", "notification_keys", "notification_rollup_keys")
+    )
+
+async def claim_keys(db: AsyncSession, keys: List[str]) -> None:
+    """
+    Занять ключи идемпотентности в notification_keys (без commit)
+    
+    Нужно только для секционированной notifications - там нет глобального уникального
+    индекса по ключу. Занятый ключ дает IntegrityError, как и уникальный индекс.
+    """
+    if NOTIFICATIONS_PARTITIONED and keys:
+        await db.execute(insert(NotificationKey), [{"idempotency_key": key} for key in keys])
+
+async def used_keys(db: AsyncSession, keys: List[str]) -> set:
+    """Какие из ключей идемпотентности уже заняты (уведомлениями или событиями в сводках)"""
+    if not keys:
+        return set()
+    key_column = (NotificationKey if NOTIFICATIONS_PARTITIONED else Notification).idempotency_key
+    rollup_column = NotificationRollupKey.idempotency_key
+    used = set()
+    for chunk in chunked(keys):
+        result = await db.execute(
+            select(key_column).where(key_column.in_(chunk))
+            .union_all(select(rollup_column).where(rollup_column.in_(chunk)))
+        )
+        used.update(result.scalars().all())
+    return used
+
+async def update_by_id(db: AsyncSession, rows: List[dict]) -> None:
+    """
+    executemany UPDATE notifications по id: [{"id": ..., "<атрибут>": ...}, ...]
+    
+    ORM-обновление по первичному ключу требует все его колонки, а в секционированной
+    таблице в ключ входит timestamp - поэтому запрос собирается по одному id.
+    """
+    columns = Notification.__mapper__.columns
+    names = [key for key in rows[0] if key != "id"]
+    statement = (
+        update(Notification.__table__)
+        .where(Notification.__table__.c.id == bindparam("b_id"))
+        .values({columns[name]: bindparam(f"b_{name}") for name in names})
+    )
+    await db.execute(statement, [{f"b_{key}": value for key, value in row.items()} for row in rows])
+
+def outbox_item(notification_id: int, data: NotificationCreate) -> dict:
+    """Строка очереди доставки в Telegram для созданного уведомления"""
+    return {
+        "notification_id": notification_id,
+        "user_id": data.user_id,
+        "type": data.type,
+        "title": data.title,
+        "description": data.description
+    }
+
+def chunked(items: list, size: int = BULK_CHUNK_SIZE):
+    """Разбить список на пачки фиксированного размера"""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def encode_cursor(timestamp: datetime, notification_id: int) -> str:
+    """Упаковать позицию (timestamp, id) в непрозрачный курсор"""
+    raw = json.dumps([timestamp.isoformat(), notification_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    """Распаковать курсор; ValueError, если курсор поврежден"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        timestamp, notification_id = json.loads(base64.urlsafe_b64decode(padded))
+        return datetime.fromisoformat(timestamp), int(notification_id)
+    except Exception:
+        raise ValueError("Невалидный курсор")
+
+# Поля ответа в порядке NotificationResponse и их колонки
+RESPONSE_FIELDS = (
+    "id", "type", "title", "description", "user_id", "user_name", "source",
+    "status", "timestamp", "details", "metadata", "change_seq"
+)
+FIELD_COLUMNS = {
+    "id": Notification.id, "type": Notification.type, "title": Notification.title,
+    "description": Notification.description, "user_id": Notification.user_id,
+    "user_name": Notification.user_name, "source": Notification.source,
+    "status": Notification.status, "timestamp": Notification.timestamp,
+    "details": Notification.details, "metadata": Notification.event_metadata,
+    "change_seq": Notification.change_seq
+}
+RESPONSE_COLUMNS = tuple(FIELD_COLUMNS[name] for name in RESPONSE_FIELDS)
+
+# Тяжелые JSON-колонки: в компактном списке не читаются, полностью - в GET /{id}
+HEAVY_FIELDS = {"details", "metadata"}
+COMPACT_FIELDS = tuple(name for name in RESPONSE_FIELDS if name not in HEAVY_FIELDS)
+# Список по умолчанию: metadata лежит в notification_payloads и распаковывалась бы на каждой странице
+STANDARD_FIELDS = tuple(name for name in RESPONSE_FIELDS if name != "metadata")
+# Нужны для пагинации и дельта-синхронизации - возвращаются при любой проекции
+PAGING_FIELDS = {"id", "timestamp", "change_seq"}
+# Обязательные поля NotificationResponse, которые в старых строках бывают пустыми
+REQUIRED_FIELDS = ("source", "status", "timestamp")
+
+def resolve_fields(view: ListView = ListView.STANDARD, fields: Optional[List[str]] = None) -> tuple:
+    """
+    Поля ответа списка по view и fields (fields важнее view)
+    
+    ValueError, если запрошено неизвестное поле.
+    """
+    if not fields:
+        if view == ListView.COMPACT:
+            return COMPACT_FIELDS
+        return RESPONSE_FIELDS if view == ListView.FULL else STANDARD_FIELDS
+    unknown = set(fields) - set(RESPONSE_FIELDS)
+    if unknown:
+        raise ValueError(f"Неизвестные поля: {', '.join(sorted(unknown))}")
+    requested = set(fields) | PAGING_FIELDS
+    return tuple(name for name in RESPONSE_FIELDS if name in requested)
+
+def row_to_response(row, fields: tuple = RESPONSE_FIELDS) -> Optional[dict]:
+    """
+    Строка колонок fields -> dict, как NotificationResponse.model_dump(mode="json", by_alias=True)
+    
+    Строки без обязательных полей пропускаются (None), как раньше при ошибке валидации.
+    """
+    notification = dict(zip(fields, row))
+    for name in REQUIRED_FIELDS:
+        if name in notification and notification[name] is None:
+            print(f"Ошибка преобразования уведомления {notification.get('id')}: пустое обязательное поле")
+            return None
+    if "type" in notification:
+        notification["type"] = notification["type"].value
+    if "status" in notification:
+        notification["status"] = notification["status"].value
+    return notification
+
+def make_etag(seq: int, *parts) -> str:
+    """Слабый ETag: номер последнего изменения + отпечаток параметров запроса"""
+    fingerprint = hashlib.sha1("|".join(str(part) for part in parts).encode()).hexdigest()[:16]
+    return f'W/"{seq}-{fingerprint}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Совпадает ли ETag с одним из значений заголовка If-None-Match"""
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+def upsert_dialect(db: AsyncSession):
+    """Модуль диалекта с INSERT ... ON CONFLICT для текущего подключения"""
+    return postgresql if db.bind.dialect.name == "postgresql" else sqlite
+
+def filter_signature(filters: NotificationFilter, fields: set) -> str:
+    """Нормализованный ключ кэша по полям фильтра"""
+    return json.dumps(filters.model_dump(mode="json", include=fields), sort_keys=True)
+
+# Поля, от которых зависит число строк (без пагинации)
+COUNT_FIELDS = {"type", "user_id", "types", "user_ids", "source", "status", "start_date", "end_date", "since_seq"}
+
+# Области счетчиков уведомлений (кроме служебной seq)
+COUNTER_SCOPES = ("global", "user", "type", "day", "user_type", "user_day")
+
+def feed_tag(user_id: Optional[str], type_value: Optional[str]) -> str:
+    """Тег кэша списков и COUNT с фильтром по пользователю и типу (* - без фильтра)"""
+    return f"feed:{user_id or '*'}:{type_value or '*'}"
+
+def event_tags(event: dict) -> List[str]:
+    """Теги кэша, которые устаревают после события создания или смены статуса"""
+    user_id, type_value = event.get("user_id"), event.get("type")
+    return [
+        feed_tag(user_id, type_value), feed_tag(user_id, None),
+        feed_tag(None, type_value), feed_tag(None, None),
+        f"notification:{event.get('id')}",
+        f"stats:{user_id}", "stats:*"
+    ]
+
+def invalidate_cache(event: dict) -> None:
+    """Слушатель broadcaster: точечная инвалидация кэша по событию записи"""
+    # Другие воркеры получают само событие и инвалидируют кэш у себя
+    query_cache.invalidate(event_tags(event), forward=False)
+
+broadcaster.add_listener(invalidate_cache)
+
+def created_event(notification: NotificationResponse) -> dict:
+    """Событие живой ленты о новом уведомлении"""
+    return {
+        "event": "created",
+        "id": notification.id,
+        "seq": notification.change_seq,
+        "user_id": notification.user_id,
+        "type": notification.type.value,
+        "notification": notification.model_dump(mode="json", by_alias=True)
+    }
+
+def replayed_event(notification: NotificationResponse) -> dict:
+    """
+    Событие догона живой ленты: уведомление изменилось, пока клиент был отключен
+    
+    Из БД не видно, знает ли клиент уведомление, поэтому событие несет и полное
+    уведомление (неизвестное клиенту - новое), и поля, как у updated.
+    """
+    data = notification.model_dump(mode="json", by_alias=True)
+    return {
+        "event": "updated",
+        "id": notification.id,
+        "seq": notification.change_seq,
+        "user_id": notification.user_id,
+        "type": notification.type.value,
+        "status": notification.status.value,
+        "changes": {"title": data["title"], "description": data["description"], "details": data["details"]},
+        "notification": data
+    }
+
+def publish_created(notification: NotificationResponse) -> None:
+    """Сообщить живой ленте о новом уведомлении"""
+    broadcaster.publish(created_event(notification))
+
+def publish_rollup(notification_id: int, user_id: str, notification_type, seq: int, changes: dict) -> None:
+    """Сообщить живой ленте, что в сводку добавились события (новые title, description, details)"""
+    broadcaster.publish({
+        "event": "updated",
+        "id": notification_id,
+        "seq": seq,
+        "user_id": user_id,
+        "type": NotificationType(notification_type).value,
+        "status": NotificationStatus.UNREAD.value,
+        "changes": changes
+    })
+
+def publish_status(
+    notification_id: int,
+    user_id: str,
+    notification_type,
+    status: NotificationStatus,
+    seq: Optional[int] = None
+) -> None:
+    """Сообщить живой ленте о смене статуса"""
+    broadcaster.publish({
+        "event": "updated",
+        "id": notification_id,
+        "seq": seq,
+        "user_id": user_id,
+        "type": NotificationType(notification_type).value,
+        "status": status.value
+    })
+
+class CounterService:
+    """Инкрементальные счетчики для статистики (таблица notification_counters)"""
+    
+    @staticmethod
+    def counter_keys(user_id: str, notification_type: NotificationType, day: str) -> List[tuple[str, str]]:
+        """Ключи счетчиков, которые затрагивает одно уведомление"""
+        type_value = NotificationType(notification_type).value
+        return [
+            ("global", ""),
+            ("user", user_id),
+            ("type", type_value),
+            ("day", day),
+            ("user_type", f"{user_id}|{type_value}"),
+            ("user_day", f"{user_id}|{day}"),
+        ]
+    
+    @staticmethod
+    def track(
+        deltas: dict,
+        user_id: str,
+        notification_type: NotificationType,
+        timestamp: datetime,
+        total: int = 0,
+        unread: int = 0
+    ) -> None:
+        """Накопить приращения (total, unread) для уведомления в deltas"""
+        day = timestamp.date().isoformat()
+        for key in CounterService.counter_keys(user_id, notification_type, day):
+            delta = deltas.setdefault(key, [0, 0])
+            delta[0] += total
+            delta[1] += unread
+    
+    @staticmethod
+    async def apply(
+        db: AsyncSession,
+        deltas: dict,
+        labels: Optional[dict] = None
+    ) -> None:
+        """Применить накопленные приращения одним upsert (без commit - в транзакции вызывающего)"""
+        labels = labels or {}
+        rows = [
+            {
+                "scope": scope,
+                "key": key,
+                "label": labels.get(key) if scope == "user" else None,
+                "total": total,
+                "unread": unread
+            }
+            for (scope, key), (total, unread) in deltas.items()
+            if total or unread or (scope == "user" and key in labels)
+        ]
+        if not rows:
+            return
+        
+        stmt = upsert_dialect(db).insert(NotificationCounter).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[NotificationCounter.scope, NotificationCounter.key],
+            set_={
+                "total": NotificationCounter.total + stmt.excluded.total,
+                "unread": NotificationCounter.unread + stmt.excluded.unread,
+                "label": func.coalesce(stmt.excluded.label, NotificationCounter.label)
+            }
+        )
+        await db.execute(stmt)
+    
+    @staticmethod
+    async def reserve_seq(db: AsyncSession, count: int = 1) -> int:
+        """
+        Зарезервировать count номеров изменений; возвращает первый из них
+        
+        Строка seq блокируется до конца транзакции, поэтому номера растут в порядке коммитов.
+        Если строки нет (новая БД или пересчет), отсчет продолжается от max(change_seq).
+        """
+        start_value = select(func.coalesce(func.max(Notification.change_seq), 0) + count).scalar_subquery()
+        stmt = upsert_dialect(db).insert(NotificationCounter).values(
+            scope="seq", key="", total=start_value, unread=0
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[NotificationCounter.scope, NotificationCounter.key],
+            set_={"total": NotificationCounter.total + count}
+        ).returning(NotificationCounter.total)
+        last = (await db.execute(stmt)).scalar_one()
+        return last - count + 1
+    
+    @staticmethod
+    async def current_seq(db: AsyncSession) -> int:
+        """Номер последнего изменения (одно чтение по первичному ключу)"""
+        result = await db.execute(
+            select(NotificationCounter.total)
+            .where(NotificationCounter.scope == "seq", NotificationCounter.key == "")
+        )
+        return result.scalar() or 0
+    
+    @staticmethod
+    async def estimate_total(db: AsyncSession, filters: NotificationFilter) -> Optional[int]:
+        """
+        Число уведомлений под фильтр по счетчикам - одно чтение по первичному ключу
+        
+        Счетчики есть для сочетаний user_id / type / status. Для фильтров по датам,
+        источнику, спискам значений и since_seq возвращает None - тогда нужен COUNT.
+        """
+        if (
+            filters.start_date or filters.end_date or filters.since_seq is not None
+            or filters.types or filters.user_ids or filters.source
+        ):
+            return None
+        
+        type_value = filters.type.value if filters.type else None
+        if filters.user_id and type_value:
+            key = ("user_type", f"{filters.user_id}|{type_value}")
+        elif filters.user_id:
+            key = ("user", filters.user_id)
+        elif type_value:
+            key = ("type", type_value)
+        else:
+            key = ("global", "")
+        
+        result = await db.execute(
+            select(NotificationCounter.total, NotificationCounter.unread)
+            .where(NotificationCounter.scope == key[0], NotificationCounter.key == key[1])
+        )
+        total, unread = result.first() or (0, 0)
+        if filters.status == NotificationStatus.UNREAD:
+            return unread
+        if filters.status == NotificationStatus.READ:
+            return total - unread
+        return total
+    
+    @staticmethod
+    async def rebuild(db: AsyncSession) -> int:
+        """Пересчитать все счетчики из таблицы notifications; возвращает число строк счетчиков"""
+        day_column = func.date(Notification.timestamp)
+        result = await db.execute(
+            select(
+                Notification.user_id,
+                Notification.type,
+                day_column,
+                func.count(Notification.id),
+                func.sum(case((Notification.status == NotificationStatus.UNREAD, 1), else_=0)),
+                func.max(Notification.user_name)
+            ).group_by(Notification.user_id, Notification.type, day_column)
+        )
+        
+        deltas = {}
+        labels = {}
+        for user_id, notification_type, day, total, unread, user_name in result.fetchall():
+            day = day if isinstance(day, str) else day.isoformat()
+            for key in CounterService.counter_keys(user_id, notification_type, day):
+                delta = deltas.setdefault(key, [0, 0])
+                delta[0] += total
+                delta[1] += unread or 0
+            labels[user_id] = user_name
+        
+        # Номер изменений не пересчитывается, а переносится - иначе сломались бы ETag клиентов
+        max_seq = (await db.execute(select(func.max(Notification.change_seq)))).scalar() or 0
+        seq = max(max_seq, await CounterService.current_seq(db))
+        if seq:
+            deltas[("seq", "")] = [seq, 0]
+        
+        await db.execute(delete(NotificationCounter))
+        await CounterService.apply(db, deltas, labels)
+        await db.commit()
+        return len(deltas)
+    
+    @staticmethod
+    async def rebuild_if_empty(db: AsyncSession) -> None:
+        """Заполнить счетчики для БД, созданной до их появления"""
+        has_counters = await db.execute(select(NotificationCounter.scope).limit(1))
+        if has_counters.first() is None:
+            await CounterService.rebuild(db)
+
+class PayloadService:
+    """Сырые payload событий (metadata) в notification_payloads - см. payloads.py"""
+    
+    @staticmethod
+    async def store(db: AsyncSession, payloads: List[Optional[dict]]) -> List[Optional[str]]:
+        """
+        Сохранить payload сжатыми и без дубликатов (без commit); возвращает хэши по порядку
+        
+        Для None и в режиме PAYLOAD_STORAGE=inline хэш - None: metadata остается в строке уведомления.
+        """
+        if PAYLOAD_STORAGE != "table":
+            return [None] * len(payloads)
+        
+        packed = {}
+        hashes = []
+        for payload in payloads:
+            if payload is None:
+                hashes.append(None)
+                continue
+            row = pack_payload(payload)
+            packed.setdefault(row["hash"], row)
+            hashes.append(row["hash"])
+        
+        if packed:
+            stmt = upsert_dialect(db).insert(NotificationPayload).on_conflict_do_nothing(
+                index_elements=[NotificationPayload.hash]
+            )
+            await db.execute(stmt, list(packed.values()))
+        return hashes
+    
+    @staticmethod
+    async def load(db: AsyncSession, hashes) -> dict:
+        """Распакованные payload по хэшам: {hash: payload}"""
+        payloads = {}
+        for chunk in chunked(list(set(hashes))):
+            result = await db.execute(
+                select(NotificationPayload.hash, NotificationPayload.codec, NotificationPayload.data)
+                .where(NotificationPayload.hash.in_(chunk))
+            )
+            for payload_hash, codec, data in result.all():
+                payloads[payload_hash] = unpack_payload(data, codec)
+        return payloads
+    
+    @staticmethod
+    async def hydrate(db: AsyncSession, notifications: List[Notification]) -> None:
+        """Подставить metadata из notification_payloads в ORM-объекты (без пометки об изменении)"""
+        pending = [n for n in notifications if n.payload_hash and n.event_metadata is None]
+        if not pending:
+            return
+        payloads = await PayloadService.load(db, [n.payload_hash for n in pending])
+        for notification in pending:
+            set_committed_value(notification, "event_metadata", payloads.get(notification.payload_hash))
+    
+    @staticmethod
+    async def offload(db: AsyncSession, batch_size: int = BULK_CHUNK_SIZE) -> int:
+        """
+        Перенести metadata, записанную в строки notifications, в notification_payloads
+        
+        Идет пачками по id с commit после каждой, поэтому прерванный перенос можно
+        продолжить. Возвращает число перенесенных уведомлений.
+        """
+        moved = 0
+        last_id = 0
+        while True:
+            result = await db.execute(
+                select(Notification.id, Notification.event_metadata)
+                .where(Notification.id > last_id, Notification.payload_hash.is_(None))
+                .order_by(Notification.id)
+                .limit(batch_size)
+            )
+            rows = result.all()
+            if not rows:
+                return moved
+            last_id = rows[-1][0]
+            
+            rows = [(notification_id, metadata) for notification_id, metadata in rows if metadata is not None]
+            hashes = await PayloadService.store(db, [metadata for _, metadata in rows])
+            updates = [
+                {"id": notification_id, "event_metadata": None, "payload_hash": payload_hash}
+                for (notification_id, _), payload_hash in zip(rows, hashes)
+                if payload_hash
+            ]
+            if updates:
+                await update_by_id(db, updates)
+            await db.commit()
+            moved += len(updates)
+
+class TelegramOutboxService:
+    """Очередь доставки в Telegram (telegram_outbox) и чаты получателей - отправка в telegram_push.py"""
+    
+    @staticmethod
+    async def enqueue(db: AsyncSession, notifications: List[dict]) -> int:
+        """
+        Поставить созданные уведомления в очередь доставки (без commit)
+        
+        notifications - dict с notification_id, user_id, type, title, description.
+        В очередь попадают только пользователи с включенным чатом; возвращает число строк.
+        """
+        if not TELEGRAM_PUSH_ENABLED or not notifications:
+            return 0
+        user_ids = {item["user_id"] for item in notifications}
+        result = await db.execute(
+            select(TelegramRecipient.user_id, TelegramRecipient.chat_id)
+            .where(TelegramRecipient.user_id.in_(user_ids), TelegramRecipient.enabled.is_(True))
+        )
+        chats = dict(result.all())
+        now = datetime.utcnow()
+        rows = [
+            dict(item, chat_id=chats[item["user_id"]], next_attempt_at=now, created_at=now)
+            for item in notifications
+            if item["user_id"] in chats
+        ]
+        if rows:
+            await db.execute(insert(TelegramOutbox), rows)
+        return len(rows)
+    
+    @staticmethod
+    async def set_recipient(db: AsyncSession, user_id: str, chat_id: int, enabled: bool = True) -> TelegramRecipient:
+        """Привязать (или перепривязать) чат к пользователю"""
+        recipient = await db.get(TelegramRecipient, user_id)
+        if recipient is None:
+            recipient = TelegramRecipient(user_id=user_id)
+            db.add(recipient)
+        recipient.chat_id = chat_id
+        recipient.enabled = enabled
+        await db.commit()
+        await db.refresh(recipient)
+        return recipient
+    
+    @staticmethod
+    async def remove_recipient(db: AsyncSession, user_id: str) -> bool:
+        """Отвязать чат; недоставленное пользователю остается в очереди и будет отправлено"""
+        result = await db.execute(delete(TelegramRecipient).where(TelegramRecipient.user_id == user_id))
+        await db.commit()
+        return result.rowcount > 0
+    
+    @staticmethod
+    async def counts(db: AsyncSession) -> dict:
+        """Строк в очереди по статусам (pending, dead)"""
+        result = await db.execute(
+            select(TelegramOutbox.status, func.count(TelegramOutbox.id)).group_by(TelegramOutbox.status)
+        )
+        return {"pending": 0, "dead": 0, **dict(result.all())}
+    
+    @staticmethod
+    async def dead_letters(db: AsyncSession, limit: int = 100) -> List[TelegramOutbox]:
+        """Недоставленные строки (dead), новые сначала"""
+        result = await db.execute(
+            select(TelegramOutbox).where(TelegramOutbox.status == "dead")
+            .order_by(TelegramOutbox.id.desc()).limit(limit)
+            .execution_options(populate_existing=True)  # строки меняет доставка в своих сессиях
+        )
+        return list(result.scalars().all())
+    
+    @staticmethod
+    async def requeue_dead(db: AsyncSession, ids: Optional[List[int]] = None) -> int:
+        """Вернуть dead-строки в очередь с обнуленными попытками; ids=None - все"""
+        stmt = update(TelegramOutbox).where(TelegramOutbox.status == "dead")
+        if ids is not None:
+            stmt = stmt.where(TelegramOutbox.id.in_(ids))
+        result = await db.execute(stmt.values(
+            status="pending", attempts=0, next_attempt_at=datetime.utcnow(), last_error=None
+        ))
+        await db.commit()
+        return result.rowcount
 
 class NotificationService:
     """Сервис для работы с уведомлениями"""
@@ -24,6 +680,9 @@ class NotificationService:
     ) -> Notification:
         """Создать новое уведомление"""
         try:
+            payload_hash, = await PayloadService.store(db, [notification_data.event_metadata])
+            if notification_data.idempotency_key:
+                await claim_keys(db, [notification_data.idempotency_key])
             notification = Notification(
                 type=notification_data.type,
                 title=notification_data.title,
@@ -32,65 +691,306 @@ class NotificationService:
                 user_name=notification_data.user_name,
                 source=notification_data.source,
                 details=notification_data.details,
-                event_metadata=notification_data.event_metadata,
+                event_metadata=None if payload_hash else notification_data.event_metadata,
+                payload_hash=payload_hash,
+                idempotency_key=notification_data.idempotency_key,
                 status=NotificationStatus.UNREAD,
-                timestamp=datetime.utcnow()
+                timestamp=datetime.utcnow(),
+                change_seq=await CounterService.reserve_seq(db)
             )
             
             db.add(notification)
+            await db.flush()
+            await TelegramOutboxService.enqueue(db, [outbox_item(notification.id, notification_data)])
+            
+            # Счетчики статистики - в той же транзакции
+            deltas = {}
+            CounterService.track(
+                deltas, notification.user_id, notification.type, notification.timestamp,
+                total=1, unread=1
+            )
+            await CounterService.apply(db, deltas, {notification.user_id: notification.user_name})
+            
             await db.commit()
             await db.refresh(notification)
-            return notification
+            if payload_hash:
+                # В строке metadata теперь NULL - ответ и событие получают исходную
+                set_committed_value(notification, "event_metadata", notification_data.event_metadata)
         except Exception as e:
             await db.rollback()
+            if is_idempotency_conflict(e):
+                raise DuplicateNotificationError(notification_data.idempotency_key)
             raise
+        
+        publish_created(NotificationResponse.model_validate(notification))
+        return notification
     
     @staticmethod
-    async def get_notifications(
+    async def create_notifications(
         db: AsyncSession,
-        filters: NotificationFilter
-    ) -> tuple[List[Notification], int]:
-        """Получить список уведомлений с фильтрацией"""
+        notifications_data: List[NotificationCreate]
+    ) -> List[Union[int, Exception]]:
+        """
+        Массово создать уведомления в одной транзакции
+        
+        Вставка идет пачками через INSERT ... RETURNING (на PostgreSQL крупные пачки - через
+        COPY). Если пачка падает, ее строки повторяются по одной в savepoint, чтобы сбой
+        одной строки не отменял остальные.
+        Элементы с уже использованным ключом идемпотентности не вставляются.
+        Возвращает для каждого элемента id созданного уведомления или исключение.
+        """
         try:
-            query = select(Notification)
-            count_query = select(func.count(Notification.id))
-            
-            # Применяем фильтры
-            conditions = []
-            
-            if filters.type:
-                conditions.append(Notification.type == filters.type)
-            
-            if filters.user_id:
-                conditions.append(Notification.user_id == filters.user_id)
-            
-            if filters.status:
-                conditions.append(Notification.status == filters.status)
+            results, created = await NotificationService.insert_notifications(db, notifications_data)
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+        
+        for notification in created:
+            publish_created(notification)
+        return results
+    
+    @staticmethod
+    async def insert_notifications(
+        db: AsyncSession,
+        notifications_data: List[NotificationCreate]
+    ) -> tuple[List[Union[int, Exception]], List[NotificationResponse]]:
+        """
+        Вставка create_notifications без commit - для вызова внутри чужой транзакции
+        
+        Возвращает результаты по элементам и созданные уведомления: их событие живой
+        ленты публикует вызывающий после commit.
+        """
+        results: List[Union[int, Exception]] = []
+        seqs = {}
+        deltas = {}
+        labels = {}
+        timestamp = datetime.utcnow()
+        insert_stmt = insert(Notification).returning(Notification.id, sort_by_parameter_order=True)
+        use_copy = db.bind.dialect.name == "postgresql"
+        
+        seen_keys = set()
+        
+        for chunk in chunked(notifications_data):
+            # Дубликаты по ключу идемпотентности - одним запросом на пачку
+            seen_keys.update(await used_keys(db, [data.idempotency_key for data in chunk if data.idempotency_key]))
             
-            if filters.start_date:
-                conditions.append(Notification.timestamp >= filters.start_date)
+            duplicates = {}
+            fresh = []
+            for position, data in enumerate(chunk):
+                if data.idempotency_key and data.idempotency_key in seen_keys:
+                    duplicates[position] = DuplicateNotificationError(data.idempotency_key)
+                    continue
+                if data.idempotency_key:
+                    seen_keys.add(data.idempotency_key)
+                fresh.append(data)
             
-            if filters.end_date:
-                conditions.append(Notification.timestamp <= filters.end_date)
+            first_seq = await CounterService.reserve_seq(db, len(fresh)) if fresh else 0
+            hashes = await PayloadService.store(db, [data.event_metadata for data in fresh])
+            rows = [
+                {
+                    "type": data.type,
+                    "title": data.title,
+                    "description": data.description,
+                    "user_id": data.user_id,
+                    "user_name": data.user_name,
+                    "source": data.source,
+                    "details": data.details,
+                    "event_metadata": None if payload_hash else data.event_metadata,
+                    "payload_hash": payload_hash,
+                    "idempotency_key": data.idempotency_key,
+                    "status": NotificationStatus.UNREAD,
+                    "timestamp": timestamp,
+                    "change_seq": first_seq + position
+                }
+                for position, (data, payload_hash) in enumerate(zip(fresh, hashes))
+            ]
             
-            if conditions:
-                query = query.where(and_(*conditions))
-                count_query = count_query.where(and_(*conditions))
+            inserted: List[Union[int, Exception]] = []
+            if rows:
+                try:
+                    async with db.begin_nested():
+                        await claim_keys(db, [row["idempotency_key"] for row in rows if row["idempotency_key"]])
+                        if use_copy and len(rows) >= PG_COPY_MIN_ROWS:
+                            inserted = await NotificationService.copy_notifications(db, rows)
+                        else:
+                            result = await db.execute(insert_stmt, rows)
+                            inserted = list(result.scalars().all())
+                except Exception:
+                    for row in rows:
+                        try:
+                            async with db.begin_nested():
+                                if row["idempotency_key"]:
+                                    await claim_keys(db, [row["idempotency_key"]])
+                                result = await db.execute(insert_stmt, [row])
+                                inserted.append(result.scalar_one())
+                        except Exception as e:
+                            # Ключ успел занять параллельный запрос
+                            inserted.append(
+                                DuplicateNotificationError(row["idempotency_key"])
+                                if is_idempotency_conflict(e) else e
+                            )
             
-            # Сортировка по времени (новые сначала)
-            query = query.order_by(Notification.timestamp.desc())
+            created = []
+            for data, row, outcome in zip(fresh, rows, inserted):
+                if isinstance(outcome, Exception):
+                    continue
+                seqs[outcome] = row["change_seq"]
+                CounterService.track(deltas, data.user_id, data.type, timestamp, total=1, unread=1)
+                labels[data.user_id] = data.user_name
+                created.append(outbox_item(outcome, data))
+            await TelegramOutboxService.enqueue(db, created)
             
-            # Пагинация
-            query = query.offset(filters.offset).limit(filters.limit)
+            inserted_iter = iter(inserted)
+            results.extend(
+                duplicates[position] if position in duplicates else next(inserted_iter)
+                for position in range(len(chunk))
+            )
+        
+        await CounterService.apply(db, deltas, labels)
+        
+        created = [
+            NotificationResponse(
+                id=outcome,
+                status=NotificationStatus.UNREAD,
+                timestamp=timestamp,
+                change_seq=seqs[outcome],
+                **data.model_dump(exclude={"idempotency_key"})
+            )
+            for data, outcome in zip(notifications_data, results)
+            if not isinstance(outcome, Exception)
+        ]
+        return results, created
+    
+    @staticmethod
+    async def copy_notifications(db: AsyncSession, rows: List[dict]) -> List[int]:
+        """
+        Загрузить строки через COPY (только PostgreSQL + asyncpg)
+        
+        COPY не умеет RETURNING, поэтому id заранее берутся из последовательности
+        одним запросом. Возвращает id в порядке строк.
+        """
+        result = await db.execute(
+            text("SELECT nextval(pg_get_serial_sequence('notifications', 'id')) FROM generate_series(1, :count)"),
+            {"count": len(rows)}
+        )
+        ids = list(result.scalars().all())
+        
+        records = []
+        for notification_id, row in zip(ids, rows):
+            row = dict(row, id=notification_id)
+            # Enum хранится по имени, JSON кодек asyncpg-диалекта принимает строку
+            row["type"] = row["type"].name
+            row["status"] = row["status"].name
+            for field in ("details", "event_metadata"):
+                if row[field] is not None:
+                    row[field] = json.dumps(row[field])
+            records.append(tuple(row[field] for _, field in COPY_COLUMNS))
+        
+        connection = await db.connection()
+        raw_connection = await connection.get_raw_connection()
+        await raw_connection.driver_connection.copy_records_to_table(
+            Notification.__tablename__,
+            columns=[column for column, _ in COPY_COLUMNS],
+            records=records
+        )
+        return ids
+    
+    @staticmethod
+    def filter_conditions(filters: NotificationFilter) -> list:
+        """Условия WHERE по фильтрам списка (без пагинации)"""
+        conditions = []
+        
+        if filters.type:
+            conditions.append(Notification.type == filters.type)
+        
+        if filters.user_id:
+            conditions.append(Notification.user_id == filters.user_id)
+        
+        # IN по списку: индекс с этим полем первым читается отдельно по каждому значению
+        if filters.types:
+            conditions.append(Notification.type.in_(filters.types))
+        
+        if filters.user_ids:
+            conditions.append(Notification.user_id.in_(filters.user_ids))
+        
+        if filters.source:
+            conditions.append(Notification.source == filters.source)
+        
+        if filters.status:
+            conditions.append(Notification.status == filters.status)
+        
+        if filters.start_date:
+            conditions.append(Notification.timestamp >= filters.start_date)
+        
+        if filters.end_date:
+            conditions.append(Notification.timestamp <= filters.end_date)
+        
+        if filters.since_seq is not None:
+            conditions.append(Notification.change_seq > filters.since_seq)
+        
+        return conditions
+    
+    @staticmethod
+    def list_query(filters: NotificationFilter, *entities) -> tuple:
+        """SELECT списка по фильтрам (сущность или набор колонок) и условия для COUNT"""
+        # Поврежденный курсор - ошибка клиента, а не сервера
+        cursor_position = decode_cursor(filters.cursor) if filters.cursor else None
+        
+        query = select(*entities)
+        conditions = NotificationService.filter_conditions(filters)
+        
+        if conditions:
+            query = query.where(and_(*conditions))
+        
+        if filters.since_seq is not None:
+            # Дельта-синхронизация: изменения в порядке их номеров
+            query = query.order_by(Notification.change_seq).limit(filters.limit)
+        else:
+            # Сортировка по времени (новые сначала), id - для однозначного порядка
+            query = query.order_by(Notification.timestamp.desc(), Notification.id.desc())
             
+            # Пагинация: курсор (keyset) или offset для обратной совместимости
+            if cursor_position:
+                cursor_timestamp, cursor_id = cursor_position
+                # Лишнее на вид timestamp <= ? дает планировщику верхнюю границу диапазона
+                # индекса (вместе с start_date) и отсечение секций в PostgreSQL
+                query = query.where(
+                    Notification.timestamp <= cursor_timestamp,
+                    or_(
+                        Notification.timestamp < cursor_timestamp,
+                        and_(Notification.timestamp == cursor_timestamp, Notification.id < cursor_id)
+                    )
+                )
+                query = query.limit(filters.limit)
+            else:
+                query = query.offset(filters.offset).limit(filters.limit)
+        
+        return query, conditions
+    
+    @staticmethod
+    async def get_notifications(
+        db: AsyncSession,
+        filters: NotificationFilter
+    ) -> tuple[List[Notification], Optional[int]]:
+        """
+        Получить список уведомлений с фильтрацией
+        
+        total - по filters.include_total: None (не считать), точный COUNT или оценка по счетчикам.
+        """
+        query, conditions = NotificationService.list_query(filters, Notification)
+        
+        try:
             # Выполняем запросы
             result = await db.execute(query)
-            notifications = result.scalars().all()
+            notifications = list(result.scalars().all())
+            await PayloadService.hydrate(db, notifications)
             
-            count_result = await db.execute(count_query)
-            total = count_result.scalar() or 0
+            total = None
+            if filters.include_total != TotalMode.NONE:
+                total = await NotificationService.count_notifications(db, filters, conditions)
             
-            return list(notifications), total
+            return notifications, total
         except Exception as e:
             # Логируем ошибку для отладки
             print(f"Ошибка при получении уведомлений: {e}")
@@ -98,16 +998,124 @@ class NotificationService:
             traceback.print_exc()
             raise
     
+    @staticmethod
+    def row_columns(filters: NotificationFilter) -> tuple[tuple, list]:
+        """Поля ответа по filters.view / filters.fields и колонки, которые для них читаются"""
+        fields = resolve_fields(filters.view, filters.fields)
+        columns = [FIELD_COLUMNS[name] for name in fields]
+        # metadata может лежать в notification_payloads - нужен и хэш
+        if "metadata" in fields:
+            columns.append(Notification.payload_hash)
+        return fields, columns
+    
+    @staticmethod
+    async def load_rows(db: AsyncSession, query, fields: tuple) -> List[dict]:
+        """Выполнить запрос колонок row_columns и собрать dict ответа (с metadata из notification_payloads)"""
+        with_payloads = "metadata" in fields
+        result = await db.execute(query)
+        rows = []
+        offloaded = []
+        for row in result.all():
+            notification = row_to_response(row, fields)
+            if notification is None:
+                continue
+            rows.append(notification)
+            if with_payloads and row[-1] and notification["metadata"] is None:
+                offloaded.append((notification, row[-1]))
+        
+        if offloaded:
+            payloads = await PayloadService.load(db, [payload_hash for _, payload_hash in offloaded])
+            for notification, payload_hash in offloaded:
+                notification["metadata"] = payloads.get(payload_hash)
+        return rows
+    
+    @staticmethod
+    async def get_notification_rows(
+        db: AsyncSession,
+        filters: NotificationFilter
+    ) -> tuple[List[dict], Optional[int]]:
+        """
+        Список уведомлений как dict в формате NotificationResponse
+        
+        Быстрый путь для API: читаются только колонки запрошенных полей
+        (filters.view / filters.fields) кортежами, без ORM-объектов и моделей
+        Pydantic на каждую строку.
+        """
+        fields, columns = NotificationService.row_columns(filters)
+        query, conditions = NotificationService.list_query(filters, *columns)
+        
+        try:
+            rows = await NotificationService.load_rows(db, query, fields)
+            
+            total = None
+            if filters.include_total != TotalMode.NONE:
+                total = await NotificationService.count_notifications(db, filters, conditions)
+            
+            return rows, total
+        except Exception as e:
+            print(f"Ошибка при получении уведомлений: {e}")
+            raise
+    
+    @staticmethod
+    async def count_notifications(db: AsyncSession, filters: NotificationFilter, conditions: list) -> int:
+        """Total для списка: оценка по счетчикам или COUNT через кэш"""
+        if filters.include_total == TotalMode.ESTIMATE:
+            estimate = await CounterService.estimate_total(db, filters)
+            if estimate is not None:
+                return estimate
+        
+        async def count() -> int:
+            count_query = select(func.count(Notification.id))
+            if conditions:
+                count_query = count_query.where(and_(*conditions))
+            return (await db.execute(count_query)).scalar() or 0
+        
+        # Номер изменения в ключе: COUNT до записи не попадет в страницу после нее,
+        # даже если инвалидация (из другого воркера) еще не дошла
+        seq = await CounterService.current_seq(db)
+        tag = feed_tag(filters.user_id, filters.type.value if filters.type else None)
+        return await query_cache.get_or_load(
+            "count", f"{seq}|{filter_signature(filters, COUNT_FIELDS)}", [tag], count, ttl=COUNT_CACHE_TTL
+        )
+    
+    @staticmethod
+    async def get_changes_after(
+        db: AsyncSession,
+        after_seq: int,
+        user_ids: Optional[List[str]] = None,
+        types: Optional[List[NotificationType]] = None,
+        limit: int = 500
+    ) -> List[Notification]:
+        """
+        Уведомления, созданные или измененные после after_seq, в порядке изменений
+        (догон живой ленты по Last-Event-ID)
+        
+        Номер изменения выдается под блокировкой строки счетчика и растет в порядке
+        коммитов, в отличие от id: строка, закоммиченная позже с меньшим id, не пропадет.
+        """
+        query = select(Notification).where(Notification.change_seq > after_seq)
+        if user_ids:
+            query = query.where(Notification.user_id.in_(user_ids))
+        if types:
+            query = query.where(Notification.type.in_(types))
+        result = await db.execute(query.order_by(Notification.change_seq).limit(limit))
+        notifications = list(result.scalars().all())
+        await PayloadService.hydrate(db, notifications)
+        return notifications
+    
     @staticmethod
     async def get_notification(
         db: AsyncSession,
         notification_id: int
     ) -> Optional[Notification]:
-        """Получить уведомление по ID"""
+        """Получить уведомление по ID (вместе с metadata из notification_payloads)"""
         result = await db.execute(
             select(Notification).where(Notification.id == notification_id)
         )
-        return result.scalar_one_or_none()
+        notification = result.scalar_one_or_none()
+        if notification:
+            await PayloadService.hydrate(db, [notification])
+        return notification
     
     @staticmethod
     async def update_notification(
@@ -121,14 +1129,34 @@ class NotificationService:
         if not notification:
             return None
         
+        status_changed = False
         if update_data.read is not None:
-            notification.status = (
+            new_status = (
                 NotificationStatus.READ if update_data.read 
                 else NotificationStatus.UNREAD
             )
+            status_changed = new_status != notification.status
+            if status_changed:
+                deltas = {}
+                CounterService.track(
+                    deltas, notification.user_id, notification.type, notification.timestamp,
+                    unread=1 if new_status == NotificationStatus.UNREAD else -1
+                )
+                await CounterService.apply(db, deltas)
+                notification.change_seq = await CounterService.reserve_seq(db)
+            notification.status = new_status
         
+        metadata = notification.event_metadata
         await db.commit()
         await db.refresh(notification)
+        if notification.payload_hash:
+            set_committed_value(notification, "event_metadata", metadata)
+        
+        if status_changed:
+            publish_status(
+                notification.id, notification.user_id, notification.type,
+                notification.status, notification.change_seq
+            )
         return notification
     
     @staticmethod
@@ -143,82 +1171,868 @@ class NotificationService:
             NotificationUpdate(read=True)
         )
     
+    @staticmethod
+    async def assign_change_seqs(db: AsyncSession, notification_ids: List[int]) -> dict:
+        """Выдать изменённым строкам новые номера изменений (executemany по первичному ключу)"""
+        if not notification_ids:
+            return {}
+        first_seq = await CounterService.reserve_seq(db, len(notification_ids))
+        seqs = {notification_id: first_seq + n for n, notification_id in enumerate(notification_ids)}
+        await update_by_id(db, [
+            {"id": notification_id, "change_seq": seq} for notification_id, seq in seqs.items()
+        ])
+        return seqs
+    
+    @staticmethod
+    async def mark_many_as_read(
+        db: AsyncSession,
+        notification_ids: List[int]
+    ) -> tuple[List[int], List[int]]:
+        """
+        Отметить несколько уведомлений прочитанными одной транзакцией
+        
+        Возвращает (updated, not_found). Уже прочитанные уведомления попадают в updated.
+        """
+        requested = list(dict.fromkeys(notification_ids))
+        found = set()
+        changed = []
+        deltas = {}
+        
+        try:
+            for chunk in chunked(requested):
+                result = await db.execute(
+                    update(Notification)
+                    .where(Notification.id.in_(chunk), Notification.status == NotificationStatus.UNREAD)
+                    .values(status=NotificationStatus.READ)
+                    .returning(Notification.id, Notification.user_id, Notification.type, Notification.timestamp)
+                )
+                for notification_id, user_id, notification_type, timestamp in result.fetchall():
+                    found.add(notification_id)
+                    changed.append((notification_id, user_id, notification_type))
+                    CounterService.track(deltas, user_id, notification_type, timestamp, unread=-1)
+                
+                # Оставшиеся id - либо уже прочитаны, либо не существуют
+                rest = [i for i in chunk if i not in found]
+                if rest:
+                    existing = await db.execute(select(Notification.id).where(Notification.id.in_(rest)))
+                    found.update(existing.scalars().all())
+            
+            seqs = await NotificationService.assign_change_seqs(db, [row[0] for row in changed])
+            await CounterService.apply(db, deltas)
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+        
+        for notification_id, user_id, notification_type in changed:
+            publish_status(notification_id, user_id, notification_type, NotificationStatus.READ, seqs[notification_id])
+        
+        updated = [i for i in requested if i in found]
+        not_found = [i for i in requested if i not in found]
+        return updated, not_found
+    
+    @staticmethod
+    async def mark_all_as_read(
+        db: AsyncSession,
+        user_id: str,
+        before: Optional[datetime] = None
+    ) -> int:
+        """Отметить прочитанными все уведомления пользователя (до момента before); возвращает количество"""
+        conditions = [
+            Notification.user_id == user_id,
+            Notification.status == NotificationStatus.UNREAD
+        ]
+        if before:
+            conditions.append(Notification.timestamp <= before)
+        
+        try:
+            result = await db.execute(
+                update(Notification)
+                .where(and_(*conditions))
+                .values(status=NotificationStatus.READ)
+                .returning(Notification.id, Notification.type, Notification.timestamp)
+            )
+            rows = result.fetchall()
+            
+            deltas = {}
+            for notification_id, notification_type, timestamp in rows:
+                CounterService.track(deltas, user_id, notification_type, timestamp, unread=-1)
+            seqs = await NotificationService.assign_change_seqs(db, [row[0] for row in rows])
+            await CounterService.apply(db, deltas)
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+        
+        for notification_id, notification_type, timestamp in rows:
+            publish_status(notification_id, user_id, notification_type, NotificationStatus.READ, seqs[notification_id])
+        return len(rows)
+    
+    @staticmethod
+    async def delete_notifications(db: AsyncSession, notification_ids: List[int]) -> int:
+        """
+        Удалить уведомления одной транзакцией; возвращает количество удаленных
+        
+        Счетчики статистики уменьшаются, обнулившиеся строки счетчиков и payload,
+        на которые больше никто не ссылается, удаляются. Номер изменений растет,
+        чтобы ETag списков сменился.
+        """
+        deleted = []
+        try:
+            for chunk in chunked(notification_ids):
+                result = await db.execute(
+                    delete(Notification)
+                    .where(Notification.id.in_(chunk))
+                    .returning(
+                        Notification.id, Notification.user_id, Notification.type, Notification.timestamp,
+                        Notification.status, Notification.payload_hash, Notification.idempotency_key
+                    )
+                )
+                deleted.extend(result.fetchall())
+            if not deleted:
+                await db.rollback()
+                return 0
+            
+            deltas = {}
+            for _, user_id, notification_type, timestamp, status, _, _ in deleted:
+                CounterService.track(
+                    deltas, user_id, notification_type, timestamp,
+                    total=-1, unread=-1 if status == NotificationStatus.UNREAD else 0
+                )
+            await NotificationService.release_deleted(
+                db, deltas,
+                payload_hashes=[row[5] for row in deleted if row[5]],
+                keys=[row[6] for row in deleted if row[6]]
+            )
+            for chunk in chunked([row[0] for row in deleted]):
+                await db.execute(delete(NotificationRollupKey).where(NotificationRollupKey.notification_id.in_(chunk)))
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+        
+        tags = set()
+        for notification_id, user_id, notification_type, _, _, _, _ in deleted:
+            tags.update(event_tags({
+                "id": notification_id, "user_id": user_id, "type": NotificationType(notification_type).value
+            }))
+        query_cache.invalidate(list(tags))
+        return len(deleted)
+    
+    @staticmethod
+    async def release_deleted(
+        db: AsyncSession,
+        deltas: dict,
+        payload_hashes: List[str],
+        keys: List[str],
+        still_used=None
+    ) -> None:
+        """
+        Прибрать за удаленными уведомлениями (без commit)
+        
+        Уменьшает счетчики на deltas и удаляет обнулившиеся строки счетчиков, payload без
+        ссылок (still_used - дополнительное условие на ссылающиеся строки notifications),
+        ключи идемпотентности секционированной таблицы; сдвигает номер изменений.
+        Ключи событий, сложенных в удаленные сводки, освобождает вызывающий.
+        """
+        await CounterService.apply(db, deltas)
+        await db.execute(
+            delete(NotificationCounter)
+            .where(NotificationCounter.scope.in_(COUNTER_SCOPES), NotificationCounter.total <= 0)
+        )
+        
+        for chunk in chunked(list(set(payload_hashes))):
+            referenced = select(Notification.id).where(Notification.payload_hash == NotificationPayload.hash)
+            if still_used is not None:
+                referenced = referenced.where(still_used)
+            await db.execute(
+                delete(NotificationPayload)
+                .where(NotificationPayload.hash.in_(chunk), ~referenced.exists())
+            )
+        
+        if NOTIFICATIONS_PARTITIONED:
+            for chunk in chunked(keys):
+                await db.execute(delete(NotificationKey).where(NotificationKey.idempotency_key.in_(chunk)))
+        
+        await CounterService.reserve_seq(db)
+    
+    @staticmethod
+    async def drop_partition(db: AsyncSession, month) -> int:
+        """
+        Удалить месячную секцию notifications целиком (DROP вместо DELETE); возвращает число строк
+        
+        Счетчики уменьшаются по агрегатам секции, payload и ключи ее уведомлений
+        освобождаются, как в delete_notifications. Секция отсоединяется и удаляется
+        в конце транзакции - блокировка таблицы держится только до commit.
+        """
+        table = partition_name(month)
+        month_start = datetime(month.year, month.month, 1)
+        month_end = datetime.combine(add_months(month, 1), datetime.min.time())
+        try:
+            result = await db.execute(text(
+                f"SELECT user_id, type, CAST(timestamp AS DATE), COUNT(*), "
+                f"SUM(CASE WHEN status = 'UNREAD' THEN 1 ELSE 0 END) "
+                f"FROM {table} GROUP BY user_id, type, CAST(timestamp AS DATE)"
+            ))
+            deltas = {}
+            pairs = set()
+            rows = 0
+            for user_id, type_name, day, total, unread in result.fetchall():
+                notification_type = NotificationType[type_name]
+                for key in CounterService.counter_keys(user_id, notification_type, day.isoformat()):
+                    delta = deltas.setdefault(key, [0, 0])
+                    delta[0] -= total
+                    delta[1] -= unread
+                pairs.add((user_id, notification_type.value))
+                rows += total
+            
+            payload_hashes = (await db.execute(text(
+                f"SELECT DISTINCT payload_hash FROM {table} WHERE payload_hash IS NOT NULL"
+            ))).scalars().all()
+            keys = (await db.execute(text(
+                f"SELECT idempotency_key FROM {table} WHERE idempotency_key IS NOT NULL"
+            ))).scalars().all()
+            # Ссылки из других месяцев (секция этого месяца отсекается по timestamp)
+            outside = or_(Notification.timestamp < month_start, Notification.timestamp >= month_end)
+            await NotificationService.release_deleted(db, deltas, list(payload_hashes), list(keys), outside)
+            await db.execute(text(
+                f"DELETE FROM notification_rollup_keys WHERE notification_id IN (SELECT id FROM {table})"
+            ))
+            
+            await db.execute(text(f"ALTER TABLE notifications DETACH PARTITION {table}"))
+            await db.execute(text(f"DROP TABLE {table}"))
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+        
+        # Кэш уведомлений по id из этой секции доживет до своего TTL
+        tags = set()
+        for user_id, type_value in pairs:
+            tags.update(event_tags({"user_id": user_id, "type": type_value}))
+        query_cache.invalidate(list(tags))
+        return rows
+    
     @staticmethod
     async def get_stats(
         db: AsyncSession,
         user_id: Optional[str] = None
     ) -> StatsResponse:
-        """Получить статистику уведомлений"""
-        # Общее количество
-        total_query = select(func.count(Notification.id))
-        if user_id:
-            total_query = total_query.where(Notification.user_id == user_id)
-        total_result = await db.execute(total_query)
-        total = total_result.scalar() or 0
+        """Получить статистику уведомлений из предрассчитанных счетчиков"""
+        today = datetime.utcnow().date().isoformat()
+        type_values = [t.value for t in NotificationType]
         
-        # Непрочитанные
-        unread_query = select(func.count(Notification.id)).where(
-            Notification.status == NotificationStatus.UNREAD
-        )
-        if user_id:
-            unread_query = unread_query.where(Notification.user_id == user_id)
-        unread_result = await db.execute(unread_query)
-        unread = unread_result.scalar() or 0
-        
-        # Сегодня
-        today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-        today_query = select(func.count(Notification.id)).where(
-            Notification.timestamp >= today_start
-        )
         if user_id:
-            today_query = today_query.where(Notification.user_id == user_id)
-        today_result = await db.execute(today_query)
-        today = today_result.scalar() or 0
-        
-        # По типам
-        type_query = select(
-            Notification.type,
-            func.count(Notification.id).label('count')
+            totals_key = ("user", user_id)
+            today_key = ("user_day", f"{user_id}|{today}")
+            type_scope, type_keys = "user_type", [f"{user_id}|{t}" for t in type_values]
+        else:
+            totals_key = ("global", "")
+            today_key = ("day", today)
+            type_scope, type_keys = "type", type_values
+        
+        # Все точечные счетчики - одним запросом по первичному ключу
+        result = await db.execute(
+            select(NotificationCounter).where(or_(
+                and_(NotificationCounter.scope == totals_key[0], NotificationCounter.key == totals_key[1]),
+                and_(NotificationCounter.scope == today_key[0], NotificationCounter.key == today_key[1]),
+                and_(NotificationCounter.scope == type_scope, NotificationCounter.key.in_(type_keys))
+            ))
         )
-        if user_id:
-            type_query = type_query.where(Notification.user_id == user_id)
-        type_query = type_query.group_by(Notification.type)
-        type_result = await db.execute(type_query)
-        by_type = {row[0].value: row[1] for row in type_result.fetchall()}
+        counters = {(c.scope, c.key): c for c in result.scalars().all()}
+        
+        totals = counters.get(totals_key)
+        today_counter = counters.get(today_key)
+        by_type = {}
+        for type_value, key in zip(type_values, type_keys):
+            counter = counters.get((type_scope, key))
+            if counter and counter.total > 0:
+                by_type[type_value] = counter.total
         
         # По пользователям (топ 10)
-        user_query = select(
-            Notification.user_id,
-            Notification.user_name,
-            func.count(Notification.id).label('count')
-        )
         if user_id:
-            user_query = user_query.where(Notification.user_id == user_id)
-        user_query = user_query.group_by(Notification.user_id, Notification.user_name)
-        user_query = user_query.order_by(func.count(Notification.id).desc())
-        user_query = user_query.limit(10)
-        user_result = await db.execute(user_query)
-        by_user = {
-            row[1]: row[2] for row in user_result.fetchall()
-        }
+            by_user = {totals.label: totals.total} if totals and totals.total > 0 else {}
+        else:
+            user_result = await db.execute(
+                select(NotificationCounter.label, NotificationCounter.total)
+                .where(NotificationCounter.scope == "user", NotificationCounter.total > 0)
+                .order_by(NotificationCounter.total.desc())
+                .limit(10)
+            )
+            by_user = {row[0]: row[1] for row in user_result.fetchall()}
         
         return StatsResponse(
-            total=total,
-            unread=unread,
-            today=today,
+            total=totals.total if totals else 0,
+            unread=totals.unread if totals else 0,
+            today=today_counter.total if today_counter else 0,
             by_type=by_type,
             by_user=by_user
         )
 
+class CachedNotificationService:
+    """
+    Чтения через кэш запросов (cache.query_cache)
+    
+    Возвращает модели ответа или готовые dict, а не ORM-объекты: их безопасно
+    отдавать нескольким запросам и класть в общее хранилище кэша. Кэшируются
+    первые страницы списков, уведомления по id и статистика; инвалидация - по
+    событиям broadcaster.
+    
+    Ключ списков и статистики включает номер последнего изменения (seq), из которого
+    строится их ETag: событие об изменении приходит после коммита, а в других
+    воркерах - еще позже, и без seq в ключе ответ с новым ETag мог бы отдать страницу
+    до записи, после чего клиент получал бы 304 на устаревших данных.
+    """
+    
+    LIST_FIELDS = COUNT_FIELDS | {"limit", "include_total", "view", "fields"}
+    
+    @staticmethod
+    async def get_notifications(
+        db: AsyncSession,
+        filters: NotificationFilter,
+        seq: Optional[int] = None
+    ) -> tuple[List[dict], Optional[int]]:
+        """
+        Список уведомлений (dict для быстрой сериализации); глубокие страницы и since_seq - мимо кэша
+        
+        seq - номер изменения, прочитанный этой же сессией до запроса (для ETag).
+        """
+        async def load():
+            return await NotificationService.get_notification_rows(db, filters)
+        
+        if filters.cursor or filters.offset or filters.since_seq is not None:
+            return await load()
+        
+        if seq is None:
+            seq = await CounterService.current_seq(db)
+        tag = feed_tag(filters.user_id, filters.type.value if filters.type else None)
+        return await query_cache.get_or_load(
+            "list", f"{seq}|{filter_signature(filters, CachedNotificationService.LIST_FIELDS)}", [tag], load
+        )
+    
+    @staticmethod
+    async def get_notification(db: AsyncSession, notification_id: int) -> Optional[NotificationResponse]:
+        """Уведомление по ID"""
+        async def load():
+            notification = await NotificationService.get_notification(db, notification_id)
+            return NotificationResponse.model_validate(notification) if notification else None
+        
+        return await query_cache.get_or_load(
+            "notification", str(notification_id), [f"notification:{notification_id}"], load
+        )
+    
+    @staticmethod
+    async def get_stats(
+        db: AsyncSession,
+        user_id: Optional[str] = None,
+        seq: Optional[int] = None
+    ) -> StatsResponse:
+        """Статистика; дата в ключе - "сегодня" сменится в полночь"""
+        if seq is None:
+            seq = await CounterService.current_seq(db)
+        today = datetime.utcnow().date().isoformat()
+        return await query_cache.get_or_load(
+            "stats", f"{seq}|{user_id or ''}|{today}", [f"stats:{user_id or '*'}"],
+            lambda: NotificationService.get_stats(db, user_id)
+        )
+
+class SearchService:
+    """
+    Полнотекстовый поиск по title и description
+    
+    SQLite - FTS5 (notifications_fts), ранжирование bm25; PostgreSQL - search_vector
+    с морфологией SEARCH_LANGUAGE и GIN-индексом, ранжирование ts_rank_cd. Каждое слово
+    запроса ищется как префикс, найденным должно быть каждое. Индекс поддерживает сама БД
+    (см. ensure_search_index в database.py).
+    
+    Если совпадений больше SEARCH_RANK_WINDOW, а фильтров нет, по релевантности
+    упорядочиваются только самые новые из них (окно растет кратно, чтобы вместить
+    страницу): релевантность по сотням тысяч строк с частым словом стоит секунды, а старые
+    совпадения находит уточнение запроса или периода. total считает все совпадения.
+    """
+    
+    @staticmethod
+    def terms(q: str) -> List[str]:
+        """Слова запроса: буквы и цифры в нижнем регистре, без повторов и однобуквенных"""
+        words = [word for word in SEARCH_WORD_RE.findall(q.lower()) if len(word) > 1 or word.isdigit()]
+        return list(dict.fromkeys(words))[:SEARCH_MAX_TERMS]
+    
+    @staticmethod
+    def stem(term: str) -> str:
+        """
+        Основа русского слова для префиксного поиска в SQLite: без типичного окончания
+        
+        FTS5 не знает русской морфологии; "сделки" как префикс не нашло бы "сделка",
+        а "сделк" находит все формы. Основа не короче трех букв.
+        """
+        if CYRILLIC_WORD_RE.fullmatch(term):
+            ending = RUSSIAN_ENDING_RE.search(term)
+            if ending and ending.start() >= 3:
+                return term[:ending.start()]
+        return term
+    
+    @staticmethod
+    def match(db: AsyncSession, terms: List[str]) -> tuple:
+        """
+        Поиск для диалекта сессии: (условие на notifications, FROM ранжирования,
+        условие совпадения в нем, порядок по релевантности, id строки в нем)
+        
+        В SQLite bm25 доступна только в запросе с MATCH по FTS-таблице, поэтому ранжирование
+        идет через JOIN, а COUNT - через notifications.id IN (...): с JOIN и фильтром по
+        пользователю SQLite выбирает индекс notifications и повторяет полнотекстовый поиск
+        на каждой строке, а подзапрос IN выполняется один раз.
+        """
+        if db.bind.dialect.name == "postgresql":
+            vector = literal_column("notifications.search_vector")
+            tsquery = func.to_tsquery(
+                literal_column(f"'{SEARCH_LANGUAGE}'::regconfig"),
+                " & ".join(f"{term}:*" for term in terms)
+            )
+            found = vector.op("@@")(tsquery)
+            return found, Notification.__table__, found, func.ts_rank_cd(vector, tsquery).desc(), Notification.id
+        
+        fts = table("notifications_fts", column("rowid"))
+        fts_query = " ".join(f'"{SearchService.stem(term)}"*' for term in terms)
+        fts_match = literal_column("notifications_fts").op("MATCH")(fts_query)
+        # Колонки: title весит вдвое больше description; у bm25 меньше - лучше.
+        # Ограничение на rowid FTS5 применяет сама, не читая лишние строки notifications
+        return (
+            Notification.id.in_(select(fts.c.rowid).where(fts_match)),
+            fts.join(Notification, Notification.id == fts.c.rowid),
+            fts_match,
+            func.bm25(literal_column("notifications_fts"), 2.0, 1.0),
+            fts.c.rowid
+        )
+    
+    @staticmethod
+    async def search(
+        db: AsyncSession,
+        q: str,
+        filters: NotificationFilter
+    ) -> tuple[List[dict], Optional[int]]:
+        """
+        Найти уведомления: сначала самые релевантные, при равенстве - новые
+        
+        Фильтры, поля ответа и limit/offset - как у списка (курсор и since_seq не
+        используются). total - только при filters.include_total != false.
+        ValueError, если в запросе нет слов.
+        """
+        terms = SearchService.terms(q)
+        if not terms:
+            raise ValueError("Пустой поисковый запрос")
+        
+        fields, columns = NotificationService.row_columns(filters)
+        found, source, match, rank, row_id = SearchService.match(db, terms)
+        filter_by = NotificationService.filter_conditions(filters)
+        conditions = [found, *filter_by]
+        
+        ranked = [match, *filter_by]
+        # С фильтрами окно не помогает: время уходит на проверку фильтра у каждого
+        # совпадения, а граница окна стоила бы столько же
+        if SEARCH_RANK_WINDOW > 0 and not filter_by:
+            # Окно кратно SEARCH_RANK_WINDOW - соседние страницы ранжируются по одному окну
+            window = ((filters.offset + filters.limit - 1) // SEARCH_RANK_WINDOW + 1) * SEARCH_RANK_WINDOW
+            # Граница окна - id самого старого из window новейших совпадений (без ранжирования)
+            oldest = (await db.execute(
+                select(row_id).where(match).order_by(row_id.desc()).offset(window - 1).limit(1)
+            )).scalar()
+            if oldest is not None:
+                ranked.append(row_id >= oldest)
+        
+        query = (
+            select(*columns).select_from(source).where(and_(*ranked))
+            .order_by(rank, Notification.timestamp.desc(), Notification.id.desc())
+            .offset(filters.offset).limit(filters.limit)
+        )
+        rows = await NotificationService.load_rows(db, query, fields)
+        
+        total = None
+        if filters.include_total != TotalMode.NONE:
+            total = (await db.execute(
+                select(func.count()).select_from(Notification).where(and_(*conditions))
+            )).scalar()
+        return rows, total
+
+class RollupService:
+    """
+    Сводки однотипных событий (notification_rollups)
+    
+    При массовых правках в Airtable один пользователь порождает тысячи почти одинаковых
+    событий. События типов ROLLUP_TYPES одного пользователя по одной таблице, идущие с
+    паузами не длиннее ROLLUP_WINDOW_SECONDS, складываются в одно уведомление со счетчиком
+    и первыми ROLLUP_SAMPLE_SIZE record_id. Сводка обновляется на месте (новый change_seq,
+    событие updated живой ленты), пока она не прочитана и не старше ROLLUP_MAX_SECONDS.
+    """
+    
+    @staticmethod
+    def key(data: NotificationCreate) -> Optional[tuple]:
+        """Ключ сводки (user_id, type, table_id) или None, если событие не складывается"""
+        if ROLLUP_WINDOW_SECONDS <= 0 or data.type.value not in ROLLUP_TYPES:
+            return None
+        table_id = (data.details or {}).get("table_id")
+        return (data.user_id, data.type, table_id) if table_id else None
+    
+    @staticmethod
+    def sample(record_ids: List[str], events: List[NotificationCreate]) -> List[str]:
+        """Дополнить выборку record_id записями событий (без повторов, не больше ROLLUP_SAMPLE_SIZE)"""
+        merged = list(record_ids)
+        for data in events:
+            record_id = (data.details or {}).get("record_id")
+            if len(merged) >= ROLLUP_SAMPLE_SIZE:
+                break
+            if record_id and record_id not in merged:
+                merged.append(record_id)
+        return merged
+    
+    @staticmethod
+    def render(data: NotificationCreate, count: int, record_ids: List[str]) -> dict:
+        """title, description и details сводки по ее последнему событию"""
+        title, label = ROLLUP_LABELS[data.type]
+        details = {
+            key: value for key, value in (data.details or {}).items()
+            if key not in ("record_id", "change_count")
+        }
+        details["rollup_count"] = count
+        details["record_ids"] = record_ids
+        return {
+            "title": title,
+            "description": f'{label}: {count} в таблице "{details.get("table_name", "Unknown")}"',
+            "details": details
+        }
+    
+    @staticmethod
+    async def open_rollups(db: AsyncSession, keys: List[tuple], now: datetime) -> dict:
+        """Сводки, в которые еще можно складывать: окно не истекло, уведомление есть и не прочитано"""
+        found = {}
+        # Три параметра на ключ
+        for chunk in chunked(keys, BULK_CHUNK_SIZE // 3):
+            result = await db.execute(
+                select(NotificationRollup)
+                .join(Notification, Notification.id == NotificationRollup.notification_id)
+                .where(
+                    tuple_(NotificationRollup.user_id, NotificationRollup.type, NotificationRollup.table_id).in_(chunk),
+                    NotificationRollup.updated_at >= now - timedelta(seconds=ROLLUP_WINDOW_SECONDS),
+                    NotificationRollup.started_at >= now - timedelta(seconds=ROLLUP_MAX_SECONDS),
+                    Notification.status == NotificationStatus.UNREAD
+                )
+                # PostgreSQL: параллельный писатель дождется и увидит новый счетчик
+                .with_for_update(of=NotificationRollup)
+            )
+            for rollup in result.scalars().all():
+                found[(rollup.user_id, rollup.type, rollup.table_id)] = rollup
+        return found
+    
+    @staticmethod
+    async def claim_keys(db: AsyncSession, rows: List[dict]) -> set:
+        """
+        Занять ключи сложенных событий в notification_rollup_keys (без commit)
+        
+        Возвращает занятые ключи. Ключ, который уже занят (в том числе параллельной
+        транзакцией с тем же событием), не возвращается - событие считается повтором.
+        """
+        claimed = set()
+        for chunk in chunked(rows, BULK_CHUNK_SIZE // 2):
+            stmt = (
+                upsert_dialect(db).insert(NotificationRollupKey).values(chunk)
+                .on_conflict_do_nothing(index_elements=[NotificationRollupKey.idempotency_key])
+                .returning(NotificationRollupKey.idempotency_key)
+            )
+            claimed.update((await db.execute(stmt)).scalars().all())
+        return claimed
+    
+    @staticmethod
+    async def create_notifications(
+        db: AsyncSession,
+        notifications_data: List[NotificationCreate]
+    ) -> List[Union[int, Exception]]:
+        """
+        Создать уведомления, складывая подходящие события в сводки
+        
+        Результат - как у NotificationService.create_notifications; для сложенного
+        события - id сводки. Ключ события, создавшего уведомление сводки, хранится в
+        самом уведомлении, ключи остальных сложенных событий - в notification_rollup_keys:
+        повтор любого из них (после перезапуска или в другом воркере) - дубликат.
+        Ключи, сводки и уведомления пишутся одной транзакцией.
+        """
+        groups = {}
+        for position, data in enumerate(notifications_data):
+            key = RollupService.key(data)
+            if key:
+                groups.setdefault(key, []).append(position)
+        if not groups:
+            return await NotificationService.create_notifications(db, notifications_data)
+        
+        results: List[Union[int, Exception, None]] = [None] * len(notifications_data)
+        now = datetime.utcnow()
+        updates = []
+        created = []
+        try:
+            # Повторы уже принятых событий - дубликаты, как и без сводок
+            used = await used_keys(db, [
+                notifications_data[position].idempotency_key
+                for positions in groups.values() for position in positions
+                if notifications_data[position].idempotency_key
+            ])
+            for key in list(groups):
+                fresh = []
+                for position in groups[key]:
+                    idempotency_key = notifications_data[position].idempotency_key
+                    if idempotency_key in used:
+                        results[position] = DuplicateNotificationError(idempotency_key)
+                        continue
+                    if idempotency_key:
+                        used.add(idempotency_key)
+                    fresh.append(position)
+                if fresh:
+                    groups[key] = fresh
+                else:
+                    del groups[key]
+            
+            # Ключи сложенных событий занимаются до сложения: событие, которое параллельно
+            # принимает другой воркер, попадет в счетчик только один раз
+            open_rollups = await RollupService.open_rollups(db, list(groups), now)
+            claims = []
+            for key, positions in groups.items():
+                rollup = open_rollups.get(key)
+                for position in positions if rollup else positions[1:]:
+                    idempotency_key = notifications_data[position].idempotency_key
+                    if idempotency_key:
+                        claims.append({
+                            "idempotency_key": idempotency_key,
+                            "notification_id": rollup.notification_id if rollup else None,
+                            "created_at": now
+                        })
+            claimed = await RollupService.claim_keys(db, claims) if claims else set()
+            for key in list(groups):
+                kept = []
+                for n, position in enumerate(groups[key]):
+                    idempotency_key = notifications_data[position].idempotency_key
+                    owner = n == 0 and key not in open_rollups
+                    if idempotency_key and not owner and idempotency_key not in claimed:
+                        results[position] = DuplicateNotificationError(idempotency_key)
+                    else:
+                        kept.append(position)
+                if kept:
+                    groups[key] = kept
+                else:
+                    del groups[key]
+            
+            # Открытые сводки дополняются на месте
+            for key, rollup in open_rollups.items():
+                if key not in groups:
+                    continue
+                positions = groups.pop(key)
+                events = [notifications_data[position] for position in positions]
+                rollup.event_count += len(events)
+                rollup.record_ids = RollupService.sample(rollup.record_ids, events)
+                rollup.updated_at = now
+                updates.append((
+                    rollup.notification_id, rollup.user_id, rollup.type,
+                    RollupService.render(events[-1], rollup.event_count, rollup.record_ids)
+                ))
+                for position in positions:
+                    results[position] = rollup.notification_id
+            if updates:
+                first_seq = await CounterService.reserve_seq(db, len(updates))
+                await update_by_id(db, [
+                    {"id": notification_id, "change_seq": first_seq + n, **changes}
+                    for n, (notification_id, _, _, changes) in enumerate(updates)
+                ])
+            
+            # Без открытой сводки первое событие ключа создает уведомление, остальные из пачки - сразу в нем
+            batch, owners = [], []
+            for position, data in enumerate(notifications_data):
+                key = RollupService.key(data)
+                if results[position] is not None or (key and groups[key][0] != position):
+                    continue
+                positions = groups[key] if key else [position]
+                if len(positions) > 1:
+                    events = [notifications_data[p] for p in positions]
+                    data = data.model_copy(update=RollupService.render(
+                        events[-1], len(events), RollupService.sample([], events)
+                    ))
+                batch.append(data)
+                owners.append(positions)
+            
+            outcomes, created = await NotificationService.insert_notifications(db, batch)
+            
+            rollups = []
+            for data, positions, outcome in zip(batch, owners, outcomes):
+                for position in positions:
+                    results[position] = outcome
+                key = RollupService.key(data)
+                folded_keys = [
+                    notifications_data[p].idempotency_key for p in positions[1:]
+                    if notifications_data[p].idempotency_key
+                ]
+                if folded_keys:
+                    # Уведомление не создано - ключи остальных событий освобождаются вместе с ним
+                    statement = (
+                        delete(NotificationRollupKey) if isinstance(outcome, Exception)
+                        else update(NotificationRollupKey).values(notification_id=outcome)
+                    )
+                    await db.execute(statement.where(NotificationRollupKey.idempotency_key.in_(folded_keys)))
+                if key and not isinstance(outcome, Exception):
+                    rollups.append({
+                        "user_id": key[0],
+                        "type": key[1],
+                        "table_id": key[2],
+                        "notification_id": outcome,
+                        "event_count": len(positions),
+                        "record_ids": RollupService.sample([], [notifications_data[p] for p in positions]),
+                        "started_at": now,
+                        "updated_at": now
+                    })
+            if rollups:
+                stmt = upsert_dialect(db).insert(NotificationRollup).values(rollups)
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[NotificationRollup.user_id, NotificationRollup.type, NotificationRollup.table_id],
+                    set_={
+                        column: stmt.excluded[column]
+                        for column in ("notification_id", "event_count", "record_ids", "started_at", "updated_at")
+                    }
+                )
+                await db.execute(stmt)
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+        
+        for notification in created:
+            publish_created(notification)
+        for n, (notification_id, user_id, notification_type, changes) in enumerate(updates):
+            publish_rollup(notification_id, user_id, notification_type, first_seq + n, changes)
+        return results
+
 class AirtableService:
     """Сервис для обработки событий из Airtable"""
     
     @staticmethod
-    async def process_airtable_event(
-        db: AsyncSession,
-        event_data: dict
-    ) -> Notification:
-        """Обработать событие из Airtable и создать уведомление"""
+    def make_idempotency_key(*parts) -> str:
+        """Ключ идемпотентности события - sha256 от составных частей"""
+        return hashlib.sha256("|".join(str(part) for part in parts).encode()).hexdigest()
+    
+    @staticmethod
+    def iter_webhook_events(body: dict, idempotency_key: Optional[str] = None):
+        """
+        Развернуть webhook-payload Airtable в события - по одному на каждую пару (таблица, запись)
+        
+        Ключ идемпотентности события строится из заголовка Idempotency-Key, а без него -
+        из (webhook_id, base_id, record_id, event, timestamp). Payload без timestamp и
+        webhook_id ключа не получает: иначе разные правки одной записи считались бы повтором.
+        """
+        # Парсим событие Airtable
+        event_type = body.get("event", "")
+        base_id = body.get("base", {}).get("id", "")
+        webhook_id = body.get("webhook", {}).get("id", "")
+        event_timestamp = body.get("timestamp", "")
+        payload = body.get("payload", {})
+        
+        # Определяем тип действия
+        action = "unknown"
+        if "record.created" in event_type:
+            action = "created"
+        elif "record.updated" in event_type:
+            action = "updated"
+        elif "record.deleted" in event_type:
+            action = "deleted"
+        elif "attachment" in event_type.lower():
+            action = "attachment_added"
+        
+        # Извлекаем информацию о пользователе
+        user_info = payload.get("eventMetadata", {}).get("sourceMetadata", {}).get("user", {})
+        user_id = user_info.get("id", "unknown")
+        user_email = user_info.get("email", "unknown@example.com")
+        user_name = user_info.get("name", user_email.split("@")[0])
+        
+        for table_data in payload.get("tables", []):
+            table_id = table_data.get("id", "")
+            table_name = table_data.get("name", "Unknown Table")
+            
+            # Таблица без записей - одно событие уровня таблицы
+            for record_data in table_data.get("records") or [{}]:
+                record_id = record_data.get("id", "")
+                fields = record_data.get("fields", {})
+                
+                # Проверяем наличие вложений
+                attachment_url = None
+                for field_name, field_value in fields.items():
+                    if isinstance(field_value, list):
+                        for item in field_value:
+                            if isinstance(item, dict) and "url" in item:
+                                attachment_url = item["url"]
+                                break
+                
+                if idempotency_key:
+                    event_key = AirtableService.make_idempotency_key(idempotency_key, table_id, record_id)
+                elif webhook_id or event_timestamp:
+                    event_key = AirtableService.make_idempotency_key(
+                        webhook_id, base_id, table_id, record_id, event_type, event_timestamp
+                    )
+                else:
+                    event_key = None
+                
+                yield {
+                    "action": action,
+                    "base_id": base_id,
+                    "table_id": table_id,
+                    "table_name": table_name,
+                    "record_id": record_id,
+                    "user_id": user_id,
+                    "user_name": user_name,
+                    "user_email": user_email,
+                    "fields": fields,
+                    "attachment_url": attachment_url,
+                    "idempotency_key": event_key
+                }
+    
+    @staticmethod
+    def expand_webhook_payload(
+        body: dict,
+        max_events: Optional[int] = None,
+        coalesce: Optional[bool] = None,
+        idempotency_key: Optional[str] = None
+    ) -> tuple[List[dict], int]:
+        """
+        Собрать события webhook-payload с ограничением на их число
+        
+        В режиме coalesce несколько обновлений одной записи схлопываются в одно событие
+        с полем change_count. Возвращает (события, число отброшенных сверх лимита).
+        Без аргументов - WEBHOOK_MAX_EVENTS_PER_PAYLOAD и WEBHOOK_COALESCE_UPDATES.
+        """
+        if max_events is None:
+            max_events = WEBHOOK_MAX_EVENTS_PER_PAYLOAD
+        if coalesce is None:
+            coalesce = WEBHOOK_COALESCE_UPDATES
+        events = []
+        updates_by_record = {}
+        dropped = 0
+        
+        for event in AirtableService.iter_webhook_events(body, idempotency_key):
+            if coalesce and event["action"] == "updated" and event["record_id"]:
+                record_key = (event["table_id"], event["record_id"])
+                previous = updates_by_record.get(record_key)
+                if previous is not None:
+                    previous["change_count"] += 1
+                    previous["fields"].update(event["fields"])
+                    previous["attachment_url"] = event["attachment_url"] or previous["attachment_url"]
+                    continue
+                event["fields"] = dict(event["fields"])
+                event["change_count"] = 1
+            
+            if len(events) >= max_events:
+                dropped += 1
+                continue
+            
+            events.append(event)
+            if event.get("change_count"):
+                updates_by_record[(event["table_id"], event["record_id"])] = event
+        
+        return events, dropped
+    
+    @staticmethod
+    def build_notification(event_data: dict) -> NotificationCreate:
+        """Преобразовать событие из Airtable в данные уведомления (по правилам или встроенной цепочке)"""
         
         # Парсим данные события
         action = event_data.get("action", "unknown")
@@ -239,7 +2053,25 @@ class AirtableService:
             "table_name": event_data.get("table_name", "Unknown")
         }
         
-        if action == "attachment_added" or attachment_url:
+        # Правила из файла (rules.py) проверяются раньше встроенного преобразования
+        rule = rule_engine.match(event_data)
+        if rule:
+            try:
+                notification_type, title, description = rule.render(event_data)
+            except Exception as e:
+                print(f"Ошибка шаблона правила {rule.rule.name}: {e}")
+                rule = None
+        
+        if rule:
+            details["rule"] = rule.rule.name
+            if event_data.get("record_id"):
+                details["record_id"] = event_data["record_id"]
+            if attachment_url:
+                details["attachment_url"] = attachment_url
+            if event_data.get("change_count", 1) > 1:
+                details["change_count"] = event_data["change_count"]
+        
+        elif action == "attachment_added" or attachment_url:
             notification_type = NotificationType.FILE_UPLOAD
             title = "Загрузка файла"
             file_name = attachment_url.split("/")[-1] if attachment_url else "файл"
@@ -260,14 +2092,19 @@ class AirtableService:
             record_name = fields.get("Name") or fields.get("title") or "Запись"
             description = f'Обновлена запись "{record_name}" в таблице "{details["table_name"]}"'
             details["record_id"] = event_data.get("record_id")
+            
+            # Схлопнутые обновления одной записи из одного payload
+            change_count = event_data.get("change_count", 1)
+            if change_count > 1:
+                description += f" (изменений: {change_count})"
+                details["change_count"] = change_count
         
         elif action == "deleted":
             notification_type = NotificationType.RECORD_DELETE
             title = "Удаление записи"
             description = f'Удалена запись из таблицы "{details["table_name"]}"'
         
-        # Создаем уведомление
-        notification_data = NotificationCreate(
+        return NotificationCreate(
             type=notification_type,
             title=title,
             description=description,
@@ -275,8 +2112,41 @@ class AirtableService:
             user_name=user_name,
             source="airtable",
             details=details,
-            event_metadata=event_data
+            event_metadata=event_data,
+            idempotency_key=event_data.get("idempotency_key")
         )
-        
+    
+    @staticmethod
+    async def process_airtable_event(
+        db: AsyncSession,
+        event_data: dict
+    ) -> Notification:
+        """Обработать событие из Airtable и создать уведомление"""
+        notification_data = AirtableService.build_notification(event_data)
         return await NotificationService.create_notification(db, notification_data)
+    
+    @staticmethod
+    async def process_airtable_events(
+        db: AsyncSession,
+        events: List[dict]
+    ) -> List[Union[int, Exception]]:
+        """
+        Обработать пачку событий из Airtable одной массовой вставкой; результат - по каждому событию
+        
+        Однотипные события складываются в сводки (RollupService).
+        """
+        outcomes: List[Union[int, Exception, None]] = []
+        notifications_data = []
+        for event in events:
+            try:
+                notifications_data.append(AirtableService.build_notification(event))
+                outcomes.append(None)
+            except Exception as e:
+                outcomes.append(e)
+        
+        created = iter(
+            await RollupService.create_notifications(db, notifications_data)
+            if notifications_data else []
+        )
+        return [outcome if outcome is not None else next(created) for outcome in outcomes]
 
@@ -66,6 +66,7 @@ document.querySelectorAll('.chip').forEach(chip => {
 document.addEventListener('DOMContentLoaded', async () => {
     await loadNotifications();
     await loadManagers(); // Загружаем менеджеров из API
+    connectLiveFeed(); // Дальше новые уведомления приходят без повторной загрузки
 });
 
 // Toggle filter panel
@@ -88,6 +89,8 @@ async function loadNotifications() {
         }
         params.append('limit', '100');
         params.append('offset', '0');
+        // Только поля карточки: metadata (сырое событие Airtable) списку не нужна
+        params.append('fields', 'type,title,description,user_id,user_name,status,details');
         
         const url = `${API_BASE_URL}/notifications?${params.toString()}`;
         const response = await fetch(url);
@@ -99,17 +102,8 @@ async function loadNotifications() {
         const data = await response.json();
         
         // Преобразуем данные API в формат для фронтенда
-        notifications = data.notifications.map(n => ({
-            id: n.id,
-            type: n.type,
-            title: n.title,
-            description: n.description,
-            user: n.user_name,
-            userId: n.user_id,
-            timestamp: new Date(n.timestamp).getTime(),
-            read: n.status === 'read',
-            details: n.details ? Object.values(n.details) : []
-        }));
+        notifications = data.notifications.map(mapNotification);
+        lastSeq = data.last_seq || 0;
         
         renderNotifications();
         await loadStats();
@@ -125,6 +119,89 @@ async function loadNotifications() {
     }
 }
 
+// Преобразование уведомления из API в формат для фронтенда
+function mapNotification(n) {
+    return {
+        id: n.id,
+        type: n.type,
+        title: n.title,
+        description: n.description,
+        user: n.user_name,
+        userId: n.user_id,
+        timestamp: new Date(n.timestamp).getTime(),
+        read: n.status === 'read',
+        details: n.details ? Object.values(n.details) : []
+    };
+}
+
+// Live feed - события через SSE вместо периодической перезагрузки списка
+let liveFeed = null;
+// Номер последнего изменения, вошедшего в загруженный список (last_seq)
+let lastSeq = 0;
+
+function connectLiveFeed() {
+    if (!window.EventSource || liveFeed) return;
+    
+    // При переподключении браузер сам передаст Last-Event-ID и сервер догрузит
+    // все изменения после него - и новые уведомления, и смены статуса
+    const params = new URLSearchParams();
+    if (lastSeq) {
+        params.append('last_event_id', lastSeq);
+    }
+    liveFeed = new EventSource(`${API_BASE_URL}/notifications/stream?${params.toString()}`);
+    
+    liveFeed.addEventListener('created', (event) => {
+        const data = JSON.parse(event.data);
+        if (notifications.some(n => n.id === data.id)) return;
+        
+        const notification = mapNotification(data.notification);
+        notifications.unshift(notification);
+        renderNotifications();
+        
+        if (filters.manager === 'all' || notification.userId === filters.manager) {
+            totalCountEl.textContent = Number(totalCountEl.textContent) + 1;
+            unreadCountEl.textContent = Number(unreadCountEl.textContent) + 1;
+            todayCountEl.textContent = Number(todayCountEl.textContent) + 1;
+        }
+    });
+    
+    liveFeed.addEventListener('updated', (event) => {
+        const data = JSON.parse(event.data);
+        const notification = notifications.find(n => n.id === data.id);
+        if (!notification) {
+            // Догон после переподключения: уведомление создано, пока лента была отключена
+            if (data.notification) {
+                const added = mapNotification(data.notification);
+                notifications.push(added);
+                notifications.sort((a, b) => b.timestamp - a.timestamp);
+                renderNotifications();
+                if (!added.read) {
+                    unreadCountEl.textContent = Number(unreadCountEl.textContent) + 1;
+                }
+                totalCountEl.textContent = Number(totalCountEl.textContent) + 1;
+            }
+            return;
+        }
+        
+        // В сводку добавились события - новые заголовок, описание и детали
+        if (data.changes) {
+            Object.assign(notification, {
+                title: data.changes.title,
+                description: data.changes.description,
+                details: Object.values(data.changes.details || {})
+            });
+            renderNotifications();
+        }
+        
+        const read = data.status === 'read';
+        if (notification.read !== read) {
+            notification.read = read;
+            unreadCountEl.textContent = Math.max(0, Number(unreadCountEl.textContent) + (read ? -1 : 1));
+            renderNotifications();
+        }
+    });
+}
+
 // Render notifications
 function renderNotifications() {
     notificationsContainer.innerHTML = '';
@@ -0,0 +1,413 @@
+"""
+Доставка уведомлений в Telegram (push)
+
+Уведомление пользователя с привязанным чатом (telegram_recipients) попадает в
+telegram_outbox в той же транзакции, что и само уведомление, - при падении процесса
+ничего не теряется. Диспетчер раз в TELEGRAM_POLL_SECONDS (и сразу после новых
+уведомлений) забирает строки каждого чата, как только самой старой исполнилось
+TELEGRAM_DIGEST_WINDOW_SECONDS: все, что пришло за окно, уходит одним сообщением.
+
+Пул из TELEGRAM_WORKERS отправителей соблюдает лимиты Bot API token bucket'ами:
+общий (TELEGRAM_GLOBAL_RATE сообщений в секунду) и на чат (TELEGRAM_CHAT_RATE).
+Сеть, 5xx и 429 повторяются с экспоненциальной задержкой (429 - через retry_after,
+на это время приостанавливается вся отправка бота, и попытка не тратится),
+400/403 (чат не найден, бот заблокирован) и исчерпанные попытки переводят
+строки в dead: они видны в GET /api/telegram/outbox/dead и возвращаются
+в очередь вручную.
+
+Адрес Bot API задается TELEGRAM_API_URL - для разработки и тестов есть локальный
+фейковый сервер fake_telegram.py.
+"""
+import asyncio
+import html
+import os
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+import httpx
+from sqlalchemy import select, update, delete, func
+
+from database import AsyncSessionLocal, TelegramOutbox, TelegramRecipient
+from pubsub import broadcaster
+
+TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+TELEGRAM_PUSH_ENABLED = os.getenv("TELEGRAM_PUSH_ENABLED", "false").lower() in ("1", "true", "yes")
+TELEGRAM_WORKERS = int(os.getenv("TELEGRAM_WORKERS", "4"))
+# Bot API: около 30 сообщений в секунду на бота и 1 в секунду в один чат
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+# Окно сбора дайджеста: события чата за это время уходят одним сообщением (0 - сразу)
+TELEGRAM_DIGEST_WINDOW_SECONDS = float(os.getenv("TELEGRAM_DIGEST_WINDOW_SECONDS", "30"))
+# Строк очереди в одном сообщении и сколько из них перечислять в тексте
+TELEGRAM_DIGEST_MAX_ROWS = int(os.getenv("TELEGRAM_DIGEST_MAX_ROWS", "100"))
+TELEGRAM_DIGEST_LIST_ITEMS = int(os.getenv("TELEGRAM_DIGEST_LIST_ITEMS", "10"))
+TELEGRAM_POLL_SECONDS = float(os.getenv("TELEGRAM_POLL_SECONDS", "5"))
+TELEGRAM_MAX_ATTEMPTS = int(os.getenv("TELEGRAM_MAX_ATTEMPTS", "8"))
+TELEGRAM_RETRY_BASE_SECONDS = float(os.getenv("TELEGRAM_RETRY_BASE_SECONDS", "5"))
+TELEGRAM_RETRY_MAX_SECONDS = float(os.getenv("TELEGRAM_RETRY_MAX_SECONDS", "3600"))
+# На это время забранные строки скрыты от диспетчера (и от других процессов)
+TELEGRAM_LEASE_SECONDS = float(os.getenv("TELEGRAM_LEASE_SECONDS", "120"))
+TELEGRAM_TIMEOUT_SECONDS = float(os.getenv("TELEGRAM_TIMEOUT_SECONDS", "10"))
+# Кнопка "Открыть" под сообщением - Mini App
+TELEGRAM_WEBAPP_URL = os.getenv("TELEGRAM_WEBAPP_URL", "")
+
+# Максимальная длина текста сообщения в Bot API
+MESSAGE_MAX_LENGTH = 4096
+
+TYPE_ICONS = {
+    "file_upload": "📎",
+    "record_create": "🆕",
+    "record_update": "✏️",
+    "record_delete": "🗑",
+    "user_action": "👤",
+}
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity про запас"""
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """Дождаться и забрать один токен (ожидающие обслуживаются по очереди)"""
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Не выдавать токены seconds секунд (ответ 429 с retry_after)"""
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    @property
+    def idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+class TelegramError(Exception):
+    """Ошибка Bot API или сети"""
+
+    def __init__(self, description: str, status: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(description)
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def permanent(self) -> bool:
+        """Повтор не поможет: чат не найден, бот заблокирован, неверный запрос"""
+        return self.status in (400, 403)
+
+def render_digest(rows: List[dict]) -> str:
+    """Текст сообщения: одно уведомление целиком или сводка по нескольким (HTML)"""
+    if len(rows) == 1:
+        row = rows[0]
+        text = f"{TYPE_ICONS.get(row['type'], '🔔')} <b>{html.escape(row['title'])}</b>\n{html.escape(row['description'])}"
+    else:
+        lines = [f"🔔 <b>Новых уведомлений: {len(rows)}</b>"]
+        for row in rows[:TELEGRAM_DIGEST_LIST_ITEMS]:
+            lines.append(f"{TYPE_ICONS.get(row['type'], '•')} {html.escape(row['title'])}")
+        if len(rows) > TELEGRAM_DIGEST_LIST_ITEMS:
+            lines.append(f"… и еще {len(rows) - TELEGRAM_DIGEST_LIST_ITEMS}")
+        text = "\n".join(lines)
+    if len(text) > MESSAGE_MAX_LENGTH:
+        text = text[:MESSAGE_MAX_LENGTH - 1] + "…"
+    return text
+
+def retry_delay(attempts: int, retry_after: Optional[float] = None) -> float:
+    """Задержка перед следующей попыткой: retry_after от Telegram или экспонента с разбросом"""
+    if retry_after is not None:
+        return retry_after
+    delay = min(TELEGRAM_RETRY_BASE_SECONDS * 2 ** (attempts - 1), TELEGRAM_RETRY_MAX_SECONDS)
+    # Разброс, чтобы после сбоя Telegram повторы не пришли все разом
+    return delay * random.uniform(0.8, 1.2)
+
+class TelegramDelivery:
+    """Диспетчер дайджестов и пул отправителей"""
+
+    # Сколько чатов забирать за один проход диспетчера
+    DISPATCH_CHATS = 100
+    # Не держать бесконечно token bucket'ы давно молчащих чатов
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(
+        self,
+        token: str = TELEGRAM_BOT_TOKEN,
+        api_url: str = TELEGRAM_API_URL,
+        workers: int = TELEGRAM_WORKERS,
+        global_rate: float = TELEGRAM_GLOBAL_RATE,
+        chat_rate: float = TELEGRAM_CHAT_RATE,
+        digest_window: float = TELEGRAM_DIGEST_WINDOW_SECONDS,
+        max_attempts: int = TELEGRAM_MAX_ATTEMPTS,
+        poll_interval: float = TELEGRAM_POLL_SECONDS,
+        transport: Optional[httpx.AsyncBaseTransport] = None
+    ):
+        self.token = token
+        self.api_url = api_url.rstrip("/")
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.digest_window = digest_window
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.transport = transport
+        self.global_bucket = TokenBucket(global_rate, capacity=max(1.0, global_rate))
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._client: Optional[httpx.AsyncClient] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self._listening = False
+        self.messages_sent = 0
+        self.notifications_sent = 0
+        self.retries = 0
+        self.dead = 0
+        self.rate_limited = 0
+        self.last_error: Optional[str] = None
+
+    @property
+    def running(self) -> bool:
+        return any(not task.done() for task in self._tasks)
+
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=f"{self.api_url}/bot{self.token}/",
+                timeout=TELEGRAM_TIMEOUT_SECONDS,
+                transport=self.transport
+            )
+        return self._client
+
+    def chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.MAX_CHAT_BUCKETS:
+                self._chat_buckets = {key: value for key, value in self._chat_buckets.items() if not value.idle}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate)
+        return bucket
+
+    def wake(self, event: Optional[dict] = None):
+        """Слушатель broadcaster: новое уведомление - проверить очередь, не дожидаясь опроса"""
+        if self._wakeup is not None and (event is None or event.get("event") == "created"):
+            self._wakeup.set()
+
+    async def start(self):
+        """Запустить диспетчер и отправителей (вызывается из lifespan)"""
+        if self.running:
+            return
+        if not self.token:
+            print("TELEGRAM_PUSH_ENABLED без TELEGRAM_BOT_TOKEN - доставка в Telegram не запущена")
+            return
+        self._queue = asyncio.Queue(self.workers * 2)
+        self._wakeup = asyncio.Event()
+        self._stopping = asyncio.Event()
+        if not self._listening:
+            broadcaster.add_listener(self.wake)
+            self._listening = True
+        self._tasks = [asyncio.create_task(self._dispatch_loop())]
+        self._tasks += [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Остановить диспетчер, дождаться отправки уже забранных дайджестов"""
+        if self.running:
+            self._stopping.set()
+            self._wakeup.set()
+            await self._tasks[0]
+            for _ in range(self.workers):
+                await self._queue.put(None)
+            await asyncio.gather(*self._tasks[1:])
+        self._tasks = []
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _dispatch_loop(self):
+        while not self._stopping.is_set():
+            # До прохода: уведомления, созданные во время него, разбудят следующий
+            self._wakeup.clear()
+            try:
+                for digest in await self.claim_due():
+                    await self._queue.put(digest)
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"Ошибка диспетчера доставки в Telegram: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                if self.digest_window:
+                    # Окно нового уведомления закончится не раньше чем через digest_window
+                    await asyncio.wait_for(self._stopping.wait(), self.digest_window)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self):
+        while True:
+            digest = await self._queue.get()
+            if digest is None:
+                return
+            try:
+                await self.deliver(*digest)
+            except Exception as e:
+                # Строки остались арендованными - после аренды диспетчер заберет их снова
+                self.last_error = str(e)
+                print(f"Ошибка доставки в Telegram: {e}")
+
+    async def claim_due(self, now: Optional[datetime] = None) -> List[tuple]:
+        """
+        Забрать готовые дайджесты: (chat_id, строки) по чатам, у которых старейшей строке
+        исполнилось окно. Строки арендуются (next_attempt_at сдвигается на время аренды).
+        """
+        now = now or datetime.utcnow()
+        digests = []
+        async with AsyncSessionLocal() as db:
+            due = await db.execute(
+                select(TelegramOutbox.chat_id)
+                .where(TelegramOutbox.status == "pending", TelegramOutbox.next_attempt_at <= now)
+                .group_by(TelegramOutbox.chat_id)
+                .having(func.min(TelegramOutbox.created_at) <= now - timedelta(seconds=self.digest_window))
+                .limit(self.DISPATCH_CHATS)
+            )
+            for chat_id in due.scalars().all():
+                ids = (
+                    select(TelegramOutbox.id)
+                    .where(
+                        TelegramOutbox.chat_id == chat_id,
+                        TelegramOutbox.status == "pending",
+                        TelegramOutbox.next_attempt_at <= now
+                    )
+                    .order_by(TelegramOutbox.id)
+                    .limit(TELEGRAM_DIGEST_MAX_ROWS)
+                    .scalar_subquery()
+                )
+                # Повторная проверка next_attempt_at: строку мог забрать другой процесс
+                result = await db.execute(
+                    update(TelegramOutbox)
+                    .where(TelegramOutbox.id.in_(ids), TelegramOutbox.next_attempt_at <= now)
+                    .values(next_attempt_at=now + timedelta(seconds=TELEGRAM_LEASE_SECONDS))
+                    .returning(
+                        TelegramOutbox.id, TelegramOutbox.user_id, TelegramOutbox.type,
+                        TelegramOutbox.title, TelegramOutbox.description, TelegramOutbox.attempts
+                    )
+                )
+                rows = sorted((dict(row._mapping) for row in result), key=lambda row: row["id"])
+                if rows:
+                    for row in rows:
+                        row["type"] = row["type"].value
+                    digests.append((chat_id, rows))
+            await db.commit()
+        return digests
+
+    async def send_message(self, chat_id: int, text: str):
+        """sendMessage; TelegramError при ошибке Bot API или сети"""
+        payload = {"chat_id": chat_id, "text": text, "parse_mode": "HTML", "disable_web_page_preview": True}
+        if TELEGRAM_WEBAPP_URL:
+            payload["reply_markup"] = {
+                "inline_keyboard": [[{"text": "Открыть", "web_app": {"url": TELEGRAM_WEBAPP_URL}}]]
+            }
+        try:
+            response = await self.client().post("sendMessage", json=payload)
+            body = response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            raise TelegramError(f"{type(e).__name__}: {e}")
+        if not body.get("ok"):
+            retry_after = (body.get("parameters") or {}).get("retry_after")
+            raise TelegramError(
+                body.get("description") or f"HTTP {response.status_code}",
+                body.get("error_code") or response.status_code,
+                retry_after
+            )
+        return body["result"]
+
+    async def deliver(self, chat_id: int, rows: List[dict]):
+        """Отправить дайджест с учетом лимитов и записать результат в очередь"""
+        # Сначала лимит чата: ожидание своей очереди не должно занимать общий токен
+        await self.chat_bucket(chat_id).acquire()
+        await self.global_bucket.acquire()
+        try:
+            await self.send_message(chat_id, render_digest(rows))
+        except TelegramError as e:
+            self.last_error = str(e)
+            if e.status == 429:
+                # Flood control Telegram считается на бота: паузу держат все чаты, а не только этот
+                self.rate_limited += 1
+                self.chat_bucket(chat_id).pause(e.retry_after or 1)
+                self.global_bucket.pause(e.retry_after or 1)
+            await self._failed(chat_id, rows, e)
+            return
+        except Exception as e:
+            self.last_error = str(e)
+            await self._failed(chat_id, rows, TelegramError(str(e)))
+            return
+
+        async with AsyncSessionLocal() as db:
+            await db.execute(delete(TelegramOutbox).where(TelegramOutbox.id.in_([row["id"] for row in rows])))
+            await db.commit()
+        self.messages_sent += 1
+        self.notifications_sent += len(rows)
+
+    async def _failed(self, chat_id: int, rows: List[dict], error: TelegramError):
+        """Повтор с задержкой или dead; бот заблокирован - чат отключается"""
+        now = datetime.utcnow()
+        async with AsyncSessionLocal() as db:
+            for row in rows:
+                values = {"last_error": str(error)[:1000]}
+                if error.status == 429:
+                    # Flood control - лимит бота, а не ошибка сообщения: отправка уже на паузе,
+                    # повтор после retry_after не тратит попытку и не уводит строку в dead
+                    values["next_attempt_at"] = now + timedelta(seconds=error.retry_after or 1)
+                    self.retries += 1
+                else:
+                    attempts = row["attempts"] + 1
+                    values["attempts"] = attempts
+                    if error.permanent or attempts >= self.max_attempts:
+                        values["status"] = "dead"
+                        self.dead += 1
+                    else:
+                        values["next_attempt_at"] = now + timedelta(seconds=retry_delay(attempts, error.retry_after))
+                        self.retries += 1
+                await db.execute(update(TelegramOutbox).where(TelegramOutbox.id == row["id"]).values(**values))
+            if error.status == 403:
+                await db.execute(
+                    update(TelegramRecipient).where(TelegramRecipient.chat_id == chat_id).values(enabled=False)
+                )
+            await db.commit()
+
+    async def flush(self) -> int:
+        """Забрать и отправить все готовые дайджесты сразу (тесты, ручной запуск); число дайджестов"""
+        digests = await self.claim_due()
+        await asyncio.gather(*(self.deliver(chat_id, rows) for chat_id, rows in digests))
+        return len(digests)
+
+    def stats(self) -> dict:
+        """Метрики доставки"""
+        return {
+            "enabled": TELEGRAM_PUSH_ENABLED,
+            "running": self.running,
+            "workers": self.workers,
+            "queued_digests": self._queue.qsize() if self._queue else 0,
+            "digest_window_seconds": self.digest_window,
+            "global_rate": self.global_bucket.rate,
+            "chat_rate": self.chat_rate,
+            "messages_sent": self.messages_sent,
+            "notifications_sent": self.notifications_sent,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "dead": self.dead,
+            "last_error": self.last_error
+        }
+
+telegram_delivery = TelegramDelivery()
@@ -78,6 +78,24 @@ def test_create_custom_notification():
     print_response("Создание кастомного уведомления", response)
     return response.status_code in [200, 201]
 
+def test_create_batch():
+    """Массовое создание уведомлений"""
+    print("Массовое создание уведомлений...")
+    item = {
+        "type": "record_create",
+        "title": "Создание записи",
+        "description": "Создана запись в таблице Проекты",
+        "user_id": "manager_test",
+        "user_name": "Тестовый менеджер"
+    }
+    # Второй элемент невалиден - должен попасть в отчет, не отменив остальные
+    response = requests.post(
+        f"{API_BASE}/notifications/batch",
+        json=[item, {"type": "record_create"}, item]
+    )
+    print_response("Массовое создание", response)
+    return response.status_code == 207 and response.json()["created"] == 2
+
 def main():
     print("[*] Начинаем тестирование API...")
     print("Убедитесь, что сервер запущен (python main.py)")
@@ -92,6 +110,7 @@ def main():
     
     test_create_notification()
     test_create_custom_notification()
+    test_create_batch()
     test_get_notifications()
     test_get_stats()
     